@@ -1,8 +1,10 @@
 from django.contrib import admin
 
-from apps.accounts.models import User, UserContact, ChatGroup, GroupMember
+from apps.accounts.models import User, UserContact, ChatGroup, GroupMember, Job, MediaFile
 
 admin.site.register(User)
 admin.site.register(UserContact)
 admin.site.register(ChatGroup)
 admin.site.register(GroupMember)
+admin.site.register(Job)
+admin.site.register(MediaFile)
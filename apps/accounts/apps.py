@@ -4,3 +4,11 @@ from django.apps import AppConfig
 class AccountsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'apps.accounts'
+
+    def ready(self):
+        from django.db.backends.signals import connection_created
+
+        from apps.accounts import checks, signals, tasks  # noqa: F401
+        from apps.accounts.metrics import install_query_recorder
+
+        connection_created.connect(install_query_recorder)
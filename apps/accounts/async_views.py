@@ -0,0 +1,237 @@
+"""
+Async versions of the I/O bound accounts endpoints, served by the ASGI worker.
+
+They return the same payloads as the DRF views in apps.accounts.views and use
+the same serializers, throttles and caches, but read and write through the async
+ORM so a request waiting on the database or the cache doesn't hold a thread.
+Requests they don't handle, e.g. PUT users/me/, browsers asking for the
+browsable API and session authenticated clients, are passed to the DRF view.
+Enabled with the ASYNC_VIEWS setting.
+"""
+import functools
+import io
+from types import SimpleNamespace
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db.models import Max
+from rest_framework import exceptions, status
+from rest_framework.authtoken.models import Token
+from rest_framework.response import Response
+from rest_framework.serializers import as_serializer_error
+from rest_framework.views import exception_handler
+
+from apps.accounts import cache as accounts_cache
+from apps.accounts import fast_serializers, jobs, throttling
+from apps.accounts.authentication import CustomTokenAuthentication
+from apps.accounts.conditional import Validators
+from apps.accounts.models import UserContact
+from apps.accounts.parsers import FastJSONParser, MessagePackParser
+from apps.accounts.renderers import FastJSONRenderer, MessagePackRenderer
+from apps.accounts.serializers import LoginSerializer, VerifyOtpSerializer, SyncCursorSerializer
+from apps.accounts.views import LoginApiView, UserViewSet, VerifyOtpApiView, sync_contacts, sync_page
+
+User = get_user_model()
+
+FORM_MEDIA_TYPES = ("application/x-www-form-urlencoded", "multipart/form-data")
+
+
+def parse(request):
+    """
+    request.data of a DRF view, for the media types the API accepts.
+    """
+    if request.content_type in FORM_MEDIA_TYPES:
+        return request.POST
+    if not request.body:
+        return {}
+    if request.content_type == MessagePackParser.media_type:
+        parser = MessagePackParser()
+    elif request.content_type == FastJSONParser.media_type:
+        parser = FastJSONParser()
+    else:
+        raise exceptions.UnsupportedMediaType(request.content_type)
+    parser_context = {"encoding": request.encoding or settings.DEFAULT_CHARSET}
+    return parser.parse(io.BytesIO(request.body), parser_context=parser_context)
+
+
+def negotiate(request):
+    """
+    Render as msgpack when the client asks for it, else as JSON. Set on the
+    request before the view runs like DRF does, the ETag depends on it.
+    """
+    if MessagePackRenderer.media_type in request.headers.get("Accept", ""):
+        request.accepted_renderer = MessagePackRenderer()
+    else:
+        request.accepted_renderer = FastJSONRenderer()
+    request.accepted_media_type = request.accepted_renderer.media_type
+
+
+def finalize(request, response):
+    """
+    Render a DRF Response with the renderer negotiate() picked.
+    """
+    response.accepted_renderer = request.accepted_renderer
+    response.accepted_media_type = request.accepted_media_type
+    response.renderer_context = {"request": request, "response": response}
+    return response.render()
+
+
+async def authenticate(request):
+    """
+    Token authentication, sets request.user and request.auth like DRF does.
+    """
+    user_auth = await CustomTokenAuthentication().aauthenticate(request)
+    if user_auth is None:
+        raise exceptions.NotAuthenticated()
+    request.user, request.auth = user_auth
+
+
+async def check_throttles(request, data, throttle_classes):
+    """
+    APIView.check_throttles, every throttle counts the request.
+    """
+    # The throttles only read request.META and request.data
+    throttle_request = SimpleNamespace(META=request.META, data=data)
+
+    def check():
+        throttles = [throttle_class() for throttle_class in throttle_classes]
+        return [throttle.wait() for throttle in throttles if not throttle.allow_request(throttle_request, None)]
+
+    waits = await sync_to_async(check)()
+    if waits:
+        waits = [wait for wait in waits if wait is not None]
+        raise exceptions.Throttled(max(waits, default=None))
+
+
+async def is_valid(serializer):
+    """
+    serializer.is_valid(raise_exception=True) for serializers with an async avalidate().
+    """
+    try:
+        attrs = serializer.to_internal_value(serializer.initial_data)
+        serializer._validated_data = await serializer.avalidate(attrs)
+    except exceptions.ValidationError as exc:
+        raise exceptions.ValidationError(detail=as_serializer_error(exc))
+    return serializer.validated_data
+
+
+def needs_drf(request):
+    """
+    Browsers and session authenticated clients, only the DRF views serve the
+    browsable API and SessionAuthentication.
+    """
+    if "text/html" in request.headers.get("Accept", ""):
+        return True
+    return "Auth" not in request.headers and settings.SESSION_COOKIE_NAME in request.COOKIES
+
+
+def api_view(methods, fallback, authenticated=False):
+    """
+    Wrap an async view with DRF's error responses and rendering.
+
+    Other methods, browsers and session clients go to ``fallback``, the DRF view.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        async def wrapper(request, *args, **kwargs):
+            if request.method not in methods or needs_drf(request):
+                return await sync_to_async(fallback)(request, *args, **kwargs)
+            else:
+                negotiate(request)
+                try:
+                    if authenticated:
+                        await authenticate(request)
+                    response = await view(request, *args, **kwargs)
+                except (exceptions.NotAuthenticated, exceptions.AuthenticationFailed) as exc:
+                    # SessionAuthentication comes first, DRF answers these with a 403
+                    exc.status_code = status.HTTP_403_FORBIDDEN
+                    response = exception_handler(exc, {})
+                except exceptions.APIException as exc:
+                    response = exception_handler(exc, {})
+            if isinstance(response, Response):
+                response = finalize(request, response)
+            return response
+        # Token authenticated like the DRF views, csrf_exempt() only wraps sync views in Django 4.1
+        wrapper.csrf_exempt = True
+        return wrapper
+    return decorator
+
+
+@api_view(("POST",), LoginApiView.as_view())
+async def login(request):
+    data = parse(request)
+    await check_throttles(request, data, (throttling.LoginIPRateThrottle, throttling.LoginMobileNumberRateThrottle))
+    serializer = LoginSerializer(data=data)
+    serializer.is_valid(raise_exception=True)
+    await serializer.asend_otp(serializer.validated_data)
+    return Response(status=status.HTTP_200_OK)
+
+
+@api_view(("POST",), VerifyOtpApiView.as_view())
+async def verify_otp(request):
+    data = parse(request)
+    await check_throttles(
+        request, data, (throttling.VerifyOtpIPRateThrottle, throttling.VerifyOtpMobileNumberRateThrottle)
+    )
+    user = (await is_valid(VerifyOtpSerializer(data=data)))["user"]
+
+    await jobs.aenqueue("activate_contacts", {"user_id": user.id})
+
+    token, created = await Token.objects.aget_or_create(user=user)
+    return Response({
+        "token": token.key,
+        "name": user.name,
+        "username": user.username,
+        "id": user.id
+    }, status=status.HTTP_200_OK)
+
+
+@api_view(("GET",), UserViewSet.as_view({"get": "sync"}), authenticated=True)
+async def sync(request):
+    """
+    UserViewSet.sync
+    """
+    params = SyncCursorSerializer(data=request.GET)
+    params.is_valid(raise_exception=True)
+    change_seq, contact_id = params.validated_data["cursor"]
+    page_size = params.validated_data.get("page_size", settings.SYNC_PAGE_SIZE)
+
+    last_change_seq = (await UserContact.objects.filter(user=request.user).aaggregate(
+        last=Max("change_seq")
+    ))["last"] or 0
+    validators = Validators("sync", [last_change_seq], request)
+    response = validators.not_modified(request)
+    if response:
+        return response
+
+    serializer = fast_serializers.SyncContactFastSerializer(context={"request": request})
+    cursor = (change_seq, contact_id)
+    contacts = [contact async for contact in sync_contacts(request.user, cursor, serializer.paths)[:page_size + 1]]
+    return validators.apply(
+        Response(status=status.HTTP_200_OK, data=sync_page(serializer, contacts, page_size, cursor))
+    )
+
+
+@api_view(("GET",), UserViewSet.as_view({"get": "me", "put": "me"}), authenticated=True)
+async def me(request):
+    """
+    GET of UserViewSet.me, updates go to the DRF view.
+    """
+    version_keys = [accounts_cache.user_key(request.user.id)]
+    versions = await sync_to_async(accounts_cache.get_versions)(version_keys)
+    validators = Validators("me", versions.values(), request)
+    response = validators.not_modified(request)
+    if response:
+        return response
+
+    async def build():
+        serializer = fast_serializers.UserFastSerializer(context={"request": request})
+        return serializer.to_representation(
+            await serializer.values(User.objects.filter(id=request.user.id)).afirst()
+        )
+
+    data = await accounts_cache.acached_data(
+        f"me:{request.user.id}:{request.build_absolute_uri('/')}", version_keys, build, versions=versions
+    )
+    return validators.apply(Response(status=status.HTTP_200_OK, data=data))
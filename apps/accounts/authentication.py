@@ -1,5 +1,13 @@
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+from asgiref.sync import sync_to_async
 from rest_framework.authentication import TokenAuthentication
 from rest_framework import HTTP_HEADER_ENCODING, exceptions
+from django.conf import settings
+from django.core.cache import caches
 from django.utils.translation import gettext_lazy as _
 
 
@@ -16,9 +24,105 @@ def get_authorization_header(request):
     return auth
 
 
+class TokenCache:
+    """
+    Token key -> Token (with its user) cache in two tiers: a bounded LRU local
+    to the process and, when ``SHARED_CACHE`` names a cache alias, a cache
+    shared by all workers. Entries live at most ``TTL`` seconds.
+
+    Token deletion and user saves changing ``is_active`` evict the entry through
+    model signals, see apps.accounts.signals. Other processes still hold their
+    local copy until it expires, so keep ``TTL`` short. Views read the fields of
+    the cached user they need, besides its id, from the database.
+    """
+
+    key_prefix = "auth-token:"
+
+    def __init__(self, max_size, ttl, shared_cache=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.shared_cache = shared_cache
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    @property
+    def shared(self):
+        return caches[self.shared_cache] if self.shared_cache else None
+
+    def get(self, key):
+        token = self.get_local(key)
+        if token is None:
+            token = self.get_shared(key)
+        return token
+
+    def get_local(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry[1] > time.monotonic():
+                    self.entries.move_to_end(key)
+                    return self.copy(entry[0])
+                del self.entries[key]
+        return None
+
+    def get_shared(self, key):
+        if self.shared is not None:
+            token = self.shared.get(self.key_prefix + key)
+            if token is not None:
+                self.set_local(key, token)
+                return self.copy(token)
+        return None
+
+    def set(self, key, token):
+        token = self.copy(token)
+        self.set_local(key, token)
+        if self.shared is not None:
+            self.shared.set(self.key_prefix + key, token, self.ttl)
+
+    def set_local(self, key, token):
+        with self.lock:
+            self.entries[key] = (token, time.monotonic() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+        if self.shared is not None:
+            self.shared.delete(self.key_prefix + key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    @staticmethod
+    def copy(token):
+        # Callers get their own instances, saving request.user must not change the cached one.
+        token = copy.copy(token)
+        token.user = copy.copy(token.user)
+        return token
+
+
+token_cache = TokenCache(
+    max_size=settings.AUTH_TOKEN_CACHE["MAX_SIZE"],
+    ttl=settings.AUTH_TOKEN_CACHE["TTL"],
+    shared_cache=settings.AUTH_TOKEN_CACHE.get("SHARED_CACHE"),
+)
+
+
 class CustomTokenAuthentication(TokenAuthentication):
 
     def authenticate(self, request):
+        key = self.get_key(request)
+        if key is None:
+            return None
+        return self.authenticate_credentials(key)
+
+    def get_key(self, request):
+        """
+        Token key from the auth header, None when the header is not a token one.
+        """
         auth = get_authorization_header(request).split()
 
         if not auth or auth[0].lower() != self.keyword.lower().encode():
@@ -32,9 +136,42 @@ class CustomTokenAuthentication(TokenAuthentication):
             raise exceptions.AuthenticationFailed(msg)
 
         try:
-            token = auth[1].decode()
+            return auth[1].decode()
         except UnicodeError:
             msg = _('Invalid token header. Token string should not contain invalid characters.')
             raise exceptions.AuthenticationFailed(msg)
 
-        return self.authenticate_credentials(token)
+    def authenticate_credentials(self, key):
+        token = token_cache.get(key)
+        if token is None:
+            user, token = super().authenticate_credentials(key)
+            token_cache.set(key, token)
+            return (user, token)
+        self.check_active(token)
+        return (token.user, token)
+
+    def check_active(self, token):
+        # A cached copy may predate the deactivation, e.g. one of another process
+        if not token.user.is_active:
+            raise exceptions.AuthenticationFailed(_('User inactive or deleted.'))
+
+    async def aauthenticate(self, request):
+        """
+        authenticate() for async views, the token is read with the async ORM.
+        """
+        key = self.get_key(request)
+        if key is None:
+            return None
+        token = token_cache.get_local(key)
+        if token is None and token_cache.shared_cache:
+            token = await sync_to_async(token_cache.get_shared)(key)
+        if token is None:
+            try:
+                token = await self.get_model().objects.select_related('user').aget(key=key)
+            except self.get_model().DoesNotExist:
+                raise exceptions.AuthenticationFailed(_('Invalid token.'))
+            self.check_active(token)
+            await sync_to_async(token_cache.set)(key, token)
+        else:
+            self.check_active(token)
+        return (token.user, token)
@@ -0,0 +1,128 @@
+"""
+Fixed size avatar variants of User.image.
+
+Uploads are only sniffed on the request thread. The image is decoded and
+resized by the avatar_variants job, which records the results in
+User.image_variants as ``{"<size>": "<storage name>"}``.
+"""
+import imghdr
+import io
+import logging
+import os
+import uuid
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.files.base import ContentFile
+from PIL import Image, ImageOps
+
+from apps.accounts import jobs
+from apps.accounts.utils import ALLOWED_IMAGE_TYPES
+
+
+logger = logging.getLogger(__name__)
+
+User = get_user_model()
+
+
+class InvalidImage(Exception):
+    pass
+
+
+def get_storage():
+    return User._meta.get_field("image").storage
+
+
+def sniff(file):
+    """
+    Extension of an uploaded image from its first bytes, None when it isn't an allowed type.
+    """
+    file.seek(0)
+    extension = imghdr.what(None, file.read(32))
+    file.seek(0)
+    extension = "jpg" if extension == "jpeg" else extension
+    return extension if extension in ALLOWED_IMAGE_TYPES else None
+
+
+def random_name(extension):
+    return f"{str(uuid.uuid4())[:12]}.{extension}"
+
+
+def variant_urls(variants, request=None):
+    storage = get_storage()
+    urls = {}
+    for size, name in (variants or {}).items():
+        url = storage.url(name)
+        urls[size] = request.build_absolute_uri(url) if request is not None else url
+    return urls
+
+
+def schedule(user):
+    """
+    Generate the variants of the user's current image, once the transaction commits.
+    """
+    if user.image:
+        jobs.enqueue("avatar_variants", {"user_id": user.id, "name": user.image.name})
+
+
+def existing_variants(name):
+    """
+    Variants already generated for the same image, images are stored by content.
+    """
+    sizes = {str(size) for size in settings.AVATAR["SIZES"]}
+    for variants in User.objects.filter(image=name).exclude(image_variants={}).values_list("image_variants", flat=True):
+        if set(variants) == sizes:
+            return variants
+    return None
+
+
+def load(file, size):
+    """
+    Decode an image for crops of at most ``size``, return (image, format, extension) of the crops.
+    """
+    try:
+        image = Image.open(file)
+        # JPEGs are decoded straight at the smallest scale that still covers the size
+        image.draft("RGB", (size, size))
+        image.load()
+    except (OSError, ValueError, Image.DecompressionBombError) as exc:
+        raise InvalidImage(str(exc))
+
+    image = ImageOps.exif_transpose(image)
+    if image.mode in ("RGBA", "LA", "P"):
+        return image.convert("RGBA"), "PNG", "png"
+    return image.convert("RGB"), "JPEG", "jpg"
+
+
+def crop(image, size):
+    return ImageOps.fit(image, (size, size), Image.LANCZOS)
+
+
+def encode(image, image_format):
+    buffer = io.BytesIO()
+    image.save(buffer, image_format, quality=settings.AVATAR["QUALITY"], optimize=True)
+    return buffer.getvalue()
+
+
+def generate_variants(name):
+    """
+    Write a square crop of the image ``name`` for every AVATAR["SIZES"] and return their names.
+    """
+    sizes = sorted(settings.AVATAR["SIZES"], reverse=True)
+    storage = get_storage()
+    try:
+        file = storage.open(name)
+    except OSError as exc:
+        raise InvalidImage(str(exc))
+    with file:
+        image, image_format, extension = load(file, sizes[0])
+
+    stem = os.path.splitext(os.path.basename(name))[0]
+    variants = {}
+    for size in sizes:
+        # Each size is resized from the previous one, which is cheaper than from the original
+        image = crop(image, size)
+        variants[str(size)] = storage.save(
+            f"{settings.AVATAR['UPLOAD_TO']}{stem}_{size}.{extension}", ContentFile(encode(image, image_format))
+        )
+    return variants
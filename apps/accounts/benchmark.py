@@ -0,0 +1,296 @@
+"""
+Benchmark of the accounts endpoints over a dataset built by apps.accounts.seeding,
+run by `python manage.py benchmark`.
+
+Every scenario sends its requests one after the other through the Django test
+client, so latencies include middleware, serialization and rendering but not the
+network or the web server. Throughput is that of a single client. Requests are
+derived from the scale and the seed only, two runs against the same dataset send
+the same requests and their results can be compared with ``compare``.
+"""
+import json
+import platform
+import random
+import statistics
+import time
+
+import django
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from rest_framework.authtoken.models import Token
+
+from apps.accounts import seeding
+from apps.accounts.models import UserContact, ChatGroup, GroupMember
+from apps.accounts.otp import otp_store
+from apps.accounts.utils import normalize_phone
+
+
+User = get_user_model()
+
+#: Contacts sent by one add-contacts request
+CONTACTS_PER_UPLOAD = 50
+#: Usernames sent by one add_members / remove_members request
+USERS_PER_BULK_CHANGE = 5
+
+
+def percentile(values, fraction):
+    """
+    Nearest rank percentile of sorted ``values``.
+    """
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, round(fraction * len(values)) - 1))]
+
+
+class Benchmark:
+
+    def __init__(self, scale, seed=0, requests=100, stdout=None):
+        self.scale = scale
+        self.seed = seed
+        self.requests = requests
+        self.stdout = stdout
+        self.dataset = seeding.Seeder(scale, seed)
+        self.client = Client()
+        self.tokens = {}
+        #: Group id -> users added by the benchmark
+        self.joined = {}
+        self.scenarios = {
+            "login": self.login,
+            "verify-otp": self.verify_otp,
+            "add-contacts": self.add_contacts,
+            "users/sync": self.users_sync,
+            "users/me": self.users_me,
+            "users/retrieve": self.users_retrieve,
+            "groups/list": self.groups_list,
+            "groups/retrieve": self.groups_retrieve,
+            "groups/mine": self.groups_mine,
+            "groups/members": self.groups_members,
+            "groups/create": self.groups_create,
+            "groups/update": self.groups_update,
+            "groups/add_member": self.groups_add_member,
+            "groups/add_members": self.groups_add_members,
+            "groups/remove_members": self.groups_remove_members,
+            "groups/join": self.groups_join,
+            "groups/exit": self.groups_exit,
+        }
+
+    def log(self, message):
+        if self.stdout is not None:
+            self.stdout.write(message)
+
+    def run(self, scenarios=None):
+        results = {}
+        for name in scenarios or self.scenarios:
+            results[name] = self.measure(name, self.scenarios[name])
+            self.log(
+                f"{name}: p50 {results[name]['p50_ms']:.2f}ms p99 {results[name]['p99_ms']:.2f}ms "
+                f"{results[name]['queries_per_request']:.1f} queries {results[name]['errors']} errors"
+            )
+        return {
+            "scale": self.scale._asdict(),
+            "seed": self.seed,
+            "requests": self.requests,
+            "dataset": {
+                "users": User.objects.count(),
+                "contacts": UserContact.objects.count(),
+                "groups": ChatGroup.objects.count(),
+                "members": GroupMember.objects.count(),
+            },
+            "environment": {
+                "python": platform.python_version(),
+                "django": django.get_version(),
+                "database": connection.vendor,
+            },
+            "scenarios": results,
+        }
+
+    def measure(self, name, scenario):
+        """
+        Send the requests of a scenario. Preparing a request, e.g. issuing an OTP, is not timed.
+        """
+        durations = []
+        queries = []
+        errors = 0
+        for index in range(self.requests):
+            send = scenario(self.rng(name, index), index)
+            with CaptureQueriesContext(connection) as captured:
+                start = time.perf_counter()
+                response = send()
+                durations.append(time.perf_counter() - start)
+            queries.append(len(captured))
+            if response.status_code >= 400:
+                errors += 1
+        total = sum(durations)
+        durations.sort()
+        return {
+            "requests": len(durations),
+            "errors": errors,
+            "p50_ms": percentile(durations, 0.5) * 1000,
+            "p99_ms": percentile(durations, 0.99) * 1000,
+            "mean_ms": statistics.fmean(durations) * 1000,
+            "throughput_rps": len(durations) / total if total else None,
+            "queries_per_request": statistics.fmean(queries),
+            "max_queries": max(queries),
+        }
+
+    def rng(self, *key):
+        return random.Random(f"benchmark:{self.seed}:{':'.join(map(str, key))}")
+
+    def auth(self, user_id):
+        if user_id not in self.tokens:
+            self.tokens[user_id] = Token.objects.get_or_create(user_id=user_id)[0].key
+        return {"HTTP_AUTH": f"Token {self.tokens[user_id]}"}
+
+    def any_user(self, rng):
+        return rng.randint(1, self.scale.users)
+
+    def any_group(self, rng):
+        return rng.randint(1, self.scale.groups)
+
+    def non_members(self, rng, group_id, count):
+        """
+        Ids of users that are not members of the group, who are about to join it.
+        """
+        members = set(self.dataset.group_members(group_id)) | self.joined.setdefault(group_id, set())
+        users = set()
+        while len(users) < count:
+            user_id = self.any_user(rng)
+            if user_id not in members:
+                users.add(user_id)
+        self.joined[group_id] |= users
+        return sorted(users)
+
+    def get(self, path, user_id, data=None):
+        return lambda: self.client.get(path, data, **self.auth(user_id))
+
+    def send(self, method, path, data, user_id=None, **extra):
+        if user_id is not None:
+            extra.update(self.auth(user_id))
+        return lambda: getattr(self.client, method)(path, json.dumps(data), "application/json", **extra)
+
+    # Scenarios take a random generator and the request index and return a function sending the request
+
+    def login(self, rng, index):
+        user_id = self.any_user(rng)
+        return self.send(
+            "post", "/accounts/login/",
+            {"country_code": seeding.COUNTRY_CODE, "mobile_number": seeding.mobile_number(user_id)},
+            # Throttled by IP and number, every request comes from another address
+            REMOTE_ADDR=f"10.{index >> 16 & 255}.{index >> 8 & 255}.{index & 255}",
+        )
+
+    def verify_otp(self, rng, index):
+        user_id = self.any_user(rng)
+        otp = str(rng.randint(10000, 99999))
+        otp_store.issue(normalize_phone(seeding.COUNTRY_CODE, seeding.mobile_number(user_id)), otp)
+        return self.send(
+            "post", "/accounts/verify-otp/",
+            {"country_code": seeding.COUNTRY_CODE, "mobile_number": seeding.mobile_number(user_id), "otp": otp},
+            REMOTE_ADDR=f"10.{index >> 16 & 255}.{index >> 8 & 255}.{index & 255}",
+        )
+
+    def add_contacts(self, rng, index):
+        contacts = []
+        for _ in range(CONTACTS_PER_UPLOAD):
+            if rng.random() < seeding.UNREGISTERED_CONTACTS:
+                number = str(rng.randint(6000000000, 6999999999))
+            else:
+                number = seeding.mobile_number(self.any_user(rng))
+            contacts.append({"name": f"Contact {number}", "country_code": seeding.COUNTRY_CODE, "mobile_number": number})
+        return self.send("post", "/accounts/add-contacts/", {"contacts": contacts}, self.any_user(rng))
+
+    def users_sync(self, rng, index):
+        return self.get("/accounts/users/sync/", self.any_user(rng))
+
+    def users_me(self, rng, index):
+        return self.get("/accounts/users/me/", self.any_user(rng))
+
+    def users_retrieve(self, rng, index):
+        return self.get(f"/accounts/users/{seeding.mobile_number(self.any_user(rng))}/", self.any_user(rng))
+
+    def groups_list(self, rng, index):
+        return self.get("/accounts/groups/", self.any_user(rng))
+
+    def groups_retrieve(self, rng, index):
+        return self.get(f"/accounts/groups/{seeding.group_unique_id(self.any_group(rng))}/", self.any_user(rng))
+
+    def groups_mine(self, rng, index):
+        return self.get("/accounts/groups/mine/", self.any_user(rng))
+
+    def groups_members(self, rng, index):
+        return self.get(f"/accounts/groups/{seeding.group_unique_id(self.any_group(rng))}/members/", self.any_user(rng))
+
+    def groups_create(self, rng, index):
+        users = [seeding.username(self.any_user(rng)) for _ in range(USERS_PER_BULK_CHANGE)]
+        return self.send(
+            "post", "/accounts/groups/", {"name": f"Benchmark {index}", "users": users}, self.any_user(rng)
+        )
+
+    def groups_update(self, rng, index):
+        group_id = self.any_group(rng)
+        return self.send(
+            "patch", f"/accounts/groups/{seeding.group_unique_id(group_id)}/",
+            {"name": f"Renamed {index}"}, self.dataset.creator(group_id)
+        )
+
+    def groups_add_member(self, rng, index):
+        group_id = self.any_group(rng)
+        return self.send(
+            "post", f"/accounts/groups/{seeding.group_unique_id(group_id)}/add_member/",
+            {"username": seeding.username(self.non_members(rng, group_id, 1)[0])}, self.dataset.creator(group_id)
+        )
+
+    def groups_add_members(self, rng, index):
+        group_id = self.any_group(rng)
+        usernames = [seeding.username(user_id) for user_id in self.non_members(rng, group_id, USERS_PER_BULK_CHANGE)]
+        return self.send(
+            "post", f"/accounts/groups/{seeding.group_unique_id(group_id)}/add_members/",
+            {"usernames": usernames}, self.dataset.creator(group_id)
+        )
+
+    def groups_remove_members(self, rng, index):
+        group_id = self.any_group(rng)
+        members = self.dataset.group_members(group_id)
+        usernames = [seeding.username(user_id) for user_id in members[1:USERS_PER_BULK_CHANGE + 1]]
+        return self.send(
+            "post", f"/accounts/groups/{seeding.group_unique_id(group_id)}/remove_members/",
+            {"usernames": usernames or [seeding.username(members[0])]}, members[0]
+        )
+
+    def groups_join(self, rng, index):
+        group_id = self.any_group(rng)
+        return self.send(
+            "post", f"/accounts/groups/{seeding.group_unique_id(group_id)}/join/",
+            {}, self.non_members(rng, group_id, 1)[0]
+        )
+
+    def groups_exit(self, rng, index):
+        group_id = self.any_group(rng)
+        return self.send(
+            "post", f"/accounts/groups/{seeding.group_unique_id(group_id)}/exit/",
+            {}, rng.choice(self.dataset.group_members(group_id))
+        )
+
+
+def compare(results, baseline, tolerance=0.25):
+    """
+    Regressions of ``results`` against a previous run: a p50 or p99 more than
+    ``tolerance`` slower, or more queries per request. Latencies of runs on
+    different machines or databases are not comparable, query counts are.
+    """
+    regressions = []
+    for name, before in baseline["scenarios"].items():
+        after = results["scenarios"].get(name)
+        if after is None:
+            continue
+        for metric in ("p50_ms", "p99_ms"):
+            if after[metric] > before[metric] * (1 + tolerance):
+                regressions.append(f"{name}: {metric} {before[metric]:.2f} -> {after[metric]:.2f}")
+        for metric in ("queries_per_request", "max_queries"):
+            if after[metric] > before[metric]:
+                regressions.append(f"{name}: {metric} {before[metric]:g} -> {after[metric]:g}")
+        if after["errors"] > before["errors"]:
+            regressions.append(f"{name}: errors {before['errors']} -> {after['errors']}")
+    return regressions
@@ -0,0 +1,108 @@
+import hashlib
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+
+from apps.accounts import routers
+
+
+def get_cache():
+    return caches[settings.ACCOUNTS_CACHE["CACHE"]]
+
+
+def user_key(user_id):
+    return f"version:user:{user_id}"
+
+
+def group_key(group_id):
+    return f"version:group:{group_id}"
+
+
+def memberships_key(user_id):
+    """
+    Versions the set of groups of the user, the groups themselves have group_key().
+    """
+    return f"version:memberships:{user_id}"
+
+
+#: Bumped with any group, versions the full group list
+GROUPS_KEY = "version:groups"
+
+
+def new_version():
+    # Microseconds since the epoch, a version evicted from the cache comes back as a newer one.
+    return time.time_ns() // 1000
+
+
+def get_versions(keys):
+    cache = get_cache()
+    versions = cache.get_many(keys)
+    for key in set(keys) - set(versions):
+        cache.add(key, new_version(), None)
+        versions[key] = cache.get(key)
+    return versions
+
+
+def bump(keys):
+    if keys:
+        version = new_version()
+        get_cache().set_many({key: version for key in keys}, None)
+
+
+def bump_users(user_ids):
+    bump([user_key(user_id) for user_id in user_ids])
+
+
+def bump_groups(group_ids):
+    """
+    Payloads listing the groups of a user depend on their group_key(), a group
+    change costs the same however many members the group has.
+    """
+    if not group_ids:
+        return
+    bump([GROUPS_KEY] + [group_key(group_id) for group_id in group_ids])
+
+
+def bump_memberships(user_ids):
+    bump([memberships_key(user_id) for user_id in user_ids])
+
+
+def data_key(name, version_keys, versions):
+    digest = hashlib.md5(name.encode()).hexdigest()
+    # A user's groups can take hundreds of versions
+    versions_digest = hashlib.md5(":".join(str(versions[key]) for key in version_keys).encode()).hexdigest()
+    return f"data:{digest}:{versions_digest}"
+
+
+def cached_data(name, version_keys, build):
+    """
+    Return ``build()`` cached under ``name`` and the current value of ``version_keys``.
+    Versions are read before building, so a change made meanwhile can't be cached
+    under the new version. ``build`` reads from the primary, a lagging replica
+    would cache stale data under the new version.
+    """
+    cache = get_cache()
+    key = data_key(name, version_keys, get_versions(version_keys))
+    data = cache.get(key)
+    if data is None:
+        with routers.primary():
+            data = build()
+        cache.set(key, data, settings.ACCOUNTS_CACHE["TIMEOUT"])
+    return data
+
+
+async def acached_data(name, version_keys, build, versions=None):
+    """
+    cached_data() with an async ``build``. Pass ``versions`` when they were already read.
+    """
+    cache = get_cache()
+    versions = versions or await sync_to_async(get_versions)(version_keys)
+    key = data_key(name, version_keys, versions)
+    data = await cache.aget(key)
+    if data is None:
+        with routers.primary():
+            data = await build()
+        await cache.aset(key, data, settings.ACCOUNTS_CACHE["TIMEOUT"])
+    return data
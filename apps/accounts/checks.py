@@ -0,0 +1,65 @@
+"""
+Checks of the settings the accounts app relies on in production, run by
+`python manage.py check --deploy`.
+"""
+from django.conf import settings
+from django.core.checks import Error, Tags, Warning, register
+
+
+#: Backends whose incr() is atomic across processes
+ATOMIC_CACHE_BACKENDS = (
+    "django.core.cache.backends.redis.RedisCache",
+    "django.core.cache.backends.memcached.PyMemcacheCache",
+    "django.core.cache.backends.memcached.PyLibMCCache",
+)
+
+
+@register(Tags.caches, deploy=True)
+def check_counter_caches(app_configs, **kwargs):
+    """
+    OTP attempts and rate limits are counted with incr(). The other backends
+    emulate it with a get() and a set(), concurrent requests lose increments
+    and get more guesses than allowed.
+    """
+    errors = []
+    for setting, alias, check_id in (
+        ("OTP_STORE", settings.OTP_STORE["CACHE"], "accounts.E001"),
+        ("THROTTLE_CACHE", settings.THROTTLE_CACHE, "accounts.E002"),
+    ):
+        backend = settings.CACHES[alias]["BACKEND"]
+        if backend not in ATOMIC_CACHE_BACKENDS:
+            errors.append(Error(
+                f"{setting} counts in the '{alias}' cache, {backend} has no atomic incr().",
+                hint="Set REDIS_URL, or point the cache at Redis or Memcached.",
+                id=check_id,
+            ))
+    return errors
+
+
+@register(deploy=True)
+def check_events_broker(app_configs, **kwargs):
+    """
+    LocalBroker drops the events published by other processes, e.g. contact_joined
+    of the run_jobs worker.
+    """
+    if settings.EVENTS["BACKEND"] == "apps.accounts.events.LocalBroker":
+        return [Error(
+            "EVENTS uses LocalBroker, events published by other processes are never delivered.",
+            hint="Set REDIS_URL, or set EVENTS['BACKEND'] to None to disable events.",
+            id="accounts.E003",
+        )]
+    return []
+
+
+@register(deploy=True)
+def check_metrics_token(app_configs, **kwargs):
+    """
+    /metrics answers 404 outside of DEBUG until a token is set.
+    """
+    if not settings.METRICS["TOKEN"]:
+        return [Warning(
+            "METRICS['TOKEN'] is not set, /metrics is disabled.",
+            hint="Set METRICS_TOKEN and have the scraper send it as a bearer token.",
+            id="accounts.W001",
+        )]
+    return []
@@ -0,0 +1,34 @@
+import hashlib
+
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import quote_etag, urlencode
+
+
+class Validators:
+    """
+    ETag of a response, computed before the response itself from the versions
+    of what it shows, the query parameters, e.g. the page or the cursor, and the
+    negotiated media type: JSON and msgpack bodies are different representations.
+
+    There is no Last-Modified: versions change several times a second, a date
+    with a one second resolution would answer If-Modified-Since with a 304
+    after a change made in the same second.
+    """
+
+    def __init__(self, prefix, versions, request):
+        # A user's groups can take hundreds of versions
+        key = "-".join(map(str, versions)) + "?" + urlencode(sorted(request.GET.lists()), doseq=True)
+        key += " " + request.accepted_media_type
+        self.etag = quote_etag(prefix + "-" + hashlib.md5(key.encode()).hexdigest())
+
+    def not_modified(self, request):
+        """
+        Return the 304 (or 412) response when the request's preconditions say so, else None.
+        """
+        response = get_conditional_response(request, etag=self.etag)
+        return response and self.apply(response)
+
+    def apply(self, response):
+        response["ETag"] = self.etag
+        patch_cache_control(response, private=True, no_cache=True)
+        return response
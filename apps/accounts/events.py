@@ -0,0 +1,248 @@
+"""
+Per-user events pushed to clients over server-sent events, so they only call
+users/sync or groups/mine when something changed.
+
+Events are hints, e.g. ``{"type": "contact_joined", "change_seq": 12}``, the
+client still reads the data from the usual endpoints. Events are not kept for
+disconnected clients, a client syncs once on the ``ready`` event of every
+connection. A client whose queue overflows gets a ``resync`` event and should
+refresh everything.
+
+Events need RedisBroker: they are published by every web worker and by the
+run_jobs worker, e.g. contact_joined. Without REDIS_URL, EVENTS["BACKEND"] is
+None, nothing is published and the stream answers 503, clients poll instead.
+LocalBroker delivers to subscribers in the same process only, it is meant for
+tests and `check --deploy` rejects it.
+"""
+import asyncio
+import functools
+import json
+import logging
+import threading
+import time
+from collections import defaultdict
+from types import SimpleNamespace
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.utils.module_loading import import_string
+from rest_framework import exceptions
+
+from apps.accounts.authentication import CustomTokenAuthentication
+
+
+logger = logging.getLogger(__name__)
+
+CONTACT_JOINED = "contact_joined"
+GROUP_JOINED = "group_joined"
+GROUP_LEFT = "group_left"
+RESYNC = "resync"
+
+
+class Subscription:
+    """
+    Events of one user for one connection, read on the event loop that subscribed.
+    """
+
+    def __init__(self, user_id, queue_size):
+        self.user_id = user_id
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize=queue_size)
+
+    def put(self, event):
+        """
+        Thread safe, called by the publishing thread.
+        """
+        try:
+            self.loop.call_soon_threadsafe(self._put, event)
+        except RuntimeError:
+            # The loop is closed, the connection is gone
+            pass
+
+    def _put(self, event):
+        if self.queue.full():
+            # The client is behind, drop what is queued and let it resync
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            event = {"type": RESYNC}
+        self.queue.put_nowait(event)
+
+    async def get(self):
+        return await self.queue.get()
+
+
+class LocalBroker:
+
+    def __init__(self, queue_size):
+        self.queue_size = queue_size
+        self.lock = threading.Lock()
+        self.subscriptions = defaultdict(set)
+
+    def publish(self, user_ids, event):
+        self.deliver(user_ids, event)
+
+    def deliver(self, user_ids, event):
+        with self.lock:
+            subscriptions = [
+                subscription for user_id in user_ids for subscription in self.subscriptions.get(user_id, ())
+            ]
+        for subscription in subscriptions:
+            subscription.put(event)
+
+    async def subscribe(self, user_id):
+        subscription = Subscription(user_id, self.queue_size)
+        with self.lock:
+            self.subscriptions[user_id].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            subscriptions = self.subscriptions.get(subscription.user_id)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self.subscriptions[subscription.user_id]
+
+
+class RedisBroker(LocalBroker):
+    """
+    Publishes through Redis pub/sub. Each process listens once, on the event loop
+    of its first subscriber, and hands events to its local subscribers.
+    """
+    channel = "accounts-events"
+
+    def __init__(self, queue_size, url):
+        import redis
+
+        super().__init__(queue_size)
+        self.url = url
+        self.redis = redis.Redis.from_url(self.url)
+        self.listener = None
+
+    def publish(self, user_ids, event):
+        self.redis.publish(self.channel, json.dumps({"user_ids": list(user_ids), "event": event}))
+
+    async def subscribe(self, user_id):
+        if self.listener is None or self.listener.done():
+            self.listener = asyncio.create_task(self.listen())
+        return await super().subscribe(user_id)
+
+    async def listen(self):
+        import redis.asyncio
+
+        while True:
+            try:
+                async with redis.asyncio.Redis.from_url(self.url).pubsub() as pubsub:
+                    await pubsub.subscribe(self.channel)
+                    async for message in pubsub.listen():
+                        if message["type"] == "message":
+                            data = json.loads(message["data"])
+                            self.deliver(data["user_ids"], data["event"])
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Events listener failed, reconnecting")
+                # Events published meanwhile are lost
+                self.deliver(list(self.subscriptions), {"type": RESYNC})
+                await asyncio.sleep(1)
+
+
+@functools.lru_cache(maxsize=None)
+def _load_broker(path):
+    return import_string(path)(settings.EVENTS["QUEUE_SIZE"], **settings.EVENTS.get("OPTIONS", {}))
+
+
+def get_broker():
+    """
+    The configured broker, None when events are disabled.
+    """
+    if not settings.EVENTS["BACKEND"]:
+        return None
+    return _load_broker(settings.EVENTS["BACKEND"])
+
+
+def publish(user_ids, event):
+    """
+    Send ``event`` to ``user_ids`` once the current transaction commits.
+    """
+    user_ids = list(user_ids)
+    if user_ids and get_broker() is not None:
+        transaction.on_commit(lambda: get_broker().publish(user_ids, event))
+
+
+def encode(event):
+    return f"event: {event['type']}\ndata: {json.dumps(event, separators=(',', ':'))}\n\n".encode()
+
+
+async def event_stream(scope, receive, send):
+    """
+    ASGI app of GET /accounts/events/, a text/event-stream of the user's events.
+
+    Django 4.1 can't stream from an async view, so seazon.asgi routes the path here.
+    Authenticated with the auth token header like the API.
+    """
+    if scope["method"] != "GET":
+        return await send_error(send, 405, "Method \"%s\" not allowed." % scope["method"])
+    broker = get_broker()
+    if broker is None:
+        return await send_error(send, 503, "Events are disabled, poll users/sync and groups/mine.")
+
+    meta = {"HTTP_" + name.decode("latin-1").upper().replace("-", "_"): value for name, value in scope["headers"]}
+    try:
+        user_auth = await CustomTokenAuthentication().aauthenticate(SimpleNamespace(META=meta))
+    except exceptions.AuthenticationFailed as exc:
+        return await send_error(send, 403, str(exc.detail))
+    finally:
+        await sync_to_async(close_old_connections)()
+    if user_auth is None:
+        return await send_error(send, 403, str(exceptions.NotAuthenticated.default_detail))
+
+    subscription = await broker.subscribe(user_auth[0].id)
+    disconnected = asyncio.create_task(wait_for_disconnect(receive))
+    try:
+        await send({
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [
+                (b"content-type", b"text/event-stream"),
+                (b"cache-control", b"no-cache"),
+                # Tell nginx not to buffer the stream
+                (b"x-accel-buffering", b"no"),
+            ],
+        })
+        await send({
+            "type": "http.response.body",
+            "body": f"retry: {settings.EVENTS['RETRY'] * 1000}\n\n".encode() + encode({"type": "ready"}),
+            "more_body": True,
+        })
+        while True:
+            getter = asyncio.ensure_future(subscription.get())
+            done, _ = await asyncio.wait(
+                {getter, disconnected}, timeout=settings.EVENTS["KEEPALIVE"], return_when=asyncio.FIRST_COMPLETED
+            )
+            if getter not in done:
+                getter.cancel()
+            if disconnected in done:
+                break
+            # A comment line keeps proxies from closing an idle connection
+            body = encode(getter.result()) if getter in done else f": {int(time.time())}\n\n".encode()
+            await send({"type": "http.response.body", "body": body, "more_body": True})
+    finally:
+        broker.unsubscribe(subscription)
+        disconnected.cancel()
+
+
+async def wait_for_disconnect(receive):
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+
+async def send_error(send, status, detail):
+    body = json.dumps({"detail": detail}).encode()
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+    })
+    await send({"type": "http.response.body", "body": body})
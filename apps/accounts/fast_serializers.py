@@ -0,0 +1,129 @@
+"""
+Read-only serializers for list-heavy endpoints.
+
+They read rows with ``queryset.values()`` instead of building model instances
+and map them to dicts through a field map compiled once per class. Output is
+the same as the ModelSerializer named in each class docstring, see
+apps.accounts.tests.FastSerializerEquivalenceTests.
+"""
+from operator import attrgetter
+
+from django.contrib.auth import get_user_model
+from rest_framework import serializers
+
+from apps.accounts import avatars
+from apps.accounts.metrics import timed
+
+User = get_user_model()
+
+
+class ValuesSerializer:
+    #: Output field names, or (output name, lookup path) pairs
+    fields = ()
+
+    def __init__(self, context=None):
+        self.context = context or {}
+        self.names = tuple(field if isinstance(field, str) else field[0] for field in self.fields)
+        self.paths = tuple(field if isinstance(field, str) else field[1] for field in self.fields)
+        converters = self.get_converters()
+        self.field_map = tuple(
+            (name, path, converters.get(name)) for name, path in zip(self.names, self.paths)
+        )
+        self.plain = all(converter is None for _, _, converter in self.field_map)
+
+    def get_converters(self):
+        """
+        Output name -> callable applied to the raw column value.
+        """
+        return {}
+
+    def values(self, queryset):
+        return queryset.values(*self.paths)
+
+    def to_representation(self, row):
+        if self.plain:
+            return {name: row[path] for name, path, _ in self.field_map}
+        return {
+            name: row[path] if converter is None else converter(row[path])
+            for name, path, converter in self.field_map
+        }
+
+    @timed
+    def serialize(self, rows):
+        """
+        Serialize dicts as returned by self.values().
+        """
+        return list(map(self.to_representation, rows))
+
+    def serialize_queryset(self, queryset):
+        return self.serialize(self.values(queryset))
+
+    def serialize_objects(self, instances):
+        """
+        Serialize model instances that are already in memory, e.g. just bulk created.
+        """
+        getters = tuple(attrgetter(path.replace("__", ".")) for path in self.paths)
+        return self.serialize(
+            {path: getter(instance) for path, getter in zip(self.paths, getters)} for instance in instances
+        )
+
+
+def image_url(field, request=None):
+    storage = field.storage
+
+    def convert(name):
+        if not name:
+            return None
+        url = storage.url(name)
+        return request.build_absolute_uri(url) if request is not None else url
+    return convert
+
+
+class UserFastSerializer(ValuesSerializer):
+    """
+    UserSerializer
+    """
+    fields = ("username", "name", "country_code", "mobile_number", "id", "status", "bio", "image", "image_variants")
+
+    def get_converters(self):
+        request = self.context.get("request")
+        return {
+            "image": image_url(User._meta.get_field("image"), request),
+            "image_variants": lambda variants: avatars.variant_urls(variants, request),
+        }
+
+
+class SyncContactFastSerializer(ValuesSerializer):
+    """
+    UserSerializer applied to UserContact rows, as users/sync does.
+    Fields UserContact doesn't have are left out.
+    """
+    fields = ("username", "name", "country_code", "mobile_number", "id")
+
+
+class UserContactFastSerializer(ValuesSerializer):
+    """
+    UserContactSerializer
+    """
+    fields = ("name", "country_code", "mobile_number", "username")
+
+
+class ChatGroupFastSerializer(ValuesSerializer):
+    """
+    ChatGroupSerializer
+    """
+    fields = (
+        "id",
+        ("created_by", "created_by_id"),
+        ("creator_mobile_number", "created_by__mobile_number"),
+        "name",
+        "unique_id",
+        "created_at",
+        "premium",
+        "amount",
+        "member_count",
+    )
+
+    def get_converters(self):
+        created_at = serializers.DateTimeField()
+        return {"created_at": lambda value: None if value is None else created_at.to_representation(value)}
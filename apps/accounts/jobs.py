@@ -0,0 +1,128 @@
+import datetime
+import logging
+import traceback
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from apps.accounts.models import Job
+
+
+logger = logging.getLogger(__name__)
+
+registry = {}
+
+
+def register(name):
+    """
+    Register the decorated function as the handler of ``name`` jobs.
+    Handlers are called with the job payload as keyword arguments
+    and must be safe to run more than once.
+    """
+    def decorator(func):
+        registry[name] = func
+        return func
+    return decorator
+
+
+def enqueue(name, payload=None, delay=None, max_attempts=None):
+    if name not in registry:
+        raise KeyError(f"Unknown job {name}")
+    job = Job.objects.create(
+        name=name,
+        payload=payload or {},
+        run_after=timezone.now() + (delay or datetime.timedelta()),
+        max_attempts=max_attempts or settings.JOBS_MAX_ATTEMPTS,
+    )
+    if settings.JOBS_EAGER:
+        transaction.on_commit(lambda: run_claimed(ids=[job.id]))
+    return job
+
+
+async def aenqueue(name, payload=None, delay=None, max_attempts=None):
+    """
+    enqueue() for async views. There is no surrounding transaction, an eager job runs right away.
+    """
+    if name not in registry:
+        raise KeyError(f"Unknown job {name}")
+    job = await Job.objects.acreate(
+        name=name,
+        payload=payload or {},
+        run_after=timezone.now() + (delay or datetime.timedelta()),
+        max_attempts=max_attempts or settings.JOBS_MAX_ATTEMPTS,
+    )
+    if settings.JOBS_EAGER:
+        await sync_to_async(run_claimed)(ids=[job.id])
+    return job
+
+
+def claim(batch_size=1, ids=None):
+    """
+    Mark up to ``batch_size`` due jobs as running and return them.
+    Running jobs whose worker died are picked up again after JOBS_TIMEOUT.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        queryset = Job.objects.select_for_update(skip_locked=True)
+        if ids is not None:
+            queryset = queryset.filter(id__in=ids)
+        else:
+            queryset = queryset.filter(
+                Q(status=Job.PENDING, run_after__lte=now) |
+                Q(status=Job.RUNNING, updated_at__lt=now - settings.JOBS_TIMEOUT)
+            ).order_by("run_after", "id")[:batch_size]
+        jobs = list(queryset)
+        for job in jobs:
+            job.status = Job.RUNNING
+            job.attempts += 1
+            job.updated_at = now
+        Job.objects.bulk_update(jobs, ["status", "attempts", "updated_at"])
+    return jobs
+
+
+def run_job(job):
+    try:
+        registry[job.name](**job.payload)
+    except Exception:
+        job.last_error = traceback.format_exc()
+        if job.attempts >= job.max_attempts:
+            job.status = Job.FAILED
+            logger.exception("Job %s %s failed permanently", job.id, job.name)
+        else:
+            job.status = Job.PENDING
+            # Exponential backoff, JOBS_RETRY_DELAY, 2x, 4x ...
+            job.run_after = timezone.now() + settings.JOBS_RETRY_DELAY * 2 ** (job.attempts - 1)
+            logger.warning("Job %s %s failed, retry %s", job.id, job.name, job.attempts)
+    else:
+        job.status = Job.DONE
+        job.last_error = ""
+    job.save(update_fields=["status", "run_after", "last_error", "updated_at"])
+    return job
+
+
+def run_claimed(batch_size=1, ids=None):
+    """
+    Claim and run one batch of due jobs, return how many were run.
+    """
+    jobs = claim(batch_size, ids)
+    for job in jobs:
+        run_job(job)
+    return len(jobs)
+
+
+def purge(older_than=None, batch_size=1000):
+    """
+    Delete the jobs done more than ``older_than`` ago, JOBS_KEEP_DONE by default,
+    ``batch_size`` at a time. Return how many were deleted.
+    """
+    cutoff = timezone.now() - (settings.JOBS_KEEP_DONE if older_than is None else older_than)
+    queryset = Job.objects.filter(status=Job.DONE, updated_at__lt=cutoff)
+    count = 0
+    while True:
+        ids = list(queryset.values_list("id", flat=True)[:batch_size])
+        if not ids:
+            return count
+        count += Job.objects.filter(id__in=ids).delete()[0]
@@ -0,0 +1,70 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test.runner import DiscoverRunner
+from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+
+from apps.accounts import seeding
+from apps.accounts.benchmark import Benchmark, compare
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark the accounts endpoints on a fresh test database seeded at the given scale. "
+        "Results are written as JSON and can be checked against a baseline of a previous run."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--scale", choices=seeding.SCALES, default="tiny")
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--requests", type=int, default=100, help="Requests sent by every scenario")
+        parser.add_argument("--scenario", action="append", dest="scenarios", help="Only run this scenario, repeatable")
+        parser.add_argument("--output", help="Write the results to this file")
+        parser.add_argument("--baseline", help="Fail when the results regressed from this results file")
+        parser.add_argument(
+            "--tolerance", type=float, default=0.25, help="Slowdown of p50 and p99 allowed against the baseline"
+        )
+
+    def handle(self, *args, **options):
+        scale = seeding.SCALES[options["scale"]]
+        benchmark = Benchmark(scale, options["seed"], options["requests"], self.stdout)
+        unknown = set(options["scenarios"] or []) - set(benchmark.scenarios)
+        if unknown:
+            raise CommandError(f"Unknown scenarios {', '.join(sorted(unknown))}")
+
+        setup_test_environment()
+        runner = DiscoverRunner(verbosity=0, interactive=False)
+        old_config = runner.setup_databases()
+        try:
+            with override_settings(**self.settings()):
+                seeding.seed(scale, options["seed"], stdout=self.stdout)
+                results = benchmark.run(options["scenarios"])
+        finally:
+            runner.teardown_databases(old_config)
+            teardown_test_environment()
+
+        if options["output"]:
+            with open(options["output"], "w") as file:
+                json.dump(results, file, indent=2, sort_keys=True)
+        else:
+            self.stdout.write(json.dumps(results, indent=2, sort_keys=True))
+
+        if options["baseline"]:
+            with open(options["baseline"]) as file:
+                regressions = compare(results, json.load(file), options["tolerance"])
+            if regressions:
+                raise CommandError("Regressed from the baseline:\n" + "\n".join(regressions))
+            self.stdout.write("No regression from the baseline")
+
+    def settings(self):
+        """
+        Keep the run in the process: no SMS, jobs left queued, in memory caches.
+        """
+        return dict(
+            SMS_BACKEND="apps.accounts.sms.LocMemBackend",
+            JOBS_EAGER=False,
+            CACHES={
+                "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache", "LOCATION": "benchmark"},
+                "shared": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache", "LOCATION": "benchmark-shared"},
+            },
+        )
@@ -0,0 +1,91 @@
+import datetime
+import os
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from apps.accounts.models import MediaFile
+
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = "Delete profile images and variants that no user references anymore"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--min-age", type=int, default=24 * 60 * 60,
+            help="Seconds since a file was last referenced or written before it can be deleted"
+        )
+        parser.add_argument("--recount", action="store_true", help="Rebuild the reference counts from the users first")
+        parser.add_argument(
+            "--full", action="store_true",
+            help="Also delete files of the image directory that have no reference count at all, implies --recount"
+        )
+        parser.add_argument("--dry-run", action="store_true")
+
+    def handle(self, *args, **options):
+        self.storage = User._meta.get_field("image").storage
+        self.dry_run = options["dry_run"]
+        cutoff = timezone.now() - datetime.timedelta(seconds=options["min_age"])
+
+        if options["recount"] or options["full"]:
+            self.stdout.write(f"Counted {self.recount()} referenced files")
+
+        deleted = 0
+        for media_id in MediaFile.objects.filter(references__lte=0, updated_at__lt=cutoff).values_list("id", flat=True):
+            with transaction.atomic():
+                media = MediaFile.objects.select_for_update().filter(id=media_id, references__lte=0).first()
+                # Referenced again meanwhile
+                if media is None or not self.delete_file(media.name, cutoff):
+                    continue
+                if not self.dry_run:
+                    media.delete()
+                deleted += 1
+
+        if options["full"]:
+            referenced = set(MediaFile.objects.values_list("name", flat=True))
+            upload_to = User._meta.get_field("image").upload_to
+            for name in self.walk(upload_to):
+                if name not in referenced and self.delete_file(name, cutoff):
+                    deleted += 1
+
+        self.stdout.write(f"{'Would delete' if self.dry_run else 'Deleted'} {deleted} files")
+
+    def recount(self):
+        counts = {}
+        for image, variants in User.objects.values_list("image", "image_variants").iterator(chunk_size=2000):
+            for name in MediaFile.names_of(image, variants):
+                counts[name] = counts.get(name, 0) + 1
+        if self.dry_run:
+            return len(counts)
+        with transaction.atomic():
+            MediaFile.objects.exclude(name__in=counts.keys()).filter(references__gt=0).update(
+                references=0, updated_at=timezone.now()
+            )
+            MediaFile.objects.bulk_create(
+                [MediaFile(name=name, references=count) for name, count in counts.items()],
+                batch_size=1000, update_conflicts=True, unique_fields=["name"], update_fields=["references"]
+            )
+        return len(counts)
+
+    def delete_file(self, name, cutoff):
+        """
+        Delete ``name`` unless it was written after ``cutoff``, a missing file counts as deleted.
+        """
+        if self.storage.exists(name):
+            if self.storage.get_modified_time(name) >= cutoff:
+                return False
+            if not self.dry_run:
+                self.storage.delete(name)
+        return True
+
+    def walk(self, path):
+        directories, files = self.storage.listdir(path)
+        for file in files:
+            yield os.path.join(path, file).replace("\\", "/")
+        for directory in directories:
+            yield from self.walk(os.path.join(path, directory))
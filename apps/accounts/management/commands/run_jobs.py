@@ -0,0 +1,39 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from apps.accounts.jobs import purge, run_claimed
+
+
+class Command(BaseCommand):
+    help = "Run background jobs"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=10)
+        parser.add_argument("--sleep", type=float, default=1.0, help="Seconds to wait when the queue is empty")
+        parser.add_argument("--once", action="store_true", help="Exit once the queue is empty")
+        parser.add_argument(
+            "--purge-interval", type=float, default=3600,
+            help="Seconds between deletions of the jobs done more than JOBS_KEEP_DONE ago, 0 to never delete them"
+        )
+
+    def handle(self, *args, **options):
+        last_purge = None
+        try:
+            while True:
+                count = run_claimed(options["batch_size"])
+                if count:
+                    continue
+                # Purged while idle, and before exiting with --once
+                if options["purge_interval"] and (
+                    last_purge is None or time.monotonic() - last_purge >= options["purge_interval"]
+                ):
+                    last_purge = time.monotonic()
+                    purged = purge()
+                    if purged:
+                        self.stdout.write(f"Deleted {purged} done jobs")
+                if options["once"]:
+                    return
+                time.sleep(options["sleep"])
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,30 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from apps.accounts import seeding
+from apps.accounts.models import UserContact, ChatGroup, GroupMember
+
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = "Fill the database with synthetic users, contacts, groups and members, see apps.accounts.seeding"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--scale", choices=seeding.SCALES, default="tiny")
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--batch-size", type=int, default=10000, help="Rows written per transaction")
+        parser.add_argument(
+            "--resume", action="store_true",
+            help="Complete the rows of an interrupted run, pass the same scale and seed"
+        )
+
+    def handle(self, *args, **options):
+        if not options["resume"] and any(
+            model.objects.exists() for model in (User, UserContact, ChatGroup, GroupMember)
+        ):
+            raise CommandError("The database is not empty, seed an empty database or pass --resume")
+        seeding.seed(
+            seeding.SCALES[options["scale"]], options["seed"], options["batch_size"], options["resume"], self.stdout
+        )
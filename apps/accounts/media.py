@@ -0,0 +1,175 @@
+"""
+Serves MEDIA_ROOT. Media files are never overwritten, see apps.accounts.storage,
+so responses are cacheable forever.
+
+``?size=<n>`` serves a square crop of an image for one of AVATAR["SIZES"],
+generated on first request and kept under MEDIA_SERVING["CACHE_ROOT"].
+
+With MEDIA_SERVING["SENDFILE"] set, the file is handed to the web server
+(X-Sendfile or nginx's X-Accel-Redirect) instead of being read by the worker.
+"""
+import mimetypes
+import os
+import re
+import tempfile
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import FileResponse, Http404, HttpResponse, StreamingHttpResponse
+from django.utils._os import safe_join
+from django.utils.http import http_date, quote_etag
+from django.views.decorators.http import require_http_methods
+from django.utils.cache import get_conditional_response, patch_cache_control
+
+from apps.accounts import avatars
+
+
+RANGE = re.compile(r"^bytes=(\d*)-(\d*)$")
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+CHUNK_SIZE = 64 * 1024
+
+
+def resolve(path, size):
+    """
+    Absolute path of the file to serve, generating the variant when it isn't cached yet.
+    """
+    try:
+        source = safe_join(settings.MEDIA_ROOT, path)
+    except SuspiciousFileOperation:
+        raise Http404
+    if not os.path.isfile(source):
+        raise Http404
+    if size is None:
+        return source
+
+    if not size.isdigit() or int(size) not in settings.AVATAR["SIZES"]:
+        raise Http404
+    if not source.lower().endswith(IMAGE_EXTENSIONS):
+        raise Http404
+    cached = safe_join(settings.MEDIA_SERVING["CACHE_ROOT"], size, path)
+    if not os.path.isfile(cached) or os.path.getmtime(cached) < os.path.getmtime(source):
+        generate(source, cached, int(size))
+    return cached
+
+
+def generate(source, target, size):
+    try:
+        with open(source, "rb") as file:
+            image, image_format, _ = avatars.load(file, size)
+    except avatars.InvalidImage:
+        raise Http404
+    data = avatars.encode(avatars.crop(image, size), image_format)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    # Written aside and renamed, so concurrent requests never read half a file
+    fd, temp = tempfile.mkstemp(dir=os.path.dirname(target))
+    with os.fdopen(fd, "wb") as file:
+        file.write(data)
+    os.replace(temp, target)
+
+
+def content_type(path):
+    return mimetypes.guess_type(path)[0] or "application/octet-stream"
+
+
+def sendfile_response(path):
+    """
+    Empty response telling the web server to send ``path``, None when offloading is off.
+    """
+    backend = settings.MEDIA_SERVING["SENDFILE"]
+    if backend is None:
+        return None
+    response = HttpResponse(content_type=content_type(path))
+    if backend == "x-sendfile":
+        response["X-Sendfile"] = path
+    elif backend == "x-accel-redirect":
+        for root, location in settings.MEDIA_SERVING["ACCEL_REDIRECT_LOCATIONS"].items():
+            root = os.path.join(os.path.abspath(root), "")
+            if path.startswith(root):
+                response["X-Accel-Redirect"] = location + path[len(root):]
+                break
+        else:
+            return None
+    else:
+        raise ValueError(f"Unknown MEDIA_SERVING SENDFILE {backend}")
+    return response
+
+
+def parse_range(header, length):
+    """
+    (start, end) of a single ``bytes=`` range, end included. None for a missing or
+    multi range header, which get the whole file. ValueError when it can't be satisfied.
+    """
+    match = RANGE.match(header or "")
+    if not match:
+        return None
+    start, end = match.groups()
+    if not start:
+        if not end:
+            return None
+        # Suffix range, the last <end> bytes
+        start, end = max(length - int(end), 0), length - 1
+    else:
+        start, end = int(start), min(int(end), length - 1) if end else length - 1
+    if start >= length or start > end:
+        raise ValueError
+    return start, end
+
+
+def iter_range(path, start, length):
+    with open(path, "rb") as file:
+        file.seek(start)
+        while length > 0:
+            chunk = file.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                return
+            length -= len(chunk)
+            yield chunk
+
+
+@require_http_methods(["GET", "HEAD"])
+def serve(request, path):
+    full_path = resolve(path, request.GET.get("size"))
+    stat = os.stat(full_path)
+    etag = quote_etag(f"{stat.st_mtime_ns:x}-{stat.st_size:x}")
+
+    def finalize(response):
+        response["ETag"] = etag
+        response["Last-Modified"] = http_date(stat.st_mtime)
+        response["Accept-Ranges"] = "bytes"
+        patch_cache_control(response, public=True, max_age=settings.MEDIA_SERVING["MAX_AGE"], immutable=True)
+        return response
+
+    response = get_conditional_response(request, etag=etag, last_modified=int(stat.st_mtime))
+    if response is not None:
+        return finalize(response)
+
+    response = sendfile_response(full_path)
+    if response is not None:
+        # The web server answers range requests itself
+        return finalize(response)
+
+    byte_range = None
+    # A range of another version of the file can't be used, send it whole
+    if request.headers.get("If-Range", etag) == etag:
+        try:
+            byte_range = parse_range(request.headers.get("Range"), stat.st_size)
+        except ValueError:
+            response = HttpResponse(status=416)
+            response["Content-Range"] = f"bytes */{stat.st_size}"
+            return response
+
+    if byte_range is None:
+        if request.method == "HEAD":
+            response = HttpResponse(content_type=content_type(full_path))
+            response["Content-Length"] = stat.st_size
+        else:
+            response = FileResponse(open(full_path, "rb"), content_type=content_type(full_path))
+    else:
+        start, end = byte_range
+        response = StreamingHttpResponse(
+            iter_range(full_path, start, end - start + 1) if request.method == "GET" else (),
+            status=206, content_type=content_type(full_path)
+        )
+        response["Content-Length"] = end - start + 1
+        response["Content-Range"] = f"bytes {start}-{end}/{stat.st_size}"
+    return finalize(response)
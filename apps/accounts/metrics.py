@@ -0,0 +1,247 @@
+"""
+Per route request metrics, recorded by apps.accounts.middleware.MetricsMiddleware
+and served in the Prometheus text format by ``metrics_view``.
+
+Each process aggregates its requests in memory and writes a snapshot to
+METRICS["DIR"] at most every METRICS["FLUSH_INTERVAL"] seconds, named after its
+PID. The endpoint adds up the snapshots of the running workers and deletes those
+of exited ones, the directory must be local to the host. Counters drop when a
+worker exits, Prometheus counts it as a reset.
+
+Outside of DEBUG the endpoint requires METRICS["TOKEN"], scrapers send it as
+"Authorization: Bearer <token>".
+"""
+import atexit
+import bisect
+import contextvars
+import functools
+import json
+import os
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden, HttpResponseNotFound
+from django.utils.crypto import constant_time_compare
+
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+HISTOGRAMS = {
+    "duration": ("http_request_duration_seconds", "Request latency", DURATION_BUCKETS),
+    "size": ("http_response_size_bytes", "Response body size", SIZE_BUCKETS),
+    "queries": ("db_queries_per_request", "ORM queries run by a request", QUERY_BUCKETS),
+}
+COUNTERS = {
+    "query_time": ("db_query_duration_seconds_total", "Time spent in ORM queries"),
+    "serialize_time": ("serialize_duration_seconds_total", "Time spent serializing and rendering responses"),
+}
+PREFIX = "seazon_"
+
+
+class Sample:
+    """
+    What one request spent outside the view code, filled while it runs.
+    """
+    __slots__ = ("queries", "query_time", "serialize_time")
+
+    def __init__(self):
+        self.queries = 0
+        self.query_time = 0.0
+        self.serialize_time = 0.0
+
+
+#: Sample of the request being handled, None outside of requests
+current_sample = contextvars.ContextVar("current_sample", default=None)
+
+
+def record_query(execute, sql, params, many, context):
+    """
+    Execute wrapper of every database connection, see AccountsConfig.ready.
+    """
+    sample = current_sample.get()
+    if sample is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        sample.queries += 1
+        sample.query_time += time.perf_counter() - start
+
+
+def install_query_recorder(sender, connection, **kwargs):
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+def timed(func):
+    """
+    Count the time spent in ``func`` as serialization time of the current request.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        sample = current_sample.get()
+        if sample is None:
+            return func(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            sample.serialize_time += time.perf_counter() - start
+    return wrapper
+
+
+def process_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # Running under another user
+        return True
+    return True
+
+
+def new_stats():
+    stats = {name: {"buckets": [0] * (len(buckets) + 1), "sum": 0} for name, (_, _, buckets) in HISTOGRAMS.items()}
+    stats.update({name: 0 for name in COUNTERS})
+    stats["statuses"] = {}
+    return stats
+
+
+def merge(into, stats):
+    for name in HISTOGRAMS:
+        histogram = into[name]
+        histogram["buckets"] = [a + b for a, b in zip(histogram["buckets"], stats[name]["buckets"])]
+        histogram["sum"] += stats[name]["sum"]
+    for name in COUNTERS:
+        into[name] += stats[name]
+    for status, count in stats["statuses"].items():
+        into["statuses"][status] = into["statuses"].get(status, 0) + count
+
+
+class Registry:
+
+    def __init__(self, directory=None, flush_interval=5):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        #: "<method> <route>" -> stats
+        self.routes = {}
+        self.last_flush = time.monotonic()
+
+    def record(self, route, method, status, duration, size, sample):
+        values = {"duration": duration, "size": size, "queries": sample.queries}
+        with self.lock:
+            stats = self.routes.get(f"{method} {route}")
+            if stats is None:
+                stats = self.routes[f"{method} {route}"] = new_stats()
+            for name, (_, _, buckets) in HISTOGRAMS.items():
+                if values[name] is None:
+                    continue
+                stats[name]["buckets"][bisect.bisect_left(buckets, values[name])] += 1
+                stats[name]["sum"] += values[name]
+            stats["query_time"] += sample.query_time
+            stats["serialize_time"] += sample.serialize_time
+            stats["statuses"][str(status)] = stats["statuses"].get(str(status), 0) + 1
+        if self.directory and time.monotonic() - self.last_flush > self.flush_interval:
+            self.flush()
+
+    @property
+    def path(self):
+        return os.path.join(self.directory, f"{os.getpid()}.json")
+
+    def flush(self):
+        self.last_flush = time.monotonic()
+        with self.lock:
+            data = json.dumps(self.routes)
+        os.makedirs(self.directory, exist_ok=True)
+        fd, temp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "w") as file:
+            file.write(data)
+        os.replace(temp, self.path)
+
+    def collect(self):
+        """
+        Stats of every running process, this one's up to date. Snapshots of exited
+        processes are deleted, a new worker reusing their PID would add its own
+        counts to theirs.
+        """
+        routes = {}
+        snapshots = []
+        if self.directory and os.path.isdir(self.directory):
+            for name in os.listdir(self.directory):
+                path = os.path.join(self.directory, name)
+                pid = name[:-len(".json")]
+                if not name.endswith(".json") or not pid.isdigit() or path == self.path:
+                    continue
+                try:
+                    if not process_exists(int(pid)):
+                        os.remove(path)
+                        continue
+                    with open(path) as file:
+                        snapshots.append(json.load(file))
+                except (OSError, ValueError):
+                    continue
+        with self.lock:
+            snapshots.append(json.loads(json.dumps(self.routes)))
+        for snapshot in snapshots:
+            for key, stats in snapshot.items():
+                if key not in routes:
+                    routes[key] = new_stats()
+                merge(routes[key], stats)
+        return routes
+
+    def render(self):
+        routes = sorted(self.collect().items())
+        lines = []
+        for name, (metric, help_text, buckets) in HISTOGRAMS.items():
+            metric = PREFIX + metric
+            lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} histogram"]
+            for key, stats in routes:
+                labels = route_labels(key)
+                cumulative = 0
+                for bound, count in zip((*buckets, "+Inf"), stats[name]["buckets"]):
+                    cumulative += count
+                    lines.append(f'{metric}_bucket{{{labels},le="{bound}"}} {cumulative}')
+                lines.append(f"{metric}_sum{{{labels}}} {stats[name]['sum']}")
+                lines.append(f"{metric}_count{{{labels}}} {cumulative}")
+        for name, (metric, help_text) in COUNTERS.items():
+            metric = PREFIX + metric
+            lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} counter"]
+            lines += [f"{metric}{{{route_labels(key)}}} {stats[name]}" for key, stats in routes]
+        metric = PREFIX + "http_requests_total"
+        lines += [f"# HELP {metric} Requests by response status", f"# TYPE {metric} counter"]
+        for key, stats in routes:
+            for status, count in sorted(stats["statuses"].items()):
+                lines.append(f'{metric}{{{route_labels(key)},status="{status}"}} {count}')
+        return "\n".join(lines) + "\n"
+
+
+def escape(value):
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def route_labels(key):
+    method, route = key.split(" ", 1)
+    return f'method="{escape(method)}",route="{escape(route)}"'
+
+
+registry = Registry(settings.METRICS["DIR"], settings.METRICS["FLUSH_INTERVAL"])
+if registry.directory:
+    atexit.register(registry.flush)
+
+
+def metrics_view(request):
+    token = settings.METRICS["TOKEN"]
+    if not token:
+        # Route names and traffic are not public, only served without a token to developers
+        if not settings.DEBUG:
+            return HttpResponseNotFound()
+    elif not constant_time_compare(request.headers.get("Authorization", ""), f"Bearer {token}"):
+        return HttpResponseForbidden()
+    return HttpResponse(registry.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
@@ -1,6 +1,101 @@
-from django.utils.deprecation import MiddlewareMixin
+import time
 
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
 
-class LogMiddleware(MiddlewareMixin):
-    def process_request(self, request):
-        print(request.headers)
+from django.conf import settings
+
+from apps.accounts import metrics, routers
+
+
+class MetricsMiddleware:
+    """
+    Records latency, ORM queries, serialization time and response size of every
+    request under its URL pattern, see apps.accounts.metrics.
+    Put it first so the latency covers the other middleware too.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        sample = metrics.Sample()
+        token = metrics.current_sample.set(sample)
+        start = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            metrics.current_sample.reset(token)
+        self.record(request, response, time.perf_counter() - start, sample)
+        return response
+
+    async def __acall__(self, request):
+        sample = metrics.Sample()
+        token = metrics.current_sample.set(sample)
+        start = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            metrics.current_sample.reset(token)
+        self.record(request, response, time.perf_counter() - start, sample)
+        return response
+
+    def record(self, request, response, duration, sample):
+        match = request.resolver_match
+        route = (match.route or match.view_name) if match else "unmatched"
+        if response.streaming:
+            size = int(response["Content-Length"]) if response.has_header("Content-Length") else None
+        else:
+            size = len(response.content)
+        metrics.registry.record(route, request.method, response.status_code, duration, size, sample)
+
+
+class ReplicaMiddleware:
+    """
+    Sends the reads of safe requests to a read replica, see apps.accounts.routers.
+    Clients that wrote are pinned to the primary for READ_REPLICAS["STICKY_SECONDS"].
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        keys = routers.sticky_keys(request)
+        state = routers.RequestState()
+        if routers.may_use_replica(request) and not (keys and routers.get_cache().get_many(keys)):
+            state.replica = routers.choose_replica()
+        token = routers.current_state.set(state)
+        try:
+            response = self.get_response(request)
+        finally:
+            routers.current_state.reset(token)
+        if state.wrote:
+            keys = routers.sticky_keys(request, response)
+            routers.get_cache().set_many(dict.fromkeys(keys, True), settings.READ_REPLICAS["STICKY_SECONDS"])
+        return response
+
+    async def __acall__(self, request):
+        keys = routers.sticky_keys(request)
+        state = routers.RequestState()
+        if routers.may_use_replica(request) and not (keys and await routers.get_cache().aget_many(keys)):
+            state.replica = routers.choose_replica()
+        token = routers.current_state.set(state)
+        try:
+            response = await self.get_response(request)
+        finally:
+            routers.current_state.reset(token)
+        if state.wrote:
+            keys = routers.sticky_keys(request, response)
+            await routers.get_cache().aset_many(dict.fromkeys(keys, True), settings.READ_REPLICAS["STICKY_SECONDS"])
+        return response
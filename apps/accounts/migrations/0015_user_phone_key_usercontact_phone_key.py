@@ -0,0 +1,23 @@
+# Generated by Django 4.1.5 on 2026-10-18 08:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0014_usercontact_change_seq'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='phone_key',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=16, null=True, verbose_name='Phone Key'),
+        ),
+        migrations.AddField(
+            model_name='usercontact',
+            name='phone_key',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=16, null=True, verbose_name='Phone Key'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.1.5 on 2026-10-18 08:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0016_job'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='chatgroup',
+            index=models.Index(fields=['created_at', 'id'], name='chatgroup_created_at_id_idx'),
+        ),
+    ]
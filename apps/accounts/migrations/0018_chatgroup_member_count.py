@@ -0,0 +1,33 @@
+# Generated by Django 4.1.5 on 2026-10-18 08:41
+
+from django.db import migrations, models
+from django.db.models.functions import Coalesce
+
+
+def count_members(apps, schema_editor):
+    ChatGroup = apps.get_model('accounts', 'ChatGroup')
+    GroupMember = apps.get_model('accounts', 'GroupMember')
+    ChatGroup.objects.update(member_count=Coalesce(
+        models.Subquery(
+            GroupMember.objects.filter(group=models.OuterRef('id')).values('group').annotate(
+                count=models.Count('id')
+            ).values('count')
+        ),
+        0
+    ))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0017_chatgroup_created_at_id_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatgroup',
+            name='member_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(count_members, migrations.RunPython.noop),
+    ]
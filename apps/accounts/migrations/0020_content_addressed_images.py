@@ -0,0 +1,41 @@
+# Generated by Django 4.1.5 on 2026-10-18 08:54
+
+import apps.accounts.storage
+from django.db import migrations, models
+
+
+def count_references(apps, schema_editor):
+    User = apps.get_model('accounts', 'User')
+    MediaFile = apps.get_model('accounts', 'MediaFile')
+    counts = {}
+    for image, variants in User.objects.values_list('image', 'image_variants').iterator(chunk_size=2000):
+        for name in {image, *(variants or {}).values()} - {''}:
+            counts[name] = counts.get(name, 0) + 1
+    MediaFile.objects.bulk_create(
+        [MediaFile(name=name, references=count) for name, count in counts.items()], batch_size=1000
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0019_user_image_variants'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MediaFile',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True)),
+                ('references', models.IntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='user',
+            name='image',
+            field=models.ImageField(blank=True, storage=apps.accounts.storage.ContentAddressedStorage(), upload_to='user/profile_photo/'),
+        ),
+        migrations.RunPython(count_references, migrations.RunPython.noop),
+    ]
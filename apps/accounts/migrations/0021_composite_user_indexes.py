@@ -0,0 +1,34 @@
+# Generated by Django 4.1.5 on 2026-10-18 09:10
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0020_content_addressed_images'),
+    ]
+
+    # The composite indexes are built before the single column ones they replace are dropped
+    operations = [
+        migrations.AddIndex(
+            model_name='groupmember',
+            index=models.Index(fields=['user', 'group'], name='groupmember_user_group_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='usercontact',
+            index=models.Index(fields=['user', 'phone_key'], name='usercontact_user_phone_idx'),
+        ),
+        migrations.AlterField(
+            model_name='groupmember',
+            name='user',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='usercontact',
+            name='user',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+    ]
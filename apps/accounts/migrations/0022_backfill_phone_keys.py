@@ -0,0 +1,46 @@
+from django.db import migrations
+
+from apps.accounts.utils import normalize_phone
+
+
+BATCH_SIZE = 2000
+
+
+def backfill(model, queryset, build):
+    """
+    Recompute phone_key in batches of ids, rows whose key is up to date are left alone.
+    """
+    last_id = 0
+    while True:
+        rows = list(queryset.filter(id__gt=last_id).order_by("id")[:BATCH_SIZE])
+        if not rows:
+            return
+        changed = [model(id=row[0], phone_key=key) for row, key in zip(rows, map(build, rows)) if key != row[-1]]
+        model.objects.bulk_update(changed, ["phone_key"])
+        last_id = rows[-1][0]
+
+
+def backfill_phone_keys(apps, schema_editor):
+    User = apps.get_model("accounts", "User")
+    UserContact = apps.get_model("accounts", "UserContact")
+    # Keys of rows written before 0015 are missing, longer than E.164 ones were truncated
+    backfill(
+        User, User.objects.values_list("id", "country_code", "mobile_number", "phone_key"),
+        lambda row: normalize_phone(row[1], row[2])
+    )
+    backfill(
+        UserContact,
+        UserContact.objects.values_list("id", "country_code", "mobile_number", "user__country_code", "phone_key"),
+        lambda row: normalize_phone(row[1], row[2], row[3])
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0021_composite_user_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_phone_keys, migrations.RunPython.noop),
+    ]
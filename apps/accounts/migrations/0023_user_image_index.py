@@ -0,0 +1,19 @@
+# Generated by Django 4.1.5 on 2026-10-18 09:26
+
+import apps.accounts.storage
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0022_backfill_phone_keys'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='user',
+            name='image',
+            field=models.ImageField(blank=True, db_index=True, storage=apps.accounts.storage.ContentAddressedStorage(), upload_to='user/profile_photo/'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.1.5 on 2026-10-18 09:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0023_user_image_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='job',
+            index=models.Index(fields=['status', 'updated_at'], name='job_status_updated_at_idx'),
+        ),
+    ]
@@ -1,9 +1,15 @@
-from django.db import models
+from django.db import models, transaction
+from django.db.models.functions import Coalesce
 from django.contrib.auth.models import AbstractUser
 from django.db.models import CharField
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 from django.utils.crypto import get_random_string
 
+from apps.accounts import cache as accounts_cache
+from apps.accounts.storage import image_storage
+from apps.accounts.utils import PHONE_KEY_MAX_LENGTH, normalize_phone
+
 
 def get_default_random_string(length=10):
     return get_random_string(length)
@@ -20,32 +26,126 @@ class User(AbstractUser):
     name = CharField(_("Name of User"), blank=True, max_length=255)
     country_code = CharField(_("User Country Code"), blank=True, max_length=4)
     mobile_number = CharField(_("Mobile Number"), max_length=10, null=True, unique=True)
+    #: Normalized country code + mobile number, see utils.normalize_phone
+    phone_key = CharField(
+        _("Phone Key"), max_length=PHONE_KEY_MAX_LENGTH, null=True, blank=True, db_index=True, editable=False
+    )
     login_otp = CharField(_("Login OTP"), blank=True, max_length=10)
     first_name = None  # type: ignore
     last_name = None  # type: ignore
     last_sync = models.DateTimeField(auto_now_add=True)
     status = models.TextField(blank=True)
     bio = models.TextField(blank=True)
-    image = models.ImageField(blank=True, upload_to='user/profile_photo/')
+    #: Indexed for avatars.existing_variants(), which looks up users with the same image
+    image = models.ImageField(blank=True, upload_to='user/profile_photo/', storage=image_storage, db_index=True)
+    #: Avatar size -> storage name of the square crop of image, see apps.accounts.avatars
+    image_variants = models.JSONField(default=dict, blank=True, editable=False)
 
     def __str__(self):
         return f"${self.name} -> ${self.mobile_number}"
 
+    #: Fields the post_save signals only react to when they changed, see signals.field_changed
+    TRACKED_FIELDS = ("is_active", "mobile_number")
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        user = super().from_db(db, field_names, values)
+        user._loaded_values = {name: user.__dict__.get(name) for name in cls.TRACKED_FIELDS}
+        return user
+
+    def save(self, *args, **kwargs):
+        self.phone_key = normalize_phone(self.country_code, self.mobile_number)
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None and {"country_code", "mobile_number"} & set(update_fields):
+            kwargs["update_fields"] = {*update_fields, "phone_key"}
+        super().save(*args, **kwargs)
+        # The signals sent by the save compared with the loaded values, the next save compares with these
+        self._loaded_values = {name: self.__dict__.get(name) for name in self.TRACKED_FIELDS}
+
 
 class UserContact(models.Model):
-    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    #: Leads both indexes below, they serve lookups by user alone as well
+    user = models.ForeignKey(User, on_delete=models.CASCADE, db_index=False)
     username = models.CharField(max_length=10, null=True, blank=True)
     name = CharField(_("Name of User"), max_length=255)
     country_code = CharField(_("User Country Code"), blank=True, max_length=4)
     mobile_number = CharField(_("Mobile Number"), max_length=10)
+    #: Normalized country code + mobile number, the owner's country code is used when it is missing
+    phone_key = CharField(
+        _("Phone Key"), max_length=PHONE_KEY_MAX_LENGTH, null=True, blank=True, db_index=True, editable=False
+    )
     active = models.BooleanField(default=False)
     updated_at = models.DateTimeField(auto_now=True)
+    #: Position in the contact change log, see ChangeSequence. Sync cursors are (change_seq, id).
+    change_seq = models.BigIntegerField(default=0)
 
     def __str__(self):
         return f"${self.user} | ${self.name} -> ${self.mobile_number}"
 
+    def save(self, *args, **kwargs):
+        self.phone_key = normalize_phone(self.country_code, self.mobile_number, self.user.country_code)
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None and {"country_code", "mobile_number"} & set(update_fields):
+            kwargs["update_fields"] = {*update_fields, "phone_key"}
+        super().save(*args, **kwargs)
+
     class Meta:
         unique_together = ['user', 'username']
+        indexes = [
+            models.Index(fields=['user', 'change_seq', 'id'], name='usercontact_user_seq_idx'),
+            models.Index(fields=['user', 'phone_key'], name='usercontact_user_phone_idx'),
+        ]
+
+
+class ChangeSequence(models.Model):
+    """
+    Named monotonic counters. Every write that should be picked up by
+    a delta sync stamps the rows with a freshly reserved value.
+
+    The contacts of each user have their own counter, named "contacts:<user id>",
+    which stamps UserContact.change_seq, see reserve_contacts().
+    """
+    #: Prefix of the per user counters of UserContact.change_seq
+    CONTACTS = "contacts"
+
+    name = models.CharField(max_length=32, unique=True)
+    value = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return f"${self.name} -> ${self.value}"
+
+    @classmethod
+    def reserve_contacts(cls, user_ids):
+        """
+        Reserve the next change_seq of the contacts of each of ``user_ids`` and
+        return user id -> value.
+
+        Sync cursors are per user, so are the counters: writes to the contacts of
+        different users don't wait on each other's lock. A new counter starts after
+        the highest change_seq the user's contacts already have.
+
+        Call it inside the transaction that writes the stamped rows: the row locks
+        are held until commit, so rows become visible in sequence order and a
+        cursor never skips over a late commit.
+        """
+        names = {f"{cls.CONTACTS}:{user_id}": user_id for user_id in user_ids}
+        with transaction.atomic():
+            # Locked in name order, so concurrent reservations of overlapping users can't deadlock
+            existing = cls.objects.select_for_update().filter(name__in=names).order_by("name")
+            missing = [names[name] for name in set(names) - set(existing.values_list("name", flat=True))]
+            if missing:
+                last = dict(
+                    UserContact.objects.filter(user_id__in=missing).values("user_id").annotate(
+                        last=models.Max("change_seq")
+                    ).values_list("user_id", "last")
+                )
+                cls.objects.bulk_create(
+                    [cls(name=f"{cls.CONTACTS}:{user_id}", value=last.get(user_id) or 0) for user_id in missing],
+                    ignore_conflicts=True
+                )
+            cls.objects.filter(name__in=names).update(value=models.F("value") + 1)
+            values = cls.objects.filter(name__in=names).values_list("name", "value")
+        return {names[name]: value for name, value in values}
 
 
 class ChatGroup(models.Model):
@@ -55,14 +155,41 @@ class ChatGroup(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     premium = models.BooleanField(default=False)
     amount = models.PositiveIntegerField(null=True, blank=True)
+    #: Kept in step with GroupMember rows by the group views, see adjust_member_count
+    member_count = models.PositiveIntegerField(default=0)
 
     def __str__(self):
         return f"${self.name} | ${self.created_by}"
 
+    def adjust_member_count(self, delta):
+        if delta:
+            ChatGroup.objects.filter(id=self.id).update(member_count=models.F("member_count") + delta)
+            accounts_cache.bump_groups([self.id])
+
+    def refresh_member_count(self):
+        """
+        Recount the members in the database, for bulk changes where the delta is not known exactly.
+        """
+        ChatGroup.objects.filter(id=self.id).update(member_count=Coalesce(
+            models.Subquery(
+                GroupMember.objects.filter(group=models.OuterRef("id")).values("group").annotate(
+                    count=models.Count("id")
+                ).values("count")
+            ),
+            0
+        ))
+        accounts_cache.bump_groups([self.id])
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['created_at', 'id'], name='chatgroup_created_at_id_idx'),
+        ]
+
 
 class GroupMember(models.Model):
     group = models.ForeignKey(ChatGroup, on_delete=models.CASCADE)
-    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    #: Leads groupmember_user_group_idx, the groups of a user are read from the index alone
+    user = models.ForeignKey(User, on_delete=models.CASCADE, db_index=False)
     is_admin = models.BooleanField(default=False)
 
     def __str__(self):
@@ -70,3 +197,75 @@ class GroupMember(models.Model):
 
     class Meta:
         unique_together = ['group', 'user']
+        indexes = [
+            models.Index(fields=['user', 'group'], name='groupmember_user_group_idx'),
+        ]
+
+
+class Job(models.Model):
+    """
+    Unit of background work, see apps.accounts.jobs for the runner.
+    """
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    STATUS_CHOICES = (
+        (PENDING, "Pending"),
+        (RUNNING, "Running"),
+        (DONE, "Done"),
+        (FAILED, "Failed"),
+    )
+
+    name = models.CharField(max_length=64)
+    payload = models.JSONField(default=dict, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=5)
+    run_after = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"${self.name} | ${self.status}"
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'run_after'], name='job_status_run_after_idx'),
+            # Timed out running jobs, done jobs to purge
+            models.Index(fields=['status', 'updated_at'], name='job_status_updated_at_idx'),
+        ]
+
+
+class MediaFile(models.Model):
+    """
+    Number of users referencing a file of the content addressed image storage,
+    as their image or one of its variants. Kept by apps.accounts.signals.
+    Files without references are deleted by the gc_media command.
+    """
+    name = models.CharField(max_length=255, unique=True)
+    references = models.IntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.name} ({self.references})"
+
+    @classmethod
+    def adjust(cls, names, delta):
+        names = list(names)
+        if not names:
+            return
+        if delta > 0:
+            cls.objects.bulk_create([cls(name=name) for name in names], ignore_conflicts=True)
+        cls.objects.filter(name__in=names).update(references=models.F("references") + delta, updated_at=timezone.now())
+
+    @staticmethod
+    def names_of(image, variants):
+        """
+        Storage names referenced by a user's image and image_variants values.
+        """
+        names = set((variants or {}).values())
+        if image:
+            names.add(str(image))
+        return names
@@ -0,0 +1,65 @@
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.crypto import constant_time_compare
+
+
+class OtpStore:
+    """
+    One-time passwords keyed by phone key, kept in a cache with a TTL instead
+    of on the user row. Codes are consumed by a compare-and-delete and a code
+    is dropped after ``max_attempts`` wrong guesses.
+    """
+
+    def __init__(self, cache_alias, ttl, max_attempts):
+        self.cache_alias = cache_alias
+        self.ttl = ttl
+        self.max_attempts = max_attempts
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    def issue(self, phone_key, code):
+        self.cache.set_many({f"otp:{phone_key}": str(code), f"otp-attempts:{phone_key}": 0}, self.ttl)
+
+    def get(self, phone_key):
+        """
+        Code issued to ``phone_key``, None when it expired or was used.
+        """
+        return self.cache.get(f"otp:{phone_key}")
+
+    def verify(self, phone_key, code):
+        """
+        Return True when ``code`` matches, the code can't be used again afterwards.
+        """
+        key, attempts_key = f"otp:{phone_key}", f"otp-attempts:{phone_key}"
+        try:
+            attempts = self.cache.incr(attempts_key)
+        except ValueError:
+            # No code issued or it expired
+            return False
+        if attempts > self.max_attempts:
+            self.cache.delete_many([key, attempts_key])
+            return False
+        stored = self.cache.get(key)
+        if stored is None or not constant_time_compare(stored, str(code)):
+            return False
+        # Only one of concurrent requests with the right code gets to delete it
+        if not self.cache.delete(key):
+            return False
+        self.cache.delete(attempts_key)
+        return True
+
+    async def aissue(self, phone_key, code):
+        await sync_to_async(self.issue)(phone_key, code)
+
+    async def averify(self, phone_key, code):
+        return await sync_to_async(self.verify)(phone_key, code)
+
+
+otp_store = OtpStore(
+    cache_alias=settings.OTP_STORE["CACHE"],
+    ttl=settings.OTP_STORE["TTL"],
+    max_attempts=settings.OTP_STORE["MAX_ATTEMPTS"],
+)
@@ -0,0 +1,125 @@
+import base64
+import binascii
+import datetime
+import json
+from collections import OrderedDict
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    """
+    Forward-only keyset pagination over the ``ordering`` fields, which must
+    end with a unique one. The cursor is the position of the last row of the
+    previous page, so every page is an index range scan however deep the
+    client goes.
+    """
+    ordering = ("id",)
+    cursor_query_param = "cursor"
+    page_size = 50
+    page_size_query_param = "page_size"
+    max_page_size = 200
+    invalid_cursor_message = "Invalid cursor"
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        position = self.decode_cursor(request, queryset.model)
+
+        queryset = queryset.order_by(*self.ordering)
+        if position is not None:
+            queryset = queryset.filter(self.after(position))
+
+        results = list(queryset[:self.page_size + 1])
+        self.has_next = len(results) > self.page_size
+        results = results[:self.page_size]
+        self.next_position = self.get_position(results[-1]) if self.has_next else None
+        return results
+
+    def after(self, position):
+        """
+        Rows sorting after ``position``: (a > x) or (a = x and b > y) ...
+        """
+        condition = Q()
+        for index, name in enumerate(self.ordering):
+            equal = dict(zip(self.ordering[:index], position[:index]))
+            condition |= Q(**equal, **{f"{name}__gt": position[index]})
+        return condition
+
+    def get_position(self, instance):
+        if isinstance(instance, dict):
+            return tuple(instance[name] for name in self.ordering)
+        return tuple(getattr(instance, name) for name in self.ordering)
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return min(max(page_size, 1), self.max_page_size)
+
+    def get_next_link(self):
+        if self.next_position is None:
+            return None
+        return replace_query_param(
+            self.request.build_absolute_uri(), self.cursor_query_param, self.encode_cursor(self.next_position)
+        )
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('results', data),
+        ]))
+
+    def encode_cursor(self, position):
+        # Not DjangoJSONEncoder, it cuts datetimes down to milliseconds
+        values = [value.isoformat() if isinstance(value, datetime.datetime) else value for value in position]
+        return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+    def decode_cursor(self, request, model):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            values = json.loads(base64.urlsafe_b64decode(encoded.encode()))
+            if not isinstance(values, list) or len(values) != len(self.ordering):
+                raise ValueError
+            position = tuple(
+                model._meta.get_field(name).to_python(value) for name, value in zip(self.ordering, values)
+            )
+        except (TypeError, ValueError, binascii.Error, ValidationError):
+            raise NotFound(self.invalid_cursor_message)
+        if None in position:
+            raise NotFound(self.invalid_cursor_message)
+        return position
+
+    def get_schema_operation_parameters(self, view):
+        return [
+            {
+                'name': self.cursor_query_param,
+                'required': False,
+                'in': 'query',
+                'schema': {'type': 'string'},
+            },
+            {
+                'name': self.page_size_query_param,
+                'required': False,
+                'in': 'query',
+                'schema': {'type': 'integer'},
+            },
+        ]
+
+
+class CreatedAtKeysetPagination(KeysetPagination):
+    ordering = ("created_at", "id")
+
+
+class GroupMemberPagination(KeysetPagination):
+    ordering = ("id",)
+    page_size = 100
+    max_page_size = 500
@@ -0,0 +1,35 @@
+from django.conf import settings
+from rest_framework import parsers
+from rest_framework.exceptions import ParseError
+
+from apps.accounts import renderers
+from apps.accounts.renderers import orjson, msgpack
+
+
+class FastJSONParser(parsers.JSONParser):
+    """
+    JSONParser on orjson when it is installed, orjson only reads UTF-8.
+    """
+    renderer_class = renderers.FastJSONRenderer
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        encoding = (parser_context or {}).get('encoding', settings.DEFAULT_CHARSET)
+        if orjson is None or not self.strict or encoding.lower().replace('-', '') != 'utf8':
+            return super().parse(stream, media_type, parser_context)
+        try:
+            return orjson.loads(stream.read())
+        except orjson.JSONDecodeError as exc:
+            raise ParseError('JSON parse error - %s' % str(exc))
+
+
+class MessagePackParser(parsers.BaseParser):
+    media_type = 'application/msgpack'
+    renderer_class = renderers.MessagePackRenderer
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        if msgpack is None:
+            raise ParseError('MessagePack is not supported')
+        try:
+            return msgpack.unpackb(stream.read(), raw=False, strict_map_key=False)
+        except (ValueError, TypeError, msgpack.UnpackException) as exc:
+            raise ParseError('MessagePack parse error - %s' % str(exc))
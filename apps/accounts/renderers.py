@@ -0,0 +1,66 @@
+from rest_framework import renderers
+from rest_framework.utils.encoders import JSONEncoder
+
+from apps.accounts.metrics import timed
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+
+class FastJSONRenderer(renderers.JSONRenderer):
+    """
+    JSONRenderer on orjson when it is installed, with the same output.
+    Pretty printing, non-default JSON settings and a missing orjson fall back to the stdlib.
+    """
+    encoder = JSONEncoder()
+    # Datetimes go through DRF's encoder like they would with the stdlib
+    options = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS if orjson else 0
+
+    @timed
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        if (
+            orjson is None or self.ensure_ascii or not self.compact or not self.strict
+            or self.get_indent(accepted_media_type, renderer_context or {}) is not None
+        ):
+            return super().render(data, accepted_media_type, renderer_context)
+        try:
+            ret = orjson.dumps(data, default=self.encoder.default, option=self.options)
+        except TypeError:
+            # e.g. integers beyond 64 bit
+            return super().render(data, accepted_media_type, renderer_context)
+        # Same as JSONRenderer, keep the output a strict javascript subset
+        if b'\xe2\x80' in ret:
+            ret = ret.replace('\u2028'.encode(), b'\\u2028').replace('\u2029'.encode(), b'\\u2029')
+        return ret
+
+
+def msgpack_default(obj):
+    if isinstance(obj, dict):
+        return dict(obj)
+    if isinstance(obj, (list, tuple)):
+        return list(obj)
+    return JSONEncoder().default(obj)
+
+
+class MessagePackRenderer(renderers.BaseRenderer):
+    media_type = 'application/msgpack'
+    format = 'msgpack'
+    charset = None
+    render_style = 'binary'
+
+    @timed
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        if msgpack is None:
+            raise RuntimeError("MessagePackRenderer requires the msgpack package")
+        return msgpack.packb(data, default=msgpack_default, use_bin_type=True, datetime=False)
@@ -0,0 +1,105 @@
+"""
+Read replica routing, enabled by listing database aliases in READ_REPLICAS["ALIASES"].
+
+apps.accounts.middleware.ReplicaMiddleware picks a replica for each GET, HEAD
+or OPTIONS request. Everything else reads from the primary: other requests,
+jobs, commands, transactions, and requests that have written.
+
+Replicas lag behind the primary. A client that has written reads from the
+primary for READ_REPLICAS["STICKY_SECONDS"], keyed by its token and its session
+cookie, so it sees its own writes. Tokens and sessions are always read from the
+primary: clients use them right after verify-otp or a login creates them, before
+any stickiness applies.
+"""
+import contextlib
+import contextvars
+import hashlib
+import random
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS, connections
+
+
+SAFE_METHODS = ("GET", "HEAD", "OPTIONS")
+PRIMARY_MODELS = ("authtoken.Token", "sessions.Session")
+
+
+class RequestState:
+    """
+    Database the request reads from, filled while it runs.
+    """
+    __slots__ = ("replica", "wrote")
+
+    def __init__(self, replica=None):
+        #: Alias reads go to, None for the primary
+        self.replica = replica
+        self.wrote = False
+
+
+#: State of the request being handled, None outside of requests
+current_state = contextvars.ContextVar("database_state", default=None)
+
+
+def get_cache():
+    return caches[settings.READ_REPLICAS["CACHE"]]
+
+
+def sticky_keys(request, response=None):
+    """
+    Cache keys pinning the client of ``request`` to the primary, one per credential:
+    its token and its session cookie, including a session ``response`` starts.
+    """
+    credentials = [request.headers.get("Auth"), request.COOKIES.get(settings.SESSION_COOKIE_NAME)]
+    if response is not None and settings.SESSION_COOKIE_NAME in response.cookies:
+        credentials.append(response.cookies[settings.SESSION_COOKIE_NAME].value)
+    return ["primary:" + hashlib.sha256(credential.encode()).hexdigest() for credential in credentials if credential]
+
+
+def may_use_replica(request):
+    return bool(settings.READ_REPLICAS["ALIASES"]) and request.method in SAFE_METHODS
+
+
+def choose_replica():
+    return random.choice(settings.READ_REPLICAS["ALIASES"])
+
+
+@contextlib.contextmanager
+def primary():
+    """
+    Send the reads of the block to the primary, e.g. to build data cached for every client.
+    """
+    token = current_state.set(None)
+    try:
+        yield
+    finally:
+        current_state.reset(token)
+
+
+class ReplicaRouter:
+
+    def db_for_read(self, model, **hints):
+        state = current_state.get()
+        if state is None or state.replica is None or state.wrote:
+            return DEFAULT_DB_ALIAS
+        if model._meta.label in PRIMARY_MODELS:
+            return DEFAULT_DB_ALIAS
+        # e.g. select_for_update(), or reads checking what the transaction is about to write
+        if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        return state.replica
+
+    def db_for_write(self, model, **hints):
+        state = current_state.get()
+        if state is not None:
+            state.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same rows as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db in settings.READ_REPLICAS["ALIASES"]:
+            return False
+        return None
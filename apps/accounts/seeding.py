@@ -0,0 +1,304 @@
+"""
+Deterministic synthetic datasets for benchmarks and staging databases, loaded
+by the seed and benchmark commands.
+
+Rows get explicit ids and every user's address book and every group's members
+are derived from the seed and the entity id only, the same arguments always build
+the same database and an interrupted run can be resumed where it stopped.
+
+Users belong to communities of COMMUNITY_SIZE consecutive ids. Address books
+are mostly made of the owner's community, so they overlap, plus a few popular
+users and unregistered numbers shared by the community. Contact counts and group
+sizes follow a power law around the scale's means.
+
+Rows are written with plain SQL, bypassing models and signals: batched inserts,
+or COPY on PostgreSQL.
+"""
+import csv
+import io
+import random
+import time
+from collections import namedtuple
+
+from django.contrib.auth import get_user_model
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.db.models import Max, Min
+from django.utils import timezone
+
+from apps.accounts.models import UserContact, ChatGroup, GroupMember
+from apps.accounts.utils import normalize_phone
+
+
+User = get_user_model()
+
+#: Means of contacts per user and members per group
+Scale = namedtuple("Scale", ["users", "contacts_per_user", "groups", "members_per_group"])
+
+SCALES = {
+    "tiny": Scale(users=1_000, contacts_per_user=20, groups=100, members_per_group=10),
+    "small": Scale(users=10_000, contacts_per_user=50, groups=1_000, members_per_group=20),
+    "medium": Scale(users=100_000, contacts_per_user=100, groups=10_000, members_per_group=30),
+    "large": Scale(users=1_000_000, contacts_per_user=100, groups=100_000, members_per_group=30),
+}
+
+COUNTRY_CODE = "+91"
+FIRST_MOBILE_NUMBER = 7000000000
+FIRST_UNREGISTERED_NUMBER = 6000000000
+COMMUNITY_SIZE = 500
+#: Share of address book entries that are not registered users
+UNREGISTERED_CONTACTS = 0.3
+#: Share of registered contacts drawn from all users, skewed towards popular ones
+POPULAR_CONTACTS = 0.2
+#: Pareto shape of contact counts and group sizes, the lower the longer the tail
+POWER_LAW_ALPHA = 1.5
+MAX_CONTACTS = 5000
+MAX_GROUP_SIZE = 1000
+
+
+def username(user_id):
+    return f"u{user_id:07d}"
+
+
+def mobile_number(user_id):
+    return str(FIRST_MOBILE_NUMBER + user_id)
+
+
+def group_unique_id(group_id):
+    return f"g{group_id:07d}"
+
+
+class Table:
+    """
+    Columns of ``model`` written by a seeder: ``fields`` in the order rows give
+    them, then every other column with its default.
+    """
+
+    def __init__(self, model, fields):
+        self.model = model
+        fields = [model._meta.get_field(name) for name in fields]
+        defaults = [field for field in model._meta.concrete_fields if field not in fields]
+        self.columns = [field.column for field in fields + defaults]
+        self.defaults = tuple(field.get_db_prep_save(field.get_default(), connection) for field in defaults)
+
+    def insert(self, rows):
+        rows = [row + self.defaults for row in rows]
+        if connection.vendor == "postgresql":
+            self.copy(rows)
+            return
+        quote = connection.ops.quote_name
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                f"INSERT INTO {quote(self.model._meta.db_table)} ({', '.join(map(quote, self.columns))}) "
+                f"VALUES ({', '.join(['%s'] * len(self.columns))})",
+                rows
+            )
+
+    def copy(self, rows):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for row in rows:
+            writer.writerow(["\\N" if value is None else value for value in row])
+        buffer.seek(0)
+        quote = connection.ops.quote_name
+        with connection.cursor() as cursor:
+            cursor.cursor.copy_expert(
+                f"COPY {quote(self.model._meta.db_table)} ({', '.join(map(quote, self.columns))}) "
+                "FROM STDIN WITH (FORMAT csv, NULL '\\N')",
+                buffer
+            )
+
+
+class Seeder:
+
+    def __init__(self, scale, seed=0, batch_size=10000, stdout=None):
+        self.scale = scale
+        self.seed = seed
+        self.batch_size = batch_size
+        self.stdout = stdout
+        self.now = timezone.now()
+
+    def rng(self, *key):
+        """
+        Random generator of one entity, independent of the order rows are built in.
+        """
+        return random.Random(f"{self.seed}:{':'.join(map(str, key))}")
+
+    def log(self, message):
+        if self.stdout is not None:
+            self.stdout.write(message)
+
+    def run(self, resume=False):
+        """
+        Load the dataset. With ``resume`` the rows a previous run with the same
+        arguments committed are kept and the missing ones added.
+        """
+        now = User._meta.get_field("date_joined").get_db_prep_save(self.now, connection)
+        self.load(
+            Table(User, [
+                "id", "username", "name", "country_code", "mobile_number", "phone_key", "date_joined", "last_sync",
+            ]),
+            self.users(self.next_id(User, resume), now)
+        )
+        owner, contact_id = self.resume_point(UserContact, "user_id", resume)
+        self.load(
+            Table(UserContact, [
+                "id", "user", "username", "name", "country_code", "mobile_number", "phone_key", "active",
+                "updated_at", "change_seq",
+            ]),
+            self.contacts(owner, contact_id, now)
+        )
+        self.load(
+            Table(ChatGroup, [
+                "id", "name", "unique_id", "created_by", "created_at", "premium", "amount", "member_count",
+            ]),
+            self.groups(self.next_id(ChatGroup, resume), now)
+        )
+        group, member_id = self.resume_point(GroupMember, "group_id", resume)
+        self.load(Table(GroupMember, ["id", "group", "user", "is_admin"]), self.members(group, member_id))
+
+        # Contacts are stamped with change_seq 1, per user counters start after it when first used
+        self.reset_sequences()
+
+    def next_id(self, model, resume):
+        if not resume:
+            return 1
+        return (model.objects.aggregate(last=Max("id"))["last"] or 0) + 1
+
+    def resume_point(self, model, parent, resume):
+        """
+        (parent id, row id) to start the child rows of ``model`` from. Rows of the last
+        parent may be incomplete, they are deleted and written again.
+        """
+        last = model.objects.aggregate(last=Max(parent))["last"] if resume else None
+        if last is None:
+            return 1, 1
+        first_id = model.objects.filter(**{parent: last}).aggregate(first=Min("id"))["first"]
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {connection.ops.quote_name(model._meta.db_table)} WHERE id >= %s", [first_id])
+        return last, first_id
+
+    def load(self, table, rows):
+        count = 0
+        start = time.monotonic()
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= self.batch_size:
+                count += self.write(table, batch)
+                batch = []
+        if batch:
+            count += self.write(table, batch)
+        elapsed = time.monotonic() - start
+        self.log(f"{table.model.__name__}: {count} rows in {elapsed:.1f}s")
+
+    def write(self, table, batch):
+        with transaction.atomic():
+            table.insert(batch)
+        return len(batch)
+
+    def reset_sequences(self):
+        with connection.cursor() as cursor:
+            for sql in connection.ops.sequence_reset_sql(no_style(), [User, UserContact, ChatGroup, GroupMember]):
+                cursor.execute(sql)
+
+    def power_law(self, rng, mean, limit):
+        """
+        Pareto distributed count with the given mean, at least 1 and at most ``limit``.
+        """
+        minimum = mean * (POWER_LAW_ALPHA - 1) / POWER_LAW_ALPHA
+        return max(1, min(limit, int(minimum * rng.paretovariate(POWER_LAW_ALPHA))))
+
+    def community(self, user_id):
+        """
+        First and last user id of the community of ``user_id``.
+        """
+        first = (user_id - 1) // COMMUNITY_SIZE * COMMUNITY_SIZE + 1
+        return first, min(first + COMMUNITY_SIZE - 1, self.scale.users)
+
+    def popular_user(self, rng):
+        # Log-uniform, low ids are in many address books
+        return min(self.scale.users, int(self.scale.users ** rng.random()))
+
+    def neighbour(self, rng, user_id):
+        return rng.randint(*self.community(user_id))
+
+    def users(self, first_id, now):
+        for user_id in range(first_id, self.scale.users + 1):
+            number = mobile_number(user_id)
+            yield (
+                user_id, username(user_id), f"User {user_id}", COUNTRY_CODE, number,
+                normalize_phone(COUNTRY_CODE, number), now, now,
+            )
+
+    def address_book(self, user_id):
+        """
+        Mobile number -> user id of the registered ones, None for the others.
+        """
+        rng = self.rng("contacts", user_id)
+        first, last = self.community(user_id)
+        numbers = {}
+        for _ in range(self.power_law(rng, self.scale.contacts_per_user, MAX_CONTACTS)):
+            draw = rng.random()
+            if draw < UNREGISTERED_CONTACTS:
+                # Shared by the community, they join later and match several address books at once
+                number = FIRST_UNREGISTERED_NUMBER + first * 2 + rng.randrange(COMMUNITY_SIZE * 2)
+                numbers[str(number)] = None
+                continue
+            if draw < UNREGISTERED_CONTACTS + POPULAR_CONTACTS:
+                target = self.popular_user(rng)
+            else:
+                target = rng.randint(first, last)
+            if target != user_id:
+                numbers[mobile_number(target)] = target
+        return numbers
+
+    def contacts(self, first_owner, first_id, now):
+        contact_id = first_id
+        for user_id in range(first_owner, self.scale.users + 1):
+            for number, target in self.address_book(user_id).items():
+                yield (
+                    contact_id, user_id, username(target) if target else None, f"Contact {number}", COUNTRY_CODE,
+                    number, normalize_phone(COUNTRY_CODE, number), target is not None, now, 1,
+                )
+                contact_id += 1
+
+    def groups(self, first_id, now):
+        for group_id in range(first_id, self.scale.groups + 1):
+            rng = self.rng("group", group_id)
+            premium = rng.random() < 0.1
+            yield (
+                group_id, f"Group {group_id}", group_unique_id(group_id), self.creator(group_id), now, premium,
+                rng.randint(1, 100) * 10 if premium else None, len(self.group_members(group_id)),
+            )
+
+    def creator(self, group_id):
+        return self.rng("group", group_id, "creator").randint(1, self.scale.users)
+
+    def group_members(self, group_id):
+        """
+        User ids of the group, the creator first. Mostly the creator's community.
+        """
+        rng = self.rng("group", group_id, "members")
+        creator = self.creator(group_id)
+        size = min(self.power_law(rng, self.scale.members_per_group, MAX_GROUP_SIZE), self.scale.users)
+        members = {creator: None}
+        for _ in range(size * 2):
+            if len(members) >= size:
+                break
+            if rng.random() < POPULAR_CONTACTS:
+                members[rng.randint(1, self.scale.users)] = None
+            else:
+                members[self.neighbour(rng, creator)] = None
+        return list(members)
+
+    def members(self, first_group, first_id):
+        member_id = first_id
+        for group_id in range(first_group, self.scale.groups + 1):
+            for index, user_id in enumerate(self.group_members(group_id)):
+                yield member_id, group_id, user_id, index == 0
+                member_id += 1
+
+
+def seed(scale, seed=0, batch_size=10000, resume=False, stdout=None):
+    Seeder(scale, seed, batch_size, stdout).run(resume)
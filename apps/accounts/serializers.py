@@ -1,28 +1,40 @@
 from django.utils import timezone
-import os
 import random
 
+from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.core import signing
 from django.core.validators import RegexValidator
 from rest_framework import serializers
 from rest_framework.exceptions import ValidationError
 from django.utils.crypto import get_random_string
-from twilio.rest import Client
-from apps.accounts.models import UserContact, GroupMember, ChatGroup
-from apps.accounts.utils import Base64ImageField
+from django.db import transaction
+from django.db.models import Q
+from apps.accounts.models import UserContact, GroupMember, ChatGroup, ChangeSequence
+from apps.accounts.utils import Base64ImageField, normalize_phone
+from apps.accounts import avatars, events, sms
+from apps.accounts import cache as accounts_cache
+from apps.accounts.otp import otp_store
 
 
 User = get_user_model()
 
 
-account_sid = os.environ.get('TWILIO_ACCOUNT_SID')
-auth_token = os.environ.get('TWILIO_AUTH_TOKEN')
+class ImageVariantsField(serializers.Field):
+    """
+    User.image_variants as avatar size -> url.
+    """
+
+    def to_representation(self, value):
+        return avatars.variant_urls(value, self.context.get("request"))
 
 
 class UserSerializer(serializers.ModelSerializer):
+    image_variants = ImageVariantsField(read_only=True)
+
     class Meta:
         model = User
-        fields = ["username", "name", "country_code", "mobile_number", "id", "status", "bio", "image"]
+        fields = ["username", "name", "country_code", "mobile_number", "id", "status", "bio", "image", "image_variants"]
 
 
 class ProfileUpdateSerializer(serializers.ModelSerializer):
@@ -32,6 +44,45 @@ class ProfileUpdateSerializer(serializers.ModelSerializer):
         model = User
         fields = ["name", "status", "bio", "image"]
 
+    def update(self, instance, validated_data):
+        if "image" in validated_data:
+            validated_data["image_variants"] = {}
+        instance = super().update(instance, validated_data)
+        if "image" in validated_data:
+            avatars.schedule(instance)
+        return instance
+
+
+class AvatarUploadSerializer(ProfileUpdateSerializer):
+    """
+    Multipart profile image upload. The file is spooled to disk by the upload
+    handler and only its header is checked here, the avatar_variants job decodes it.
+    """
+    image = serializers.FileField()
+
+    class Meta:
+        model = User
+        fields = ["image"]
+
+    def validate_image(self, value):
+        if value.size > settings.AVATAR["MAX_UPLOAD_SIZE"]:
+            raise ValidationError(f"Image is larger than {settings.AVATAR['MAX_UPLOAD_SIZE'] // (1024 * 1024)} MB")
+        extension = avatars.sniff(value)
+        if extension is None:
+            raise ValidationError("Only jpg, jpeg and png images are allowed")
+        value.name = avatars.random_name(extension)
+        return value
+
+
+def get_phone_key(attrs):
+    """
+    Normalized number of a login or verify-otp request, numbers without a key are rejected.
+    """
+    phone_key = normalize_phone(attrs["country_code"], attrs["mobile_number"])
+    if phone_key is None:
+        raise ValidationError({"mobile_number": ["Enter a valid mobile number."]})
+    return phone_key
+
 
 class LoginSerializer(serializers.Serializer):
     country_code = serializers.CharField(max_length=5, validators=[RegexValidator("^(\+?\d{1,3}|\d{1,4})$")])
@@ -41,23 +92,35 @@ class LoginSerializer(serializers.Serializer):
     class Meta:
         fields = ["country_code", "mobile_number", "name"]
 
+    def validate(self, attrs):
+        get_phone_key(attrs)
+        return attrs
+
     def send_otp(self, validated_data):
         random_otp = random.randint(10000, 99999)
-        client = Client(account_sid, auth_token)
-        client.messages.create(
-            from_=os.environ.get('TWILIO_PHONE_NUMBER'),
-            to=validated_data["country_code"] + validated_data["mobile_number"],
-            body=f'Hi, Your otp for verification is ${random_otp}'
-        )
+        to = validated_data["country_code"] + validated_data["mobile_number"]
         name = validated_data.pop("name", "")
-        user, _ = User.objects.get_or_create(
+        User.objects.get_or_create(
             defaults={"username": get_random_string(10), "last_sync": timezone.now(), "name": name},
             **validated_data
         )
-        user.login_otp = random_otp
-        user.save()
+        phone_key = normalize_phone(validated_data["country_code"], validated_data["mobile_number"])
+        otp_store.issue(phone_key, random_otp)
+        sms.send_otp(to, phone_key)
         return
 
+    async def asend_otp(self, validated_data):
+        random_otp = random.randint(10000, 99999)
+        to = validated_data["country_code"] + validated_data["mobile_number"]
+        name = validated_data.pop("name", "")
+        await User.objects.aget_or_create(
+            defaults={"username": get_random_string(10), "last_sync": timezone.now(), "name": name},
+            **validated_data
+        )
+        phone_key = normalize_phone(validated_data["country_code"], validated_data["mobile_number"])
+        await otp_store.aissue(phone_key, random_otp)
+        await sms.asend_otp(to, phone_key)
+
 
 class VerifyOtpSerializer(serializers.Serializer):
     country_code = serializers.CharField(max_length=5, validators=[RegexValidator("^(\+?\d{1,3}|\d{1,4})$")])
@@ -68,21 +131,31 @@ class VerifyOtpSerializer(serializers.Serializer):
         fields = ["country_code", "mobile_number", "otp"]
 
     def validate(self, attrs):
+        phone_key = get_phone_key(attrs)
         user = User.objects.filter(
-            mobile_number=attrs["mobile_number"]
+            phone_key=phone_key
         ).first()
         if not user:
             raise ValidationError("Mobile number is not registered")
-        if user.login_otp != attrs["otp"]:
+        if not otp_store.verify(phone_key, attrs["otp"]):
             raise ValidationError("Invalid OTP")
         attrs["user"] = user
         return attrs
 
-    def verify(self, validated_data):
-        user = validated_data["user"]
-        user.login_otp = ""
-        user.save()
-        return
+    async def avalidate(self, attrs):
+        """
+        validate() on the async ORM, for apps.accounts.async_views.
+        """
+        phone_key = get_phone_key(attrs)
+        user = await User.objects.filter(
+            phone_key=phone_key
+        ).afirst()
+        if not user:
+            raise ValidationError("Mobile number is not registered")
+        if not await otp_store.averify(phone_key, attrs["otp"]):
+            raise ValidationError("Invalid OTP")
+        attrs["user"] = user
+        return attrs
 
 
 class UserContactSerializer(serializers.ModelSerializer):
@@ -92,6 +165,33 @@ class UserContactSerializer(serializers.ModelSerializer):
         fields = ["name", "country_code", "mobile_number", "username"]
 
 
+class SyncCursorSerializer(serializers.Serializer):
+    """
+    Query params of the contact delta sync. The cursor is an opaque signed
+    ``(change_seq, id)`` position, the empty cursor starts from the beginning.
+    """
+    salt = "accounts.sync"
+
+    cursor = serializers.CharField(required=False, allow_blank=True, default="")
+    page_size = serializers.IntegerField(required=False, min_value=1)
+
+    def validate_cursor(self, value):
+        if not value:
+            return (0, 0)
+        try:
+            change_seq, contact_id = signing.loads(value, salt=self.salt)
+            return (int(change_seq), int(contact_id))
+        except (signing.BadSignature, TypeError, ValueError):
+            raise ValidationError("Invalid cursor")
+
+    def validate_page_size(self, value):
+        return min(value, settings.SYNC_MAX_PAGE_SIZE)
+
+    @classmethod
+    def encode(cls, position):
+        return signing.dumps(list(position), salt=cls.salt)
+
+
 class UserContactsSerializer(serializers.Serializer):
     contacts = serializers.ListSerializer(child=UserContactSerializer())
 
@@ -104,34 +204,60 @@ class UserContactsSerializer(serializers.Serializer):
         return attrs
 
     def save(self, **kwargs):
-        mobile_numbers = set(map(lambda x: x["mobile_number"], self.validated_data["contacts"]))
-        existing_mobile_numbers = UserContact.objects.filter(
-            user=self.context["request"].user,
-            mobile_number__in=mobile_numbers
-        ).values_list("mobile_number", flat=True)
-
-        # Filter out existing number
-        new_data = []
-        new_mobile_number_set = set()
-        for data in self.validated_data["contacts"]:
-            if data["mobile_number"] not in existing_mobile_numbers and data["mobile_number"] not in new_mobile_number_set:
-                new_data.append(data)
-                new_mobile_number_set.add(data["mobile_number"])
-        mobile_number_username_map = dict(User.objects.filter(
-            mobile_number__in=map(lambda x: x["mobile_number"], new_data)
-        ).values_list("mobile_number", "username"))
+        new_contacts = create_contacts(self.context["request"].user, self.validated_data["contacts"])
+        return list(filter(lambda item: item.username is not None, new_contacts))
+
 
+def contact_key(phone_key, mobile_number):
+    """
+    What tells contacts of an address book apart: the normalized number, or the
+    number as given when it can't be normalized.
+    """
+    return phone_key if phone_key is not None else (None, mobile_number)
+
+
+def create_contacts(user, contacts):
+    """
+    Insert the contacts ``user`` does not have yet and return them.
+    """
+    for item in contacts:
+        item["phone_key"] = normalize_phone(item["country_code"], item["mobile_number"], user.country_code)
+    phone_keys = {item["phone_key"] for item in contacts if item["phone_key"] is not None}
+    unnormalized = {item["mobile_number"] for item in contacts if item["phone_key"] is None}
+    existing_keys = set(contact_key(*row) for row in UserContact.objects.filter(
+        Q(phone_key__in=phone_keys) | Q(phone_key__isnull=True, mobile_number__in=unnormalized),
+        user=user,
+    ).values_list("phone_key", "mobile_number"))
+
+    # Filter out existing number
+    new_data = []
+    new_keys = set()
+    for data in contacts:
+        key = contact_key(data["phone_key"], data["mobile_number"])
+        if key not in existing_keys and key not in new_keys:
+            new_data.append(data)
+            new_keys.add(key)
+    phone_key_username_map = dict(User.objects.filter(
+        phone_key__in=[data["phone_key"] for data in new_data if data["phone_key"] is not None]
+    ).values_list("phone_key", "username"))
+
+    if not new_data:
+        return []
+    with transaction.atomic():
+        change_seq = ChangeSequence.reserve_contacts([user.id])[user.id]
         new_contacts = list(map(lambda item: UserContact(
-            user=self.context["request"].user,
+            user=user,
             mobile_number=item["mobile_number"],
             country_code=item["country_code"],
+            phone_key=item["phone_key"],
             name=item["name"],
-            username=mobile_number_username_map.get(item["mobile_number"]),
-            active=bool(mobile_number_username_map.get(item["mobile_number"])),
-            updated_at=timezone.now()
+            username=phone_key_username_map.get(item["phone_key"]),
+            active=bool(phone_key_username_map.get(item["phone_key"])),
+            updated_at=timezone.now(),
+            change_seq=change_seq
         ), new_data))
         UserContact.objects.bulk_create(new_contacts)
-        return list(filter(lambda item: item.username is not None, new_contacts))
+    return new_contacts
 
 
 class ChatGroupUpdateSerializer(serializers.ModelSerializer):
@@ -147,11 +273,11 @@ class ChatGroupSerializer(serializers.ModelSerializer):
         queryset=User.objects.all(), default=serializers.CurrentUserDefault()
     )
     creator_mobile_number = serializers.CharField(source="created_by.mobile_number", read_only=True)
-    users_detail = serializers.SerializerMethodField()
 
     class Meta:
         model = ChatGroup
         fields = '__all__'
+        read_only_fields = ('member_count', )
 
     def validate_users(self, values):
         users = User.objects.filter(username__in=values)
@@ -161,16 +287,6 @@ class ChatGroupSerializer(serializers.ModelSerializer):
             raise ValidationError(f"Invalid usernames {invalid_usernames}")
         return users
 
-    def get_users_detail(self, instance):
-        return list(map(
-            lambda group_member: {
-                'name': group_member.user.name,
-                'username': group_member.user.username,
-                'id': group_member.user.id
-            },
-            instance.groupmember_set.all()
-        ))
-
     def create(self, validated_data):
         users = validated_data.pop("users", [])
         instance = super().create(validated_data)
@@ -181,6 +297,12 @@ class ChatGroupSerializer(serializers.ModelSerializer):
                     user=user, group=instance
                 ))
         GroupMember.objects.bulk_create(group_members)
+        # bulk_create sends no post_save
+        user_ids = [member.user_id for member in group_members]
+        accounts_cache.bump_memberships(user_ids)
+        events.publish(user_ids, {"type": events.GROUP_JOINED, "group": instance.id})
+        instance.adjust_member_count(len(group_members))
+        instance.member_count = len(group_members)
         return instance
 
 
@@ -188,3 +310,65 @@ class GroupMemberSerializer(serializers.ModelSerializer):
     class Meta:
         model = GroupMember
         fields = '__all__'
+
+
+class GroupMemberDetailSerializer(serializers.ModelSerializer):
+    name = serializers.CharField(source="user.name", read_only=True)
+    username = serializers.CharField(source="user.username", read_only=True)
+    id = serializers.IntegerField(source="user_id", read_only=True)
+
+    class Meta:
+        model = GroupMember
+        fields = ["name", "username", "id", "is_admin"]
+
+
+class GroupMembersSerializer(serializers.Serializer):
+    """
+    Bulk membership change of the group in the context. Usernames are resolved
+    and checked against the current members with one query each, so the number
+    of queries does not depend on how many users are passed.
+    """
+    usernames = serializers.ListField(
+        child=serializers.CharField(max_length=150), allow_empty=False, max_length=settings.GROUP_MEMBERS_BULK_LIMIT
+    )
+
+    class Meta:
+        fields = ["usernames"]
+
+    def validate_usernames(self, values):
+        usernames = list(dict.fromkeys(values))
+        user_ids = dict(User.objects.filter(username__in=usernames).values_list("username", "id"))
+        member_ids = set(GroupMember.objects.filter(
+            group=self.context["group"], user_id__in=user_ids.values()
+        ).values_list("user_id", flat=True))
+        result = {"members": [], "non_members": [], "invalid": [], "user_ids": user_ids}
+        for username in usernames:
+            if username not in user_ids:
+                result["invalid"].append(username)
+            elif user_ids[username] in member_ids:
+                result["members"].append(username)
+            else:
+                result["non_members"].append(username)
+        return result
+
+    def add(self):
+        group = self.context["group"]
+        usernames = self.validated_data["usernames"]
+        GroupMember.objects.bulk_create([
+            GroupMember(group=group, user_id=usernames["user_ids"][username]) for username in usernames["non_members"]
+        ], ignore_conflicts=True)
+        group.refresh_member_count()
+        # bulk_create sends no post_save
+        user_ids = [usernames["user_ids"][username] for username in usernames["non_members"]]
+        accounts_cache.bump_memberships(user_ids)
+        events.publish(user_ids, {"type": events.GROUP_JOINED, "group": group.id})
+        return {"added": usernames["non_members"], "skipped": usernames["members"], "invalid": usernames["invalid"]}
+
+    def remove(self):
+        group = self.context["group"]
+        usernames = self.validated_data["usernames"]
+        GroupMember.objects.filter(
+            group=group, user_id__in=[usernames["user_ids"][username] for username in usernames["members"]]
+        ).delete()
+        group.refresh_member_count()
+        return {"removed": usernames["members"], "skipped": usernames["non_members"], "invalid": usernames["invalid"]}
@@ -0,0 +1,97 @@
+from django.contrib.auth import get_user_model
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.dispatch import receiver
+from rest_framework.authtoken.models import Token
+
+from apps.accounts import cache as accounts_cache
+from apps.accounts import events
+from apps.accounts.authentication import token_cache
+from apps.accounts.models import ChatGroup, GroupMember, MediaFile
+
+
+User = get_user_model()
+
+
+def field_changed(instance, name, created, update_fields):
+    """
+    Whether saving an existing user changed ``name`` from the value it was loaded
+    with, see User.TRACKED_FIELDS. Users that were not loaded count as changed.
+    """
+    if created or (update_fields is not None and name not in update_fields):
+        return False
+    loaded = getattr(instance, "_loaded_values", None)
+    return loaded is None or loaded.get(name) != getattr(instance, name)
+
+
+@receiver(post_save, sender=User)
+def evict_user_token(sender, instance, created, update_fields=None, **kwargs):
+    """
+    Only is_active of the cached users matters to authentication. Deleting a
+    user deletes its tokens, evict_token handles them.
+    """
+    if not field_changed(instance, "is_active", created, update_fields):
+        return
+    for key in Token.objects.filter(user_id=instance.id).values_list("key", flat=True):
+        token_cache.delete(key)
+
+
+@receiver(post_delete, sender=Token)
+def evict_token(sender, instance, **kwargs):
+    token_cache.delete(instance.key)
+
+
+@receiver(post_save, sender=User)
+def bump_user_version(sender, instance, created, update_fields=None, **kwargs):
+    accounts_cache.bump_users([instance.id])
+    # Groups show their creator's mobile number, new users have no groups
+    if field_changed(instance, "mobile_number", created, update_fields):
+        accounts_cache.bump_groups(list(ChatGroup.objects.filter(created_by=instance).values_list("id", flat=True)))
+
+
+@receiver(post_save, sender=ChatGroup)
+@receiver(post_delete, sender=ChatGroup)
+def bump_group_version(sender, instance, **kwargs):
+    accounts_cache.bump_groups([instance.id])
+
+
+@receiver(post_save, sender=GroupMember)
+@receiver(post_delete, sender=GroupMember)
+def bump_member_version(sender, instance, **kwargs):
+    accounts_cache.bump_memberships([instance.user_id])
+
+
+@receiver(post_save, sender=GroupMember)
+def publish_group_joined(sender, instance, created, **kwargs):
+    if created:
+        events.publish([instance.user_id], {"type": events.GROUP_JOINED, "group": instance.group_id})
+
+
+@receiver(post_delete, sender=GroupMember)
+def publish_group_left(sender, instance, **kwargs):
+    events.publish([instance.user_id], {"type": events.GROUP_LEFT, "group": instance.group_id})
+
+
+@receiver(pre_save, sender=User)
+def track_media_references(sender, instance, update_fields=None, **kwargs):
+    instance._old_media_names = None
+    if update_fields is not None and not {"image", "image_variants"} & set(update_fields):
+        return
+    old = User.objects.filter(pk=instance.pk).values("image", "image_variants").first() if instance.pk else None
+    instance._old_media_names = MediaFile.names_of(old["image"], old["image_variants"]) if old else set()
+
+
+@receiver(post_save, sender=User)
+def count_media_references(sender, instance, **kwargs):
+    old = getattr(instance, "_old_media_names", None)
+    if old is None:
+        return
+    instance._old_media_names = None
+    # The image is only stored, and named, while the model saves
+    new = MediaFile.names_of(instance.image, instance.image_variants)
+    MediaFile.adjust(new - old, 1)
+    MediaFile.adjust(old - new, -1)
+
+
+@receiver(post_delete, sender=User)
+def release_media_references(sender, instance, **kwargs):
+    MediaFile.adjust(MediaFile.names_of(instance.image, instance.image_variants), -1)
@@ -0,0 +1,84 @@
+import functools
+import logging
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from apps.accounts import jobs
+
+
+logger = logging.getLogger(__name__)
+
+
+class BaseSmsBackend:
+
+    def send(self, to, body):
+        raise NotImplementedError
+
+
+class TwilioBackend(BaseSmsBackend):
+    """
+    Sends through Twilio with one client per process, so the HTTPS
+    connection pool is reused between messages.
+    """
+
+    def __init__(self):
+        from twilio.http.http_client import TwilioHttpClient
+        from twilio.rest import Client
+
+        self.client = Client(
+            settings.TWILIO_ACCOUNT_SID,
+            settings.TWILIO_AUTH_TOKEN,
+            http_client=TwilioHttpClient(pool_connections=True, timeout=settings.SMS_TIMEOUT),
+        )
+
+    def send(self, to, body):
+        self.client.messages.create(from_=settings.TWILIO_PHONE_NUMBER, to=to, body=body)
+
+
+# Messages sent through LocMemBackend, for tests
+outbox = []
+
+
+class LocMemBackend(BaseSmsBackend):
+
+    def send(self, to, body):
+        outbox.append({"to": to, "body": body})
+
+
+class ConsoleBackend(BaseSmsBackend):
+
+    def send(self, to, body):
+        logger.info("SMS to %s: %s", to, body)
+
+
+@functools.lru_cache(maxsize=None)
+def _load_backend(path):
+    return import_string(path)()
+
+
+def get_backend():
+    return _load_backend(settings.SMS_BACKEND)
+
+
+def send_sms(to, body):
+    """
+    Queue an SMS, the send_sms job delivers it with retries.
+    """
+    return jobs.enqueue("send_sms", {"to": to, "body": body}, max_attempts=settings.SMS_MAX_ATTEMPTS)
+
+
+async def asend_sms(to, body):
+    return await jobs.aenqueue("send_sms", {"to": to, "body": body}, max_attempts=settings.SMS_MAX_ATTEMPTS)
+
+
+def send_otp(to, phone_key):
+    """
+    Queue the SMS of the OTP issued to ``phone_key``. The send_otp job reads the code
+    from the OTP store, it is not written to the job table.
+    """
+    return jobs.enqueue("send_otp", {"to": to, "phone_key": phone_key}, max_attempts=settings.SMS_MAX_ATTEMPTS)
+
+
+async def asend_otp(to, phone_key):
+    return await jobs.aenqueue("send_otp", {"to": to, "phone_key": phone_key}, max_attempts=settings.SMS_MAX_ATTEMPTS)
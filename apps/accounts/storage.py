@@ -0,0 +1,39 @@
+import hashlib
+import os
+
+from django.core.files.storage import FileSystemStorage
+from django.utils.deconstruct import deconstructible
+
+
+@deconstructible
+class ContentAddressedStorage(FileSystemStorage):
+    """
+    Names every file by the SHA-256 of its content, in the directory it was
+    saved to: ``user/profile_photo/ab/ab12...ef.jpg``.
+
+    Saving content that is already stored returns the existing name, so identical
+    uploads share one file and one url. Files are never overwritten, their urls
+    can be cached forever. Unreferenced files are removed by the gc_media command,
+    see apps.accounts.models.MediaFile.
+    """
+
+    def content_name(self, name, content):
+        hasher = hashlib.sha256()
+        for chunk in content.chunks():
+            hasher.update(chunk)
+        content.seek(0)
+        digest = hasher.hexdigest()
+        directory, basename = os.path.split(name)
+        extension = os.path.splitext(basename)[1].lower()
+        return os.path.join(directory, digest[:2], digest + extension).replace("\\", "/")
+
+    def _save(self, name, content):
+        name = self.content_name(name, content)
+        if self.exists(name):
+            # Freshen the file, gc_media leaves recently touched files alone
+            os.utime(self.path(name))
+            return name
+        return super()._save(name, content)
+
+
+image_storage = ContentAddressedStorage()
@@ -0,0 +1,190 @@
+import codecs
+import itertools
+import json
+import re
+
+from rest_framework.exceptions import ParseError
+
+from apps.accounts.renderers import msgpack
+
+
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+NUMBER_TAIL = re.compile(r'[0-9.eE+-]*')
+
+DEFAULT_READ_SIZE = 64 * 1024
+# A single contact is a handful of short strings, anything bigger is garbage.
+DEFAULT_MAX_ITEM_SIZE = 64 * 1024
+
+
+class _JSONBuffer:
+    """
+    Sliding text window over a byte stream.
+    Only the unparsed tail of the body is kept in memory.
+    """
+
+    decoder = json.JSONDecoder()
+
+    def __init__(self, stream, read_size, max_item_size):
+        self.stream = stream
+        self.read_size = read_size
+        self.max_item_size = max_item_size
+        self.text_decoder = codecs.getincrementaldecoder("utf-8")()
+        self.text = ""
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        if self.eof:
+            return False
+        data = self.stream.read(self.read_size)
+        try:
+            decoded = self.text_decoder.decode(data or b"", final=not data)
+        except UnicodeDecodeError as exc:
+            raise ParseError(f"JSON parse error - {exc}")
+        self.eof = not data
+        self.text = self.text[self.pos:] + decoded
+        self.pos = 0
+        if len(self.text) > self.max_item_size + self.read_size:
+            raise ParseError("JSON parse error - item is too large")
+        return not self.eof
+
+    def peek(self):
+        while True:
+            self.pos = WHITESPACE.match(self.text, self.pos).end()
+            if self.pos < len(self.text):
+                return self.text[self.pos]
+            if not self.fill():
+                raise ParseError("JSON parse error - unexpected end of input")
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ParseError(f"JSON parse error - expected '{char}' at offset {self.pos}")
+        self.pos += 1
+
+    def consume(self, char):
+        if self.peek() == char:
+            self.pos += 1
+            return True
+        return False
+
+    def end(self):
+        while True:
+            self.pos = WHITESPACE.match(self.text, self.pos).end()
+            if self.pos < len(self.text):
+                raise ParseError(f"JSON parse error - extra data at offset {self.pos}")
+            if not self.fill():
+                return
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.text, self.pos)
+            except json.JSONDecodeError as exc:
+                if self.fill():
+                    continue
+                raise ParseError(f"JSON parse error - {exc}")
+            # A number may continue in the next read, e.g. "-4." of "-4.5e3" decodes as -4,
+            # decode it again once more data is in.
+            if self.incomplete(value, end) and self.fill():
+                continue
+            self.pos = end
+            return value
+
+    def incomplete(self, value, end):
+        if end == len(self.text):
+            return True
+        number = isinstance(value, (int, float)) and not isinstance(value, bool)
+        return number and NUMBER_TAIL.match(self.text, end).end() == len(self.text)
+
+
+def _iter_array(buffer):
+    buffer.expect("[")
+    if buffer.consume("]"):
+        return
+    while True:
+        yield buffer.value()
+        if buffer.consume(","):
+            continue
+        buffer.expect("]")
+        return
+
+
+def iter_json_array(stream, key=None, read_size=DEFAULT_READ_SIZE, max_item_size=DEFAULT_MAX_ITEM_SIZE):
+    """
+    Yield the items of a JSON array one at a time while reading ``stream``.
+
+    With ``key`` the body must be an object and the array is read from that key,
+    e.g. ``{"contacts": [...]}``. Other keys are decoded and discarded.
+    """
+    buffer = _JSONBuffer(stream, read_size, max_item_size)
+    if key is None:
+        yield from _iter_array(buffer)
+        buffer.end()
+        return
+
+    found = False
+    buffer.expect("{")
+    if not buffer.consume("}"):
+        while True:
+            name = buffer.value()
+            if not isinstance(name, str):
+                raise ParseError("JSON parse error - object keys must be strings")
+            buffer.expect(":")
+            if name == key and not found:
+                found = True
+                yield from _iter_array(buffer)
+            else:
+                buffer.value()
+            if buffer.consume(","):
+                continue
+            buffer.expect("}")
+            break
+    buffer.end()
+    if not found:
+        raise ParseError(f'"{key}" is required')
+
+
+def iter_msgpack_array(stream, key=None, read_size=DEFAULT_READ_SIZE, max_item_size=DEFAULT_MAX_ITEM_SIZE):
+    """
+    iter_json_array for a MessagePack body.
+    """
+    if msgpack is None:
+        raise ParseError("MessagePack is not supported")
+    unpacker = msgpack.Unpacker(
+        stream, raw=False, read_size=read_size, max_buffer_size=max_item_size + read_size, strict_map_key=False
+    )
+    found = False
+    try:
+        if key is None:
+            for _ in range(unpacker.read_array_header()):
+                yield unpacker.unpack()
+        else:
+            for _ in range(unpacker.read_map_header()):
+                name = unpacker.unpack()
+                if name == key and not found:
+                    found = True
+                    for _ in range(unpacker.read_array_header()):
+                        yield unpacker.unpack()
+                else:
+                    unpacker.skip()
+        # Like msgpack.unpackb(), the body is a single value
+        try:
+            unpacker.skip()
+        except msgpack.OutOfData:
+            pass
+        else:
+            raise ParseError("MessagePack parse error - extra data")
+    except (ValueError, TypeError, msgpack.UnpackException) as exc:
+        raise ParseError(f"MessagePack parse error - {exc}")
+    if key is not None and not found:
+        raise ParseError(f'"{key}" is required')
+
+
+def iter_chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
@@ -0,0 +1,92 @@
+import logging
+from collections import defaultdict
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models import Case, Q, Value, When
+from django.utils import timezone
+
+from apps.accounts import avatars, events, sms
+from apps.accounts.jobs import register
+from apps.accounts.models import UserContact, ChangeSequence
+from apps.accounts.otp import otp_store
+
+
+logger = logging.getLogger(__name__)
+
+User = get_user_model()
+
+
+@register("activate_contacts")
+def activate_contacts(user_id):
+    """
+    Link every contact entry holding the user's number to the user.
+    Runs in batches so no single transaction holds locks on all of them.
+    """
+    user = User.objects.only("username", "phone_key").get(id=user_id)
+    if not user.phone_key:
+        return
+    pending = UserContact.objects.filter(phone_key=user.phone_key).filter(
+        Q(active=False) | ~Q(username=user.username)
+    )
+    while True:
+        rows = list(pending.values_list("id", "user_id")[:settings.CONTACT_ACTIVATION_BATCH_SIZE])
+        if not rows:
+            return
+        with transaction.atomic():
+            # Each owner's contacts take the next value of the owner's counter
+            change_seqs = ChangeSequence.reserve_contacts({owner_id for _, owner_id in rows})
+            UserContact.objects.filter(id__in=[contact_id for contact_id, _ in rows]).update(
+                username=user.username,
+                updated_at=timezone.now(),
+                active=True,
+                change_seq=Case(*(When(user_id=owner_id, then=Value(seq)) for owner_id, seq in change_seqs.items()))
+            )
+            # Tell the owners of the contacts to sync
+            owners = defaultdict(list)
+            for owner_id, change_seq in change_seqs.items():
+                owners[change_seq].append(owner_id)
+            for change_seq, owner_ids in owners.items():
+                events.publish(
+                    owner_ids, {"type": events.CONTACT_JOINED, "username": user.username, "change_seq": change_seq}
+                )
+
+
+@register("send_sms")
+def send_sms(to, body):
+    sms.get_backend().send(to, body)
+
+
+@register("send_otp")
+def send_otp(to, phone_key):
+    """
+    Text the OTP issued to ``phone_key``. A code that expired or was used while the
+    job waited is not sent.
+    """
+    code = otp_store.get(phone_key)
+    if code is None:
+        logger.info("Dropping the OTP SMS to %s, the code expired", to)
+        return
+    sms.get_backend().send(to, f"Hi, Your otp for verification is ${code}")
+
+
+@register("avatar_variants")
+def avatar_variants(user_id, name):
+    """
+    Resize the uploaded profile image. A corrupt image is dropped from the profile.
+    """
+    try:
+        variants = avatars.existing_variants(name) or avatars.generate_variants(name)
+    except avatars.InvalidImage as exc:
+        logger.warning("Dropping invalid profile image %s of user %s: %s", name, user_id, exc)
+        variants = None
+    with transaction.atomic():
+        user = User.objects.select_for_update().filter(id=user_id, image=name).first()
+        if user is None:
+            # The image was replaced meanwhile
+            return
+        if variants is None:
+            user.image = ""
+        user.image_variants = variants or {}
+        user.save(update_fields=["image", "image_variants"])
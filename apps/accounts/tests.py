@@ -1,3 +1,2066 @@
-from django.test import TestCase
+import asyncio
+import base64
+import datetime
+import decimal
+import importlib
+import io
+import json
+import os
+import re
+import shutil
+import tempfile
+import uuid
+import subprocess
+import sys
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from django.apps import apps
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.db import connection, connections
+from django.db.models import F
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, modify_settings, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.utils.translation import gettext_lazy
+from django.urls import include, path
+from PIL import Image
+from rest_framework.authtoken.models import Token
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
+from rest_framework.utils.serializer_helpers import ReturnDict, ReturnList
+from rest_framework.test import APIRequestFactory
+
+from apps.accounts import async_views, avatars, events, fast_serializers, jobs, metrics, seeding, sms, tasks, throttling
+from apps.accounts import cache as accounts_cache
+from apps.accounts.parsers import FastJSONParser
+from apps.accounts.renderers import FastJSONRenderer, msgpack
+from apps.accounts.streaming import iter_json_array, iter_msgpack_array
+from apps.accounts.checks import check_counter_caches, check_events_broker, check_metrics_token
+from apps.accounts.authentication import token_cache
+from apps.accounts.benchmark import Benchmark, compare
+from apps.accounts.otp import OtpStore, otp_store
+from apps.accounts.utils import normalize_phone
+from apps.accounts.models import UserContact, ChatGroup, GroupMember, ChangeSequence, Job, MediaFile
+from apps.accounts.serializers import UserSerializer, UserContactSerializer, ChatGroupSerializer
+
+User = get_user_model()
+
+# Tests must not touch the developer's shared FileBasedCache, they clear the caches they use
+LOCMEM_CACHES = {
+    "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache", "LOCATION": "test-default"},
+    "shared": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache", "LOCATION": "test-shared"},
+}
+
+
+def make_user(index, **kwargs):
+    fields = dict(
+        username=f"user{index}", name=f"User {index}", country_code="+91", mobile_number=str(9000000000 + index)
+    )
+    return User.objects.create(**{**fields, **kwargs})
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class FastSerializerEquivalenceTests(TestCase):
+    """
+    The values() based serializers must render exactly what the ModelSerializers do.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = [
+            make_user(
+                1, status="busy", bio="hello", image="user/profile_photo/a.png",
+                image_variants={"64": "user/profile_photo/variants/a_64.png"}
+            ),
+            make_user(2),
+            make_user(3, name="", bio="ünïcode"),
+        ]
+        UserContact.objects.bulk_create([
+            UserContact(user=cls.users[0], name="Two", country_code="+91", mobile_number="9000000002", username="user2"),
+            UserContact(user=cls.users[0], name="Three", country_code="", mobile_number="9000000003", username="user3"),
+            UserContact(user=cls.users[0], name="Nobody", country_code="+1", mobile_number="5550000000"),
+        ])
+        groups = [
+            ChatGroup.objects.create(name="Free", created_by=cls.users[0], member_count=2),
+            ChatGroup.objects.create(name="Paid", created_by=cls.users[1], premium=True, amount=100),
+        ]
+        GroupMember.objects.create(group=groups[0], user=cls.users[0], is_admin=True)
+        GroupMember.objects.create(group=groups[0], user=cls.users[1])
+
+    def setUp(self):
+        self.request = APIRequestFactory().get("/")
+
+    def assertSameOutput(self, fast, slow):
+        self.assertEqual(json.dumps(fast), json.dumps(slow))
+
+    def test_user(self):
+        queryset = User.objects.order_by("id")
+        for context in ({}, {"request": self.request}):
+            self.assertSameOutput(
+                fast_serializers.UserFastSerializer(context=context).serialize_queryset(queryset),
+                UserSerializer(queryset, many=True, context=context).data,
+            )
+
+    def test_sync_contact(self):
+        queryset = UserContact.objects.order_by("id")
+        self.assertSameOutput(
+            fast_serializers.SyncContactFastSerializer(context={"request": self.request}).serialize_queryset(queryset),
+            UserSerializer(list(queryset), many=True, context={"request": self.request}).data,
+        )
+
+    def test_user_contact(self):
+        queryset = UserContact.objects.order_by("id")
+        serializer = fast_serializers.UserContactFastSerializer()
+        self.assertSameOutput(serializer.serialize_queryset(queryset), UserContactSerializer(queryset, many=True).data)
+        self.assertSameOutput(serializer.serialize_objects(queryset), UserContactSerializer(queryset, many=True).data)
+
+    def test_chat_group(self):
+        queryset = ChatGroup.objects.order_by("id")
+        self.assertSameOutput(
+            fast_serializers.ChatGroupFastSerializer().serialize_queryset(queryset),
+            ChatGroupSerializer(queryset, many=True).data,
+        )
+
+
+class MediaServingTests(SimpleTestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        os.makedirs(os.path.join(self.root, "media", "user"))
+        buffer = io.BytesIO()
+        Image.new("RGB", (300, 200), "red").save(buffer, "JPEG")
+        self.data = buffer.getvalue()
+        with open(os.path.join(self.root, "media", "user", "a.jpg"), "wb") as file:
+            file.write(self.data)
+        settings = override_settings(
+            MEDIA_ROOT=os.path.join(self.root, "media"),
+            MEDIA_SERVING={
+                "CACHE_ROOT": os.path.join(self.root, "cache"),
+                "MAX_AGE": 60,
+                "SENDFILE": None,
+                "ACCEL_REDIRECT_LOCATIONS": {os.path.join(self.root, "media"): "/internal/media/"},
+            },
+        )
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def test_full_and_conditional(self):
+        response = self.client.get("/media/user/a.jpg")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b"".join(response.streaming_content), self.data)
+        self.assertEqual(response["Content-Type"], "image/jpeg")
+        self.assertIn("immutable", response["Cache-Control"])
+        response = self.client.get("/media/user/a.jpg", HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(response.status_code, 304)
+
+    def test_range(self):
+        response = self.client.get("/media/user/a.jpg", HTTP_RANGE="bytes=10-19")
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b"".join(response.streaming_content), self.data[10:20])
+        self.assertEqual(response["Content-Range"], f"bytes 10-19/{len(self.data)}")
+        response = self.client.get("/media/user/a.jpg", HTTP_RANGE="bytes=-5")
+        self.assertEqual(b"".join(response.streaming_content), self.data[-5:])
+        response = self.client.get("/media/user/a.jpg", HTTP_RANGE=f"bytes={len(self.data)}-")
+        self.assertEqual(response.status_code, 416)
+        response = self.client.get("/media/user/a.jpg", HTTP_RANGE="bytes=0-1", HTTP_IF_RANGE='"stale"')
+        self.assertEqual(response.status_code, 200)
+
+    def test_variant(self):
+        response = self.client.get("/media/user/a.jpg?size=64")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Image.open(io.BytesIO(b"".join(response.streaming_content))).size, (64, 64))
+        self.assertTrue(os.path.isfile(os.path.join(self.root, "cache", "64", "user", "a.jpg")))
+        self.assertEqual(self.client.get("/media/user/a.jpg?size=65").status_code, 404)
+        self.assertEqual(self.client.get("/media/../a.jpg").status_code, 404)
+
+    def test_sendfile(self):
+        with self.settings(MEDIA_SERVING={
+            "CACHE_ROOT": os.path.join(self.root, "cache"),
+            "MAX_AGE": 60,
+            "SENDFILE": "x-accel-redirect",
+            "ACCEL_REDIRECT_LOCATIONS": {os.path.join(self.root, "media"): "/internal/media/"},
+        }):
+            response = self.client.get("/media/user/a.jpg")
+        self.assertEqual(response["X-Accel-Redirect"], "/internal/media/user/a.jpg")
+        self.assertEqual(response.content, b"")
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class SeedingTests(TestCase):
+
+    def test_resume(self):
+        scale = seeding.Scale(users=60, contacts_per_user=10, groups=8, members_per_group=6)
+        seeding.seed(scale, seed=3)
+        contacts = list(UserContact.objects.order_by("id").values_list("id", "user_id", "phone_key", "username"))
+        members = list(GroupMember.objects.order_by("id").values_list("id", "group_id", "user_id", "is_admin"))
+        UserContact.objects.filter(id__gt=len(contacts) // 2).delete()
+        GroupMember.objects.filter(group_id__gt=4).delete()
+        ChatGroup.objects.filter(id__gt=4).delete()
+
+        seeding.seed(scale, seed=3, resume=True)
+        self.assertEqual(
+            list(UserContact.objects.order_by("id").values_list("id", "user_id", "phone_key", "username")), contacts
+        )
+        self.assertEqual(
+            list(GroupMember.objects.order_by("id").values_list("id", "group_id", "user_id", "is_admin")), members
+        )
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class BenchmarkTests(TestCase):
+    """
+    Every scenario of the benchmark runs against a small dataset without errors.
+    """
+
+    def test_scenarios(self):
+        scale = seeding.Scale(users=50, contacts_per_user=5, groups=5, members_per_group=5)
+        seeding.seed(scale)
+        results = Benchmark(scale, requests=2).run()
+        self.assertEqual(results["dataset"]["users"], 50)
+        self.assertEqual(results["dataset"]["members"], GroupMember.objects.count())
+        for name, result in results["scenarios"].items():
+            self.assertEqual(result["errors"], 0, name)
+            self.assertGreater(result["queries_per_request"], 0, name)
+        self.assertEqual(compare(results, results), [])
+
+
+TRANSACTION_STATEMENTS = ("SAVEPOINT", "RELEASE SAVEPOINT", "ROLLBACK TO SAVEPOINT")
+
+
+def sequential_scans(sql):
+    """
+    Tables the database plans to read in full to run ``sql``.
+    """
+    with connection.cursor() as cursor:
+        if connection.vendor == "postgresql":
+            # Test tables are tiny, make the planner scan them only when no index applies
+            cursor.execute("SET LOCAL enable_seqscan = off")
+            cursor.execute(f"EXPLAIN {sql}")
+            return re.findall(r"Seq Scan on (\w+)", "\n".join(row[0] for row in cursor.fetchall()))
+        cursor.execute(f"EXPLAIN QUERY PLAN {sql}")
+        # "SCAN <table> USING INDEX <index>" walks an index for the ORDER BY, the other scans read
+        # the whole table or index
+        return [
+            match.group(1) for row in cursor.fetchall()
+            for match in [re.match(r"SCAN (?:TABLE )?(\w+)(?: USING COVERING INDEX \w+)?$", row[-1])] if match
+        ]
+
+
+@override_settings(JOBS_EAGER=False, SMS_BACKEND="apps.accounts.sms.LocMemBackend", CACHES=LOCMEM_CACHES)
+class QueryBudgetTests(TestCase):
+    """
+    Every endpoint runs a fixed number of queries however many contacts, groups
+    and members there are, and none of its queries scans a whole table.
+
+    Requests are sent with cold caches, at two data sizes. When a change adds or
+    removes queries on purpose, update QUERIES.
+    """
+    QUERIES = {
+        "login": 3,
+        "verify-otp": 4,
+        "add-contacts": 7,
+        "users/sync": 3,
+        "users/me": 2,
+        "users/retrieve": 3,
+        "groups/list": 2,
+        "groups/retrieve": 3,
+        "groups/mine": 3,
+        "groups/members": 3,
+        "groups/create": 6,
+        "groups/update": 3,
+        "groups/add_member": 8,
+        "groups/add_members": 6,
+        "groups/remove_members": 7,
+        "groups/join": 7,
+        "groups/exit": 5,
+    }
+    SIZES = (2, 30)
+
+    def setUp(self):
+        self.count = 0
+        self.user = self.new_user()
+        # The counter is created by the first upload, every measured upload finds it
+        ChangeSequence.reserve_contacts([self.user.id])
+        self.group = ChatGroup.objects.create(name="Group", created_by=self.user, member_count=1)
+        GroupMember.objects.create(group=self.group, user=self.user, is_admin=True)
+        self.grown = []
+
+    def new_user(self):
+        self.count += 1
+        return make_user(self.count)
+
+    def auth(self, user):
+        return {"HTTP_AUTH": f"Token {Token.objects.get_or_create(user=user)[0].key}"}
+
+    def grow(self, size):
+        """
+        Add ``size`` users that are contacts of the user and members of the group, and ``size`` groups of the user.
+        """
+        users = [self.new_user() for _ in range(size)]
+        UserContact.objects.bulk_create([
+            UserContact(
+                user=self.user, username=user.username, name=user.name, country_code=user.country_code,
+                mobile_number=user.mobile_number, phone_key=user.phone_key, active=True, change_seq=self.count
+            ) for user in users
+        ])
+        GroupMember.objects.bulk_create([GroupMember(group=self.group, user=user) for user in users])
+        ChatGroup.objects.filter(id=self.group.id).update(member_count=F("member_count") + size)
+        groups = ChatGroup.objects.bulk_create([
+            ChatGroup(
+                name=f"Group {self.count}-{index}", unique_id=f"{self.count}-{index}", created_by=user, member_count=1
+            )
+            for index, user in enumerate(users)
+        ])
+        GroupMember.objects.bulk_create([GroupMember(group=group, user=self.user) for group in groups])
+        self.grown = users
+
+    def check(self, name, prepare):
+        """
+        ``prepare(size)`` sets up a request, untimed, and returns the function sending it.
+        """
+        counts = []
+        for size in self.SIZES:
+            self.grow(size)
+            for cache in caches.all():
+                cache.clear()
+            token_cache.clear()
+            send = prepare(size)
+            with CaptureQueriesContext(connection) as captured:
+                response = send()
+            self.assertLess(response.status_code, 400, response.content)
+            # Savepoints stand for the transactions the requests open outside of tests
+            queries = [query["sql"] for query in captured if not query["sql"].startswith(TRANSACTION_STATEMENTS)]
+            counts.append(len(queries))
+            for sql in queries:
+                if sql.startswith("SELECT"):
+                    self.assertEqual(sequential_scans(sql), [], sql)
+        self.assertEqual(counts, [self.QUERIES[name]] * len(self.SIZES), name)
+
+    def post(self, path, data, user=None, **extra):
+        if user is not None:
+            extra.update(self.auth(user))
+        return lambda: self.client.post(path, json.dumps(data), "application/json", **extra)
+
+    def get(self, path, user):
+        headers = self.auth(user)
+        return lambda: self.client.get(path, **headers)
+
+    def test_sequential_scan_detected(self):
+        self.assertEqual(sequential_scans("SELECT id FROM accounts_user WHERE bio = 'x'"), ["accounts_user"])
+        self.assertEqual(sequential_scans("SELECT id FROM accounts_user WHERE phone_key = 'x'"), [])
+
+    def test_login(self):
+        def prepare(size):
+            return self.post("/accounts/login/", {"country_code": "+91", "mobile_number": str(8000000000 + size)})
+        self.check("login", prepare)
+
+    def test_verify_otp(self):
+        def prepare(size):
+            user = self.grown[0]
+            otp_store.issue(normalize_phone(user.country_code, user.mobile_number), "12345")
+            return self.post(
+                "/accounts/verify-otp/",
+                {"country_code": user.country_code, "mobile_number": user.mobile_number, "otp": "12345"}
+            )
+        self.check("verify-otp", prepare)
+
+    def test_add_contacts(self):
+        def prepare(size):
+            # Half new, half already in the address book
+            contacts = [
+                {"name": f"New {index}", "country_code": "+91", "mobile_number": str(8000000000 + size * 100 + index)}
+                for index in range(size)
+            ] + [
+                {"name": user.name, "country_code": "+91", "mobile_number": user.mobile_number} for user in self.grown
+            ]
+            return self.post("/accounts/add-contacts/", {"contacts": contacts}, self.user)
+        self.check("add-contacts", prepare)
+
+    def test_users_sync(self):
+        self.check("users/sync", lambda size: self.get("/accounts/users/sync/", self.user))
+
+    def test_users_me(self):
+        self.check("users/me", lambda size: self.get("/accounts/users/me/", self.user))
+
+    def test_users_retrieve(self):
+        self.check(
+            "users/retrieve", lambda size: self.get(f"/accounts/users/{self.grown[0].mobile_number}/", self.user)
+        )
+
+    def test_groups_list(self):
+        self.check("groups/list", lambda size: self.get("/accounts/groups/", self.user))
+
+    def test_groups_retrieve(self):
+        self.check("groups/retrieve", lambda size: self.get(f"/accounts/groups/{self.group.unique_id}/", self.user))
+
+    def test_groups_mine(self):
+        self.check("groups/mine", lambda size: self.get("/accounts/groups/mine/", self.user))
+
+    def test_groups_members(self):
+        self.check(
+            "groups/members", lambda size: self.get(f"/accounts/groups/{self.group.unique_id}/members/", self.user)
+        )
+
+    def test_groups_create(self):
+        def prepare(size):
+            return self.post(
+                "/accounts/groups/", {"name": "New", "users": [user.username for user in self.grown]}, self.user
+            )
+        self.check("groups/create", prepare)
+
+    def test_groups_update(self):
+        def prepare(size):
+            headers = self.auth(self.user)
+            return lambda: self.client.patch(
+                f"/accounts/groups/{self.group.unique_id}/", json.dumps({"name": "Renamed"}), "application/json",
+                **headers
+            )
+        self.check("groups/update", prepare)
+
+    def test_groups_add_member(self):
+        def prepare(size):
+            return self.post(
+                f"/accounts/groups/{self.group.unique_id}/add_member/", {"username": self.new_user().username}, self.user
+            )
+        self.check("groups/add_member", prepare)
+
+    def test_groups_add_members(self):
+        def prepare(size):
+            usernames = [self.new_user().username for _ in range(size)]
+            return self.post(f"/accounts/groups/{self.group.unique_id}/add_members/", {"usernames": usernames}, self.user)
+        self.check("groups/add_members", prepare)
+
+    def test_groups_remove_members(self):
+        def prepare(size):
+            usernames = [user.username for user in self.grown]
+            return self.post(
+                f"/accounts/groups/{self.group.unique_id}/remove_members/", {"usernames": usernames}, self.user
+            )
+        self.check("groups/remove_members", prepare)
+
+    def test_groups_join(self):
+        def prepare(size):
+            return self.post(f"/accounts/groups/{self.group.unique_id}/join/", {}, self.new_user())
+        self.check("groups/join", prepare)
+
+    def test_groups_exit(self):
+        def prepare(size):
+            return self.post(f"/accounts/groups/{self.group.unique_id}/exit/", {}, self.grown[0])
+        self.check("groups/exit", prepare)
+
+
+@override_settings(
+    READ_REPLICAS={"ALIASES": ["replica"], "STICKY_SECONDS": 60, "CACHE": "default"}, CACHES=LOCMEM_CACHES
+)
+class ReplicaRoutingTests(TransactionTestCase):
+    """
+    The replica alias mirrors the default test database, queries are told apart by connection.
+    """
+    databases = {"default", "replica"}
+
+    def setUp(self):
+        self.user = make_user(1)
+        self.headers = {"HTTP_AUTH": f"Token {Token.objects.create(user=self.user).key}"}
+        self.group = ChatGroup.objects.create(name="Group", created_by=make_user(2), member_count=0)
+        self.clear_caches()
+
+    def clear_caches(self):
+        for cache in caches.all():
+            cache.clear()
+        token_cache.clear()
+
+    def request(self, method, path, headers=None, **kwargs):
+        """
+        Response and the number of queries run on the primary and on the replica.
+        """
+        headers = self.headers if headers is None else headers
+        with CaptureQueriesContext(connections["default"]) as primary:
+            with CaptureQueriesContext(connections["replica"]) as replica:
+                response = getattr(self.client, method)(path, **kwargs, **headers)
+        return response, len(primary), len(replica)
+
+    def test_reads_go_to_replica(self):
+        response, primary, replica = self.request("get", "/accounts/users/sync/")
+        self.assertEqual(response.status_code, 200)
+        # Only the token
+        self.assertEqual(primary, 1)
+        self.assertGreater(replica, 0)
+
+        response, primary, replica = self.request("get", f"/accounts/groups/{self.group.unique_id}/")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(primary, 0)
+        self.assertGreater(replica, 0)
+
+    def test_cached_data_built_on_primary(self):
+        # A lagging replica would cache its stale rows under the current version.
+        # mine reads the ids of the user's groups, which pick the versions, from the replica.
+        for path, replica_reads in (("/accounts/groups/mine/", 1), ("/accounts/users/me/", 0)):
+            response, primary, replica = self.request("get", path)
+            self.assertEqual(response.status_code, 200)
+            self.assertGreater(primary, 0)
+            self.assertEqual(replica, replica_reads)
+
+            response, primary, replica = self.request("get", path)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(primary, 0)
+            self.assertEqual(replica, replica_reads)
+
+    def test_writer_sticks_to_primary(self):
+        response, primary, replica = self.request("post", f"/accounts/groups/{self.group.unique_id}/join/")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(replica, 0)
+
+        response, primary, replica = self.request("get", "/accounts/groups/mine/")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(replica, 0)
+        self.assertEqual(response.json()["results"][0]["unique_id"], self.group.unique_id)
+
+        response, primary, replica = self.request("get", f"/accounts/groups/{self.group.unique_id}/members/")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(replica, 0)
+
+        # Stickiness expired
+        self.clear_caches()
+        response, primary, replica = self.request("get", f"/accounts/groups/{self.group.unique_id}/members/")
+        self.assertGreater(replica, 0)
+
+    def test_session_clients(self):
+        # Sessions are read from the primary, right after the login created them
+        self.client.force_login(self.user)
+        with CaptureQueriesContext(connections["replica"]) as replica:
+            response = self.client.get("/accounts/users/sync/")
+        self.assertEqual(response.status_code, 200)
+        self.assertGreater(len(replica), 0)
+        self.assertFalse([query for query in replica if "django_session" in query["sql"]])
+
+        # and the session pins its client to the primary once it wrote
+        response, primary, replica = self.request("post", f"/accounts/groups/{self.group.unique_id}/join/", headers={})
+        self.assertEqual(response.status_code, 200)
+        response, primary, replica = self.request(
+            "get", f"/accounts/groups/{self.group.unique_id}/members/", headers={}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(replica, 0)
+        self.assertIn(self.user.username, json.dumps(response.json()))
+
+    def test_outside_requests(self):
+        with CaptureQueriesContext(connections["replica"]) as replica:
+            User.objects.count()
+        self.assertEqual(len(replica), 0)
+
+
+# URLconf of AsyncViewsTests, the async views next to the DRF ones
+urlpatterns = [
+    path("async/accounts/login/", async_views.login),
+    path("async/accounts/verify-otp/", async_views.verify_otp),
+    path("async/accounts/users/sync/", async_views.sync),
+    path("async/accounts/users/me/", async_views.me),
+    path("drf/accounts/", include("apps.accounts.urls")),
+]
+
+
+@override_settings(
+    CACHES=LOCMEM_CACHES, ROOT_URLCONF="apps.accounts.tests", JOBS_EAGER=False,
+    SMS_BACKEND="apps.accounts.sms.LocMemBackend",
+)
+class AsyncViewsTests(TestCase):
+    """
+    The async views must answer exactly what the DRF views do.
+    """
+
+    def setUp(self):
+        self.user = make_user(1)
+        self.headers = {"HTTP_AUTH": f"Token {Token.objects.create(user=self.user).key}"}
+        for index in range(3):
+            UserContact.objects.create(
+                user=self.user, username=f"user{index + 2}", name=f"Contact {index}", country_code="+91",
+                mobile_number=str(9100000000 + index), active=True, change_seq=index + 1,
+            )
+
+    def clear_caches(self):
+        for cache in caches.all():
+            cache.clear()
+        token_cache.clear()
+
+    def both(self, method, path, data=None, prepare=None, **extra):
+        """
+        Responses of the async and of the DRF view, each sent with empty caches.
+        """
+        responses = []
+        for prefix in ("async", "drf"):
+            self.clear_caches()
+            if prepare is not None:
+                prepare()
+            if method == "get":
+                responses.append(self.client.get(f"/{prefix}{path}", data, **extra))
+            else:
+                responses.append(self.client.post(f"/{prefix}{path}", json.dumps(data), "application/json", **extra))
+        return responses
+
+    def assertSameResponse(self, async_response, drf_response):
+        self.assertEqual(async_response.status_code, drf_response.status_code)
+        self.assertEqual(async_response.json() if async_response.content else None,
+                         drf_response.json() if drf_response.content else None)
+
+    def test_login(self):
+        for data in (
+            {"country_code": "+91", "mobile_number": "9000000001"},
+            {"country_code": "+91"},
+        ):
+            self.assertSameResponse(*self.both("post", "/accounts/login/", data))
+
+    def test_verify_otp(self):
+        data = {"country_code": "+91", "mobile_number": "9000000001", "otp": "12345"}
+        issue = lambda: otp_store.issue(normalize_phone("+91", "9000000001"), "12345")
+        async_response, drf_response = self.both("post", "/accounts/verify-otp/", data, prepare=issue)
+        self.assertEqual(async_response.status_code, 200)
+        self.assertSameResponse(async_response, drf_response)
+
+        self.assertSameResponse(*self.both("post", "/accounts/verify-otp/", {**data, "otp": "54321"}, prepare=issue))
+
+    def test_sync(self):
+        async_response, drf_response = self.both("get", "/accounts/users/sync/", {"page_size": 2}, **self.headers)
+        self.assertEqual(async_response.status_code, 200)
+        self.assertSameResponse(async_response, drf_response)
+        self.assertEqual(async_response["ETag"], drf_response["ETag"])
+
+        cursor = drf_response.json()["cursor"]
+        self.assertSameResponse(
+            *self.both("get", "/accounts/users/sync/", {"cursor": cursor, "page_size": 2}, **self.headers)
+        )
+        self.assertSameResponse(*self.both("get", "/accounts/users/sync/", {"cursor": "garbage"}, **self.headers))
+
+    def test_me(self):
+        async_response, drf_response = self.both("get", "/accounts/users/me/", **self.headers)
+        self.assertEqual(async_response.status_code, 200)
+        self.assertSameResponse(async_response, drf_response)
+
+    def test_authentication_failures(self):
+        for headers in ({}, {"HTTP_AUTH": "Token invalid"}, {"HTTP_AUTH": "Bearer invalid"}):
+            for path in ("/accounts/users/sync/", "/accounts/users/me/"):
+                async_response, drf_response = self.both("get", path, **headers)
+                self.assertEqual(async_response.status_code, 403)
+                self.assertSameResponse(async_response, drf_response)
+
+    @modify_settings(INSTALLED_APPS={"append": "rest_framework"})
+    def test_drf_fallback(self):
+        # Browsable API, its templates come with the rest_framework app
+        response = self.client.get("/async/accounts/users/me/", HTTP_ACCEPT="text/html", **self.headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response["Content-Type"].startswith("text/html"))
+
+        # SessionAuthentication
+        self.client.force_login(self.user)
+        response = self.client.get("/async/accounts/users/me/")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["username"], self.user.username)
+
+        # Other methods
+        response = self.client.put(
+            "/async/accounts/users/me/", json.dumps({"name": "Renamed"}), "application/json", **self.headers
+        )
+        self.assertEqual(response.status_code, 200)
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.name, "Renamed")
+
+
+@override_settings(CACHES=LOCMEM_CACHES, JOBS_EAGER=False, SMS_BACKEND="apps.accounts.sms.LocMemBackend")
+class PhoneKeyTests(TestCase):
+
+    def setUp(self):
+        for cache in caches.all():
+            cache.clear()
+
+    def test_normalize_phone(self):
+        self.assertEqual(normalize_phone("+91", "098765 43210"), "+919876543210")
+        self.assertEqual(normalize_phone("", "9876543210", "91"), "+919876543210")
+        self.assertEqual(normalize_phone("", "9876543210"), "9876543210")
+        self.assertIsNone(normalize_phone("+91", "0000000000"))
+        self.assertIsNone(normalize_phone("+91", None))
+        # Longer than E.164 allows, truncating would match another number
+        self.assertEqual(normalize_phone("+1234", "12345678901"), "+123412345678901")
+        self.assertIsNone(normalize_phone("+1234", "123456789012"))
+
+    def test_login_and_verify_reject_numbers_without_key(self):
+        make_user(1, mobile_number="0000000000")
+        data = {"country_code": "+91", "mobile_number": "0000000000"}
+
+        response = self.client.post("/accounts/login/", json.dumps(data), "application/json")
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("mobile_number", response.json())
+
+        otp_store.issue(None, "12345")
+        response = self.client.post(
+            "/accounts/verify-otp/", json.dumps({**data, "otp": "12345"}), "application/json"
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Token.objects.exists())
+
+    def test_contacts_without_key_are_told_apart_by_number(self):
+        user = make_user(1)
+        headers = {"HTTP_AUTH": f"Token {Token.objects.create(user=user).key}"}
+        contacts = [
+            {"name": "A", "country_code": "", "mobile_number": "abc"},
+            {"name": "X", "country_code": "", "mobile_number": "xyz"},
+            {"name": "A again", "country_code": "", "mobile_number": "abc"},
+        ]
+        for _ in range(2):
+            response = self.client.post(
+                "/accounts/add-contacts/", json.dumps({"contacts": contacts}), "application/json", **headers
+            )
+            self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            sorted(UserContact.objects.filter(user=user).values_list("mobile_number", "phone_key")),
+            [("abc", None), ("xyz", None)]
+        )
+
+    def test_backfill_migration(self):
+        user = make_user(1)
+        contact = UserContact.objects.create(user=user, name="Contact", country_code="", mobile_number="9100000000")
+        other = make_user(2)
+        User.objects.filter(id=user.id).update(phone_key=None)
+        UserContact.objects.filter(id=contact.id).update(phone_key="+9191000")
+        User.objects.filter(id=other.id).update(
+            country_code="+1234", mobile_number="123456789012", phone_key="+12341234567890"
+        )
+
+        migration = importlib.import_module("apps.accounts.migrations.0022_backfill_phone_keys")
+        migration.backfill_phone_keys(apps, None)
+
+        self.assertEqual(User.objects.get(id=user.id).phone_key, "+919000000001")
+        self.assertEqual(UserContact.objects.get(id=contact.id).phone_key, "+919100000000")
+        self.assertIsNone(User.objects.get(id=other.id).phone_key)
+
+
+@override_settings(CACHES=LOCMEM_CACHES, JOBS_EAGER=False, SMS_BACKEND="apps.accounts.sms.LocMemBackend")
+class OtpSmsTests(TestCase):
+
+    def setUp(self):
+        for cache in caches.all():
+            cache.clear()
+        sms.outbox.clear()
+        self.data = {"country_code": "+91", "mobile_number": "9000000001"}
+        self.phone_key = normalize_phone("+91", "9000000001")
+
+    def login(self):
+        response = self.client.post("/accounts/login/", json.dumps(self.data), "application/json")
+        self.assertEqual(response.status_code, 200)
+        return Job.objects.get(name="send_otp")
+
+    def test_code_not_stored_in_job(self):
+        job = self.login()
+        code = otp_store.get(self.phone_key)
+        self.assertEqual(job.payload, {"to": "+919000000001", "phone_key": self.phone_key})
+        self.assertNotIn(code, json.dumps(job.payload))
+
+        jobs.run_claimed(ids=[job.id])
+        self.assertEqual(sms.outbox, [{"to": "+919000000001", "body": f"Hi, Your otp for verification is ${code}"}])
+
+    def test_expired_code_not_sent(self):
+        job = self.login()
+        otp_store.cache.delete(f"otp:{self.phone_key}")
+
+        jobs.run_claimed(ids=[job.id])
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.DONE)
+        self.assertEqual(sms.outbox, [])
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class MobileNumberThrottleTests(SimpleTestCase):
+    """
+    login_mobile allows 5 requests an hour.
+    """
+    start = 3600 * 1000
+
+    def setUp(self):
+        for cache in caches.all():
+            cache.clear()
+
+    def allow(self, ip, at):
+        throttle = throttling.LoginMobileNumberRateThrottle()
+        throttle.timer = lambda: self.start + at
+        request = SimpleNamespace(
+            META={"REMOTE_ADDR": ip}, data={"country_code": "+91", "mobile_number": "9000000001"}
+        )
+        return throttle.allow_request(request, None)
+
+    def test_limit(self):
+        self.assertEqual([self.allow(f"10.0.0.{index}", 0) for index in range(6)], [True] * 5 + [False])
+        # Reformatting the number doesn't help
+        throttle = throttling.LoginMobileNumberRateThrottle()
+        request = SimpleNamespace(
+            META={"REMOTE_ADDR": "10.0.1.1"}, data={"country_code": "91", "mobile_number": "9000000001"}
+        )
+        throttle.timer = lambda: self.start
+        self.assertFalse(throttle.allow_request(request, None))
+
+    def test_rejected_requests_do_not_lock_out_the_number(self):
+        for _ in range(5):
+            self.assertTrue(self.allow("10.0.0.1", 0))
+        for _ in range(100):
+            self.assertFalse(self.allow("10.0.0.2", 10))
+        # Half of the previous window overlaps, its 5 requests weigh 2.5
+        self.assertTrue(self.allow("10.0.0.3", 5400))
+        self.assertTrue(self.allow("10.0.0.3", 5400))
+        self.assertFalse(self.allow("10.0.0.3", 5400))
+
+    def test_client_sending_rejected_requests_backs_off(self):
+        for _ in range(5):
+            self.assertTrue(self.allow("10.0.0.1", 0))
+        for _ in range(20):
+            self.assertFalse(self.allow("10.0.0.2", 10))
+        # The number has room again, the client hammering it doesn't
+        self.assertFalse(self.allow("10.0.0.2", 5400))
+        self.assertTrue(self.allow("10.0.0.3", 5400))
+
+
+@override_settings(CACHES=LOCMEM_CACHES, JOBS_EAGER=False, SMS_BACKEND="apps.accounts.sms.LocMemBackend")
+class ContactSyncTests(TestCase):
+
+    def setUp(self):
+        for cache in caches.all():
+            cache.clear()
+        token_cache.clear()
+        self.user = make_user(1)
+        self.headers = {"HTTP_AUTH": f"Token {Token.objects.create(user=self.user).key}"}
+        self.friends = [make_user(index) for index in range(2, 7)]
+        self.upload([friend.mobile_number for friend in self.friends])
+
+    def upload(self, numbers):
+        contacts = [{"name": f"Contact {number}", "country_code": "+91", "mobile_number": number} for number in numbers]
+        response = self.client.post(
+            "/accounts/add-contacts/", json.dumps({"contacts": contacts}), "application/json", **self.headers
+        )
+        self.assertEqual(response.status_code, 200)
+
+    def sync(self, cursor="", page_size=2):
+        response = self.client.get("/accounts/users/sync/", {"cursor": cursor, "page_size": page_size}, **self.headers)
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(set(data), {"results", "cursor", "has_more"})
+        return data
+
+    def sync_all(self, cursor=""):
+        """
+        Usernames of every page after ``cursor`` and the final cursor.
+        """
+        usernames = []
+        while True:
+            data = self.sync(cursor)
+            usernames += [contact["username"] for contact in data["results"]]
+            cursor = data["cursor"]
+            if not data["has_more"]:
+                return usernames, cursor
+
+    def test_pages(self):
+        pages = []
+        cursor = ""
+        while True:
+            data = self.sync(cursor)
+            pages.append((len(data["results"]), data["has_more"]))
+            cursor = data["cursor"]
+            if not data["has_more"]:
+                break
+        self.assertEqual(pages, [(2, True), (2, True), (1, False)])
+
+        # Nothing changed after the last cursor, which stays put
+        data = self.sync(cursor)
+        self.assertEqual(data, {"results": [], "cursor": cursor, "has_more": False})
+
+        self.assertEqual(self.sync_all()[0], [friend.username for friend in self.friends])
+        response = self.client.get("/accounts/users/sync/", {"cursor": "invalid"}, **self.headers)
+        self.assertEqual(response.status_code, 400)
+
+    def test_changes_after_cursor(self):
+        _, cursor = self.sync_all()
+
+        newcomer = make_user(7)
+        self.upload([newcomer.mobile_number, "9100000000"])
+        usernames, cursor = self.sync_all(cursor)
+        self.assertEqual(usernames, [newcomer.username])
+
+        # The unregistered number joins, the contact is restamped for its owner
+        joined = User.objects.create(username="joined", country_code="+91", mobile_number="9100000000")
+        tasks.activate_contacts(joined.id)
+        self.assertEqual(self.sync_all(cursor)[0], ["joined"])
+
+    def test_counters_per_user(self):
+        other = self.friends[0]
+        first = ChangeSequence.reserve_contacts([self.user.id, other.id])
+        # The user's counter goes on after the upload, the new one starts from scratch
+        self.assertEqual(first, {self.user.id: 2, other.id: 1})
+        self.assertEqual(ChangeSequence.reserve_contacts([other.id]), {other.id: 2})
+        self.assertEqual(ChangeSequence.reserve_contacts([self.user.id]), {self.user.id: 3})
+
+        # A counter created after contacts were stamped starts above them
+        contact = UserContact.objects.create(
+            user=self.friends[1], name="Contact", country_code="+91", mobile_number="9100000001", change_seq=40
+        )
+        self.assertEqual(ChangeSequence.reserve_contacts([contact.user_id]), {contact.user_id: 41})
+
+
+@override_settings(CACHES=LOCMEM_CACHES, JOBS_EAGER=False)
+class GroupCacheInvalidationTests(TestCase):
+    """
+    groups/mine is cached under the versions of the user's memberships and groups.
+    """
+
+    def setUp(self):
+        for cache in caches.all():
+            cache.clear()
+        token_cache.clear()
+        self.owner, self.member, self.outsider = make_user(1), make_user(2), make_user(3)
+        response = self.post(self.owner, "/accounts/groups/", {"name": "Group", "users": [self.member.username]})
+        self.assertEqual(response.status_code, 201)
+        self.group = ChatGroup.objects.get(name="Group")
+
+    def headers(self, user):
+        return {"HTTP_AUTH": f"Token {Token.objects.get_or_create(user=user)[0].key}"}
+
+    def post(self, user, path, data=None):
+        return self.client.post(path, json.dumps(data or {}), "application/json", **self.headers(user))
+
+    def mine(self, user):
+        response = self.client.get("/accounts/groups/mine/", **self.headers(user))
+        self.assertEqual(response.status_code, 200)
+        return {group["unique_id"]: group for group in response.json()["results"]}
+
+    def test_group_changes(self):
+        self.assertEqual(self.mine(self.member)[self.group.unique_id]["member_count"], 2)
+
+        response = self.client.patch(
+            f"/accounts/groups/{self.group.unique_id}/", json.dumps({"name": "Renamed"}), "application/json",
+            **self.headers(self.owner)
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.mine(self.member)[self.group.unique_id]["name"], "Renamed")
+
+        self.assertEqual(self.post(self.outsider, f"/accounts/groups/{self.group.unique_id}/join/").status_code, 200)
+        self.assertEqual(self.mine(self.member)[self.group.unique_id]["member_count"], 3)
+
+    def test_membership_changes(self):
+        self.assertEqual(self.mine(self.outsider), {})
+        self.post(self.outsider, f"/accounts/groups/{self.group.unique_id}/join/")
+        self.assertIn(self.group.unique_id, self.mine(self.outsider))
+        self.post(self.outsider, f"/accounts/groups/{self.group.unique_id}/exit/")
+        self.assertEqual(self.mine(self.outsider), {})
+
+        # Bulk changes send no signals
+        response = self.post(
+            self.owner, f"/accounts/groups/{self.group.unique_id}/add_members/", {"usernames": [self.outsider.username]}
+        )
+        self.assertEqual(response.json()["added"], [self.outsider.username])
+        self.assertIn(self.group.unique_id, self.mine(self.outsider))
+        response = self.post(
+            self.owner, f"/accounts/groups/{self.group.unique_id}/remove_members/",
+            {"usernames": [self.outsider.username]}
+        )
+        self.assertEqual(response.json()["removed"], [self.outsider.username])
+        self.assertEqual(self.mine(self.outsider), {})
+
+    def test_user_saves(self):
+        def versions():
+            return accounts_cache.get_versions([accounts_cache.GROUPS_KEY, accounts_cache.group_key(self.group.id)])
+
+        before = versions()
+        with CaptureQueriesContext(connection) as queries:
+            # Signups, profile edits and avatar jobs of users don't change the groups
+            make_user(10)
+            owner = User.objects.get(id=self.owner.id)
+            owner.bio = "Edited"
+            owner.save()
+            owner.save(update_fields=["image", "image_variants"])
+        self.assertEqual(versions(), before)
+        self.assertFalse([query for query in queries if "accounts_chatgroup" in query["sql"]])
+
+        # Groups show their creator's mobile number
+        owner.mobile_number = "9100000001"
+        owner.save()
+        after = versions()
+        self.assertNotEqual(after, before)
+        self.assertEqual(self.mine(self.member)[self.group.unique_id]["creator_mobile_number"], "9100000001")
+        # Creators without groups bump nothing
+        member = User.objects.get(id=self.member.id)
+        member.mobile_number = "9100000002"
+        member.save()
+        self.assertEqual(versions(), after)
+
+    def test_etag(self):
+        response = self.client.get("/accounts/groups/mine/", **self.headers(self.member))
+        etag = response["ETag"]
+        response = self.client.get("/accounts/groups/mine/", HTTP_IF_NONE_MATCH=etag, **self.headers(self.member))
+        self.assertEqual(response.status_code, 304)
+
+        self.post(self.outsider, f"/accounts/groups/{self.group.unique_id}/join/")
+        response = self.client.get("/accounts/groups/mine/", HTTP_IF_NONE_MATCH=etag, **self.headers(self.member))
+        self.assertEqual(response.status_code, 200)
+
+    def test_group_bump_does_not_touch_members(self):
+        versions = accounts_cache.get_versions([accounts_cache.memberships_key(self.member.id)])
+        with self.assertNumQueries(0):
+            accounts_cache.bump_groups([self.group.id])
+        self.assertEqual(accounts_cache.get_versions([accounts_cache.memberships_key(self.member.id)]), versions)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class ConditionalRequestTests(TestCase):
+
+    def setUp(self):
+        for cache in caches.all():
+            cache.clear()
+        token_cache.clear()
+        self.user = make_user(1)
+        self.headers = {"HTTP_AUTH": f"Token {Token.objects.create(user=self.user).key}"}
+        for index in range(3):
+            UserContact.objects.create(
+                user=self.user, username=f"user{index + 2}", name=f"Contact {index}", country_code="+91",
+                mobile_number=str(9100000000 + index), active=True, change_seq=index + 1,
+            )
+
+    def get(self, path, data=None, **extra):
+        return self.client.get(path, data, **self.headers, **extra)
+
+    def test_no_last_modified(self):
+        response = self.get("/accounts/users/me/")
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn("Last-Modified", response)
+
+        # Changed within the second, a date can't tell
+        self.user.name = "Renamed"
+        self.user.save()
+        response = self.get("/accounts/users/me/", HTTP_IF_MODIFIED_SINCE="Fri, 01 Jan 2100 00:00:00 GMT")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["name"], "Renamed")
+
+    def test_etag(self):
+        etag = self.get("/accounts/users/me/")["ETag"]
+        self.assertEqual(self.get("/accounts/users/me/", HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.user.name = "Renamed"
+        self.user.save()
+        self.assertEqual(self.get("/accounts/users/me/", HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_sync_etag_depends_on_cursor(self):
+        first = self.get("/accounts/users/sync/", {"page_size": 2})
+        self.assertEqual(
+            self.get("/accounts/users/sync/", {"page_size": 2}, HTTP_IF_NONE_MATCH=first["ETag"]).status_code, 304
+        )
+
+        # Same contacts, another page
+        second = self.get(
+            "/accounts/users/sync/", {"page_size": 2, "cursor": first.json()["cursor"]},
+            HTTP_IF_NONE_MATCH=first["ETag"]
+        )
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(len(second.json()["results"]), 1)
+        response = self.get("/accounts/users/sync/", {"page_size": 3}, HTTP_IF_NONE_MATCH=first["ETag"])
+        self.assertEqual(response.status_code, 200)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class OtpStoreTests(SimpleTestCase):
+
+    def setUp(self):
+        for cache in caches.all():
+            cache.clear()
+        self.store = OtpStore("shared", ttl=300, max_attempts=3)
+
+    def test_code_is_used_once(self):
+        self.store.issue("+919000000001", 12345)
+        self.assertFalse(self.store.verify("+919000000002", "12345"))
+        self.assertTrue(self.store.verify("+919000000001", "12345"))
+        self.assertFalse(self.store.verify("+919000000001", "12345"))
+        self.assertIsNone(self.store.get("+919000000001"))
+
+    def test_attempts(self):
+        self.store.issue("+919000000001", 12345)
+        for _ in range(3):
+            self.assertFalse(self.store.verify("+919000000001", "54321"))
+        # Guessed too often, the code is gone
+        self.assertFalse(self.store.verify("+919000000001", "12345"))
+        self.assertIsNone(self.store.get("+919000000001"))
+
+        # A new code resets the attempts
+        self.store.issue("+919000000001", 11111)
+        self.assertFalse(self.store.verify("+919000000001", "54321"))
+        self.assertTrue(self.store.verify("+919000000001", "11111"))
+
+    def test_expiry(self):
+        self.store.issue("+919000000001", 12345)
+        caches["shared"].delete_many(["otp:+919000000001", "otp-attempts:+919000000001"])
+        self.assertFalse(self.store.verify("+919000000001", "12345"))
+
+    def test_deploy_check_requires_atomic_incr(self):
+        self.assertEqual(
+            [error.id for error in check_counter_caches(None)], ["accounts.E001", "accounts.E002"]
+        )
+        redis = {"BACKEND": "django.core.cache.backends.redis.RedisCache", "LOCATION": "redis://localhost:6379"}
+        with self.settings(CACHES={**LOCMEM_CACHES, "shared": redis}):
+            self.assertEqual(check_counter_caches(None), [])
+        with self.settings(CACHES={**LOCMEM_CACHES, "counters": redis}, THROTTLE_CACHE="counters"):
+            self.assertEqual([error.id for error in check_counter_caches(None)], ["accounts.E001"])
+
+
+LOCAL_EVENTS = {"BACKEND": "apps.accounts.events.LocalBroker", "QUEUE_SIZE": 10, "KEEPALIVE": 15, "RETRY": 5}
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class EventsTests(TestCase):
+
+    def setUp(self):
+        for cache in caches.all():
+            cache.clear()
+        token_cache.clear()
+        self.user = make_user(1)
+        self.token = Token.objects.create(user=self.user).key
+
+    async def stream(self, during=None):
+        """
+        Messages sent by the event stream until ``during``, a coroutine run once it is ready, returns.
+        """
+        sent = asyncio.Queue()
+        disconnect = asyncio.Event()
+
+        async def receive():
+            await disconnect.wait()
+            return {"type": "http.disconnect"}
+
+        scope = {"type": "http", "method": "GET", "headers": [(b"auth", f"Token {self.token}".encode())]}
+        stream = asyncio.create_task(events.event_stream(scope, receive, sent.put))
+        messages = [await sent.get(), await sent.get()]
+        if messages[0]["status"] == 200:
+            if during is not None:
+                await during()
+                messages.append(await asyncio.wait_for(sent.get(), 5))
+            disconnect.set()
+        await stream
+        return messages
+
+    @override_settings(EVENTS={**LOCAL_EVENTS, "BACKEND": None})
+    def test_disabled_without_broker(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            events.publish([self.user.id], {"type": events.GROUP_JOINED, "group": 1})
+        self.assertEqual(callbacks, [])
+
+        start, body = async_to_sync(self.stream)()
+        self.assertEqual(start["status"], 503)
+        self.assertIn(b"disabled", body["body"])
+
+    @override_settings(EVENTS=LOCAL_EVENTS)
+    def test_stream(self):
+        async def publish():
+            events.get_broker().publish([self.user.id], {"type": events.GROUP_JOINED, "group": 1})
+
+        start, ready, event = async_to_sync(self.stream)(publish)
+        self.assertEqual(start["status"], 200)
+        self.assertIn(b"event: ready", ready["body"])
+        self.assertEqual(event["body"], b'event: group_joined\ndata: {"type":"group_joined","group":1}\n\n')
+
+    @override_settings(EVENTS=LOCAL_EVENTS)
+    def test_group_create_publishes_group_joined(self):
+        members = [make_user(2), make_user(3)]
+        with mock.patch.object(events, "publish") as publish:
+            response = self.client.post(
+                "/accounts/groups/", json.dumps({"name": "Group", "users": [user.username for user in members]}),
+                "application/json", HTTP_AUTH=f"Token {self.token}",
+            )
+        self.assertEqual(response.status_code, 201)
+        publish.assert_called_once_with(
+            [self.user.id, members[0].id, members[1].id], {"type": events.GROUP_JOINED, "group": response.json()["id"]}
+        )
+
+    def test_deploy_check_rejects_local_broker(self):
+        with self.settings(EVENTS=LOCAL_EVENTS):
+            self.assertEqual([error.id for error in check_events_broker(None)], ["accounts.E003"])
+        with self.settings(EVENTS={**LOCAL_EVENTS, "BACKEND": None}):
+            self.assertEqual(check_events_broker(None), [])
+
+
+def image_bytes(color):
+    buffer = io.BytesIO()
+    Image.new("RGB", (80, 80), color).save(buffer, "JPEG")
+    return buffer.getvalue()
+
+
+@override_settings(CACHES=LOCMEM_CACHES, JOBS_EAGER=False)
+class MediaReferenceTests(TestCase):
+    """
+    MediaFile counts the users referencing each stored image, gc_media deletes the others.
+    """
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        settings = override_settings(MEDIA_ROOT=self.root)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.storage = avatars.get_storage()
+
+    def references(self):
+        return dict(MediaFile.objects.values_list("name", "references"))
+
+    def set_image(self, user, color):
+        user.image.save("a.jpg", ContentFile(image_bytes(color)))
+        return user.image.name
+
+    def test_reference_counts(self):
+        first, second = make_user(1), make_user(2)
+        red = self.set_image(first, "red")
+        # Same content, same file
+        self.assertEqual(self.set_image(second, "red"), red)
+        self.assertEqual(self.references(), {red: 2})
+
+        blue = self.set_image(second, "blue")
+        self.assertEqual(self.references(), {red: 1, blue: 1})
+
+        second.image_variants = {"64": red}
+        second.save(update_fields=["image_variants"])
+        self.assertEqual(self.references(), {red: 2, blue: 1})
+
+        # Saves of other fields don't read the old image
+        with CaptureQueriesContext(connection) as queries:
+            second.name = "Renamed"
+            second.save(update_fields=["name"])
+        self.assertFalse([query for query in queries if "mediafile" in query["sql"].lower()])
+
+        second.delete()
+        self.assertEqual(self.references(), {red: 1, blue: 0})
+
+    def test_existing_variants(self):
+        first, second = make_user(1), make_user(2)
+        red = self.set_image(first, "red")
+        self.assertIsNone(avatars.existing_variants(red))
+        variants = avatars.generate_variants(red)
+        User.objects.filter(id=first.id).update(image_variants=variants)
+        self.set_image(second, "red")
+        self.assertEqual(avatars.existing_variants(red), variants)
+        self.assertEqual(sequential_scans("SELECT image_variants FROM accounts_user WHERE image = 'x'"), [])
+
+    def age(self, name, seconds):
+        """
+        Make the file and its count ``seconds`` old.
+        """
+        when = timezone.now() - datetime.timedelta(seconds=seconds)
+        os.utime(self.storage.path(name), (when.timestamp(), when.timestamp()))
+        MediaFile.objects.filter(name=name).update(updated_at=when)
+
+    def gc(self, *args):
+        out = io.StringIO()
+        call_command("gc_media", *args, stdout=out)
+        return out.getvalue()
+
+    def test_gc_media(self):
+        user = make_user(1)
+        red = self.set_image(user, "red")
+        blue = self.set_image(user, "blue")
+        green = self.set_image(user, "green")
+        self.set_image(user, "white")
+        self.age(red, 2 * 24 * 60 * 60)
+        self.age(blue, 2 * 24 * 60 * 60)
+        # Referenced again
+        other = make_user(2)
+        self.set_image(other, "blue")
+        self.age(blue, 2 * 24 * 60 * 60)
+
+        self.assertIn("Would delete 1 files", self.gc("--dry-run"))
+        self.assertTrue(self.storage.exists(red))
+
+        self.assertIn("Deleted 1 files", self.gc())
+        self.assertFalse(self.storage.exists(red))
+        self.assertNotIn(red, self.references())
+        # Still referenced, or unreferenced too recently
+        self.assertTrue(self.storage.exists(blue))
+        self.assertTrue(self.storage.exists(green))
+
+        # Files without any count are only found by --full
+        stray = self.storage.save("user/profile_photo/stray.jpg", ContentFile(image_bytes("black")))
+        self.age(stray, 2 * 24 * 60 * 60)
+        self.age(green, 2 * 24 * 60 * 60)
+        self.assertIn("Deleted 2 files", self.gc("--full"))
+        self.assertFalse(self.storage.exists(stray))
+        self.assertFalse(self.storage.exists(green))
+        self.assertTrue(self.storage.exists(user.image.name))
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class MetricsTests(TestCase):
+    """
+    Request metrics are recorded per route, added up across workers and only served to scrapers.
+    """
+
+    def setUp(self):
+        caches["default"].clear()
+        token_cache.clear()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.registry = metrics.Registry(self.directory, flush_interval=3600)
+        patcher = mock.patch.object(metrics, "registry", self.registry)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def sample(self, queries=0):
+        sample = metrics.Sample()
+        sample.queries = queries
+        return sample
+
+    def snapshot(self, pid, routes):
+        with open(os.path.join(self.directory, f"{pid}.json"), "w") as file:
+            json.dump(routes, file)
+
+    def exited_pid(self):
+        process = subprocess.Popen([sys.executable, "-c", ""])
+        process.wait()
+        return process.pid
+
+    def test_middleware_records_route(self):
+        user = make_user(1)
+        auth = {"HTTP_AUTH": f"Token {Token.objects.create(user=user).key}"}
+        self.client.get("/accounts/users/me/", **auth)
+        self.client.get("/accounts/users/me/", **auth)
+        self.client.get("/nowhere/")
+        routes = self.registry.collect()
+        # Routes of the DRF router are regexes
+        stats = routes["GET accounts/users/me/$"]
+        self.assertEqual(stats["statuses"], {"200": 2})
+        self.assertEqual(sum(stats["queries"]["buckets"]), 2)
+        self.assertGreater(stats["queries"]["sum"], 0)
+        self.assertEqual(routes["GET unmatched"]["statuses"], {"404": 1})
+
+    def test_render(self):
+        self.registry.record("accounts/users/me/", "GET", 200, 0.02, 300, self.sample(queries=2))
+        self.registry.record("accounts/users/me/", "GET", 403, 0.001, 50, self.sample())
+        text = self.registry.render()
+        labels = 'method="GET",route="accounts/users/me/"'
+        self.assertIn(f'seazon_http_request_duration_seconds_bucket{{{labels},le="0.005"}} 1', text)
+        self.assertIn(f'seazon_http_request_duration_seconds_bucket{{{labels},le="0.025"}} 2', text)
+        self.assertIn(f"seazon_db_queries_per_request_sum{{{labels}}} 2", text)
+        self.assertIn(f"seazon_http_response_size_bytes_count{{{labels}}} 2", text)
+        self.assertIn(f'seazon_http_requests_total{{{labels},status="403"}} 1', text)
+
+    def test_snapshots_of_running_workers_are_added(self):
+        self.registry.record("accounts/users/me/", "GET", 200, 0.01, 100, self.sample())
+        other = metrics.Registry(self.directory)
+        other.record("accounts/users/me/", "GET", 200, 0.01, 100, self.sample())
+        # The parent of the test runner stands for another worker
+        self.snapshot(os.getppid(), other.routes)
+        self.assertEqual(self.registry.collect()["GET accounts/users/me/"]["statuses"], {"200": 2})
+
+        # This process' own snapshot is stale, the in memory stats are counted instead
+        self.registry.flush()
+        self.registry.record("accounts/users/me/", "GET", 200, 0.01, 100, self.sample())
+        self.assertEqual(self.registry.collect()["GET accounts/users/me/"]["statuses"], {"200": 3})
+
+    def test_snapshots_of_exited_workers_are_deleted(self):
+        other = metrics.Registry(self.directory)
+        other.record("accounts/users/me/", "GET", 200, 0.01, 100, self.sample())
+        pid = self.exited_pid()
+        self.snapshot(pid, other.routes)
+        self.assertEqual(self.registry.collect(), {})
+        self.assertFalse(os.path.exists(os.path.join(self.directory, f"{pid}.json")))
+
+    @override_settings(METRICS={"DIR": None, "FLUSH_INTERVAL": 5, "TOKEN": "secret"})
+    def test_endpoint_requires_token(self):
+        self.assertEqual(self.client.get("/metrics").status_code, 403)
+        self.assertEqual(self.client.get("/metrics", HTTP_AUTHORIZATION="Bearer wrong").status_code, 403)
+        response = self.client.get("/metrics", HTTP_AUTHORIZATION="Bearer secret")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b"# TYPE seazon_http_requests_total counter", response.content)
+        self.assertEqual(check_metrics_token(None), [])
+
+    @override_settings(METRICS={"DIR": None, "FLUSH_INTERVAL": 5, "TOKEN": None})
+    def test_endpoint_without_token(self):
+        self.assertEqual(self.client.get("/metrics").status_code, 404)
+        self.assertEqual([warning.id for warning in check_metrics_token(None)], ["accounts.W001"])
+        with self.settings(DEBUG=True):
+            self.assertEqual(self.client.get("/metrics").status_code, 200)
+
+
+@override_settings(CACHES=LOCMEM_CACHES, ROOT_URLCONF="apps.accounts.tests")
+class TokenCacheTests(TestCase):
+    """
+    Tokens are cached with their user, saves only evict them when is_active changes.
+    """
+
+    def setUp(self):
+        for cache in caches.all():
+            cache.clear()
+        token_cache.clear()
+        self.user = make_user(1)
+        self.token = Token.objects.create(user=self.user)
+        self.headers = {"HTTP_AUTH": f"Token {self.token.key}"}
+
+    def me(self, prefix="drf"):
+        return self.client.get(f"/{prefix}/accounts/users/me/", **self.headers)
+
+    def token_queries(self, queries):
+        return [query for query in queries if "authtoken_token" in query["sql"]]
+
+    def test_hits_skip_the_database(self):
+        self.assertEqual(self.me().status_code, 200)
+        self.assertIsNotNone(token_cache.get_local(self.token.key))
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.me().status_code, 200)
+            self.assertEqual(self.me("async").status_code, 200)
+        self.assertEqual(self.token_queries(queries), [])
+
+    def test_saves_keep_the_entry(self):
+        self.me()
+        user = User.objects.get(id=self.user.id)
+        with CaptureQueriesContext(connection) as queries:
+            user.name = "Renamed"
+            user.save()
+            user.save(update_fields=["bio"])
+        self.assertEqual(self.token_queries(queries), [])
+        self.assertIsNotNone(token_cache.get_local(self.token.key))
+
+    def test_deactivation_evicts(self):
+        for prefix in ("drf", "async"):
+            with self.subTest(prefix):
+                User.objects.filter(id=self.user.id).update(is_active=True)
+                self.assertEqual(self.me(prefix).status_code, 200)
+                user = User.objects.get(id=self.user.id)
+                user.is_active = False
+                user.save()
+                self.assertIsNone(token_cache.get_local(self.token.key))
+                self.assertEqual(self.me(prefix).status_code, 403)
+
+    def test_inactive_hits_are_rejected(self):
+        # e.g. a copy another process cached before the deactivation
+        for prefix in ("drf", "async"):
+            with self.subTest(prefix):
+                self.me(prefix)
+                User.objects.filter(id=self.user.id).update(is_active=False)
+                token = token_cache.get_local(self.token.key)
+                token.user.is_active = False
+                token_cache.set(self.token.key, token)
+                self.assertEqual(self.me(prefix).status_code, 403)
+                User.objects.filter(id=self.user.id).update(is_active=True)
+                token_cache.clear()
+
+    def test_deleted_users_are_evicted(self):
+        self.me()
+        User.objects.get(id=self.user.id).delete()
+        self.assertIsNone(token_cache.get_local(self.token.key))
+        self.assertEqual(self.me().status_code, 403)
+
+    def test_profile_update_reads_the_user(self):
+        # The cached user must not overwrite the fields saved since it was cached
+        self.me()
+        self.client.put("/drf/accounts/users/me/", {"name": "First"}, "application/json", **self.headers)
+        self.client.put("/drf/accounts/users/me/", {"bio": "Second"}, "application/json", **self.headers)
+        user = User.objects.get(id=self.user.id)
+        self.assertEqual((user.name, user.bio), ("First", "Second"))
+
+
+class StreamingJsonTests(SimpleTestCase):
+    """
+    iter_json_array must yield what json.loads does, wherever the reads split the body.
+    """
+
+    def items(self, body, read_size, **kwargs):
+        return list(iter_json_array(io.BytesIO(body.encode()), read_size=read_size, **kwargs))
+
+    def test_chunk_boundaries(self):
+        for body in (
+            "[]",
+            " [ 1 , 22 ,333, -4.5e3, 1E+2, 0.25, true, false, null ] ",
+            '["a\\"b\\u00e9", "\u00fcn\u00ef \U0001f600", {"x": [1, {"y": "z"}]}, []]',
+        ):
+            for read_size in range(1, 8):
+                with self.subTest(body=body, read_size=read_size):
+                    self.assertEqual(self.items(body, read_size), json.loads(body))
+
+    def test_key(self):
+        body = '{"before": {"a": [1, 2]}, "contacts": [{"name": "A"}, {"name": "B"}], "after": "x"}'
+        for read_size in range(1, 8):
+            with self.subTest(read_size=read_size):
+                self.assertEqual(
+                    self.items(body, read_size, key="contacts"), [{"name": "A"}, {"name": "B"}]
+                )
+
+    def test_malformed(self):
+        for body in (
+            "", "[", "[1,", "[1 2]", "[1,]", "[tru]", "[1.]", "[-]", "[1]x", '{"a": 1}',
+        ):
+            for read_size in (1, 2, 64):
+                with self.subTest(body=body, read_size=read_size), self.assertRaises(ParseError):
+                    self.items(body, read_size)
+        for body in ('{"other": []}', '{"contacts": 1}', "[]", '{1: []}', '{"contacts": []} []'):
+            with self.subTest(body=body), self.assertRaises(ParseError):
+                self.items(body, 3, key="contacts")
+        with self.assertRaises(ParseError):
+            list(iter_json_array(io.BytesIO(b'["\xff"]')))
+
+    def test_item_size_limit(self):
+        body = json.dumps(["a" * 200])
+        with self.assertRaises(ParseError):
+            self.items(body, 16, max_item_size=100)
+        # Many small items are fine
+        body = json.dumps(["a" * 50] * 100)
+        self.assertEqual(len(self.items(body, 16, max_item_size=100)), 100)
+
+
+@override_settings(CACHES=LOCMEM_CACHES, CONTACTS_UPLOAD_CHUNK_SIZE=2, JOBS_EAGER=False)
+class StreamAddContactsTests(TestCase):
+    """
+    add-contacts/stream/ must store what add-contacts does.
+    """
+
+    def setUp(self):
+        for cache in caches.all():
+            cache.clear()
+        token_cache.clear()
+        self.friends = [make_user(index) for index in range(10, 13)]
+
+    def upload(self, path, user, contacts):
+        headers = {"HTTP_AUTH": f"Token {Token.objects.get_or_create(user=user)[0].key}"}
+        return self.client.post(path, json.dumps({"contacts": contacts}), "application/json", **headers)
+
+    def stored(self, user):
+        return sorted(UserContact.objects.filter(user=user).values_list(
+            "name", "country_code", "mobile_number", "phone_key", "username", "active"
+        ))
+
+    def test_same_contacts(self):
+        contacts = [
+            {"name": f"Contact {number}", "country_code": "+91", "mobile_number": number}
+            for number in [friend.mobile_number for friend in self.friends] + ["8000000001", "8000000002"]
+        ] + [{"name": "No code", "country_code": "", "mobile_number": "9000000011"}]
+        plain, streamed = make_user(1), make_user(2)
+        # Existing contacts are skipped by both
+        for user in (plain, streamed):
+            self.assertEqual(self.upload("/accounts/add-contacts/", user, contacts[:2]).status_code, 200)
+
+        self.assertEqual(self.upload("/accounts/add-contacts/", plain, contacts).status_code, 200)
+        response = self.upload("/accounts/add-contacts/stream/", streamed, contacts)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.stored(plain), self.stored(streamed))
+
+        data = response.json()
+        self.assertEqual([chunk["received"] for chunk in data["chunks"]], [2, 2, 2])
+        # The number without a country code is user11's, already in the address book
+        self.assertEqual(sum(chunk["created"] for chunk in data["chunks"]), 3)
+        self.assertEqual(sum(chunk["matched"] for chunk in data["chunks"]), 1)
+        # Matches are not echoed, the response does not grow with the address book
+        self.assertEqual(set(data), {"chunks"})
+
+    def test_invalid_chunk(self):
+        user = make_user(1)
+        contacts = [{"name": "A", "country_code": "+91", "mobile_number": "8000000001"}] * 2 + [{"name": "B"}]
+        response = self.upload("/accounts/add-contacts/stream/", user, contacts)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()["chunk"], "1")
+        # The first chunk is committed
+        self.assertEqual(UserContact.objects.filter(user=user).count(), 1)
+
+        headers = {"HTTP_AUTH": f"Token {Token.objects.get(user=user).key}"}
+        response = self.client.post("/accounts/add-contacts/stream/", '{"contacts": [', "application/json", **headers)
+        self.assertEqual(response.status_code, 400)
+
+
+class FastJSONTests(SimpleTestCase):
+    """
+    The orjson renderer and parser must be byte for byte the stdlib ones.
+    """
+
+    def test_same_output(self):
+        for data in (
+            None, [], {}, "", 0.1, 2 ** 70,
+            {
+                "text": "\u00fcn\u00ef \U0001f600 </script> \u2028\u2029 \"quoted\" \\", "float": 1e-07, "none": None,
+                "when": datetime.datetime(2024, 1, 2, 3, 4, 5, 678000, tzinfo=datetime.timezone.utc),
+                "naive": datetime.datetime(2024, 1, 2, 3, 4, 5), "date": datetime.date(2024, 1, 2),
+                "time": datetime.time(3, 4, 5, 6), "amount": decimal.Decimal("1.10"), "uuid": uuid.UUID(int=1),
+                "lazy": gettext_lazy("Invalid token."), "tuple": (1, 2), 1: "integer key", "big": [2 ** 70],
+                "nested": [ReturnDict({"a": 1}, serializer=None), ReturnList([None, True, False], serializer=None)],
+            },
+        ):
+            with self.subTest(data=data):
+                self.assertEqual(FastJSONRenderer().render(data), JSONRenderer().render(data))
+
+    def test_indent(self):
+        data = {"a": [1, 2]}
+        self.assertEqual(
+            FastJSONRenderer().render(data, "application/json; indent=2"),
+            JSONRenderer().render(data, "application/json; indent=2"),
+        )
+
+    def test_parse(self):
+        body = '{"text": "\u00fcn\u00ef", "list": [1, 2.5, null, true], "nested": {"a": {}}}'.encode()
+        self.assertEqual(FastJSONParser().parse(io.BytesIO(body)), JSONParser().parse(io.BytesIO(body)))
+        for parser in (FastJSONParser(), JSONParser()):
+            with self.subTest(parser=parser), self.assertRaises(ParseError):
+                parser.parse(io.BytesIO(b'{"a": '))
+
+
+@override_settings(CACHES=LOCMEM_CACHES, ROOT_URLCONF="apps.accounts.tests", JOBS_EAGER=False)
+class MessagePackTests(TestCase):
+    """
+    Clients asking for msgpack get the JSON responses encoded as msgpack, and may send msgpack bodies.
+    """
+
+    def setUp(self):
+        for cache in caches.all():
+            cache.clear()
+        token_cache.clear()
+        self.user = make_user(1, bio="\u00fcn\u00ef")
+        self.friend = make_user(2)
+        self.headers = {"HTTP_AUTH": f"Token {Token.objects.create(user=self.user).key}"}
+        UserContact.objects.create(
+            user=self.user, username="user2", name="Two", country_code="+91", mobile_number="9000000002",
+            active=True, change_seq=1,
+        )
+
+    def test_negotiation(self):
+        for path in ("/drf/accounts/users/me/", "/async/accounts/users/me/", "/drf/accounts/users/sync/"):
+            with self.subTest(path=path):
+                expected = self.client.get(path, **self.headers).json()
+                response = self.client.get(path, HTTP_ACCEPT="application/msgpack", **self.headers)
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response["Content-Type"], "application/msgpack")
+                self.assertEqual(msgpack.unpackb(response.content), expected)
+        response = self.client.get("/drf/accounts/users/me/", {"format": "msgpack"}, **self.headers)
+        self.assertEqual(response["Content-Type"], "application/msgpack")
+        # JSON stays the default
+        response = self.client.get("/drf/accounts/users/me/", HTTP_ACCEPT="*/*", **self.headers)
+        self.assertEqual(response["Content-Type"], "application/json")
+
+    def test_etag_depends_on_media_type(self):
+        for path in ("/drf/accounts/users/me/", "/async/accounts/users/me/", "/drf/accounts/users/sync/"):
+            with self.subTest(path=path):
+                json_etag = self.client.get(path, **self.headers)["ETag"]
+                response = self.client.get(
+                    path, HTTP_ACCEPT="application/msgpack", HTTP_IF_NONE_MATCH=json_etag, **self.headers
+                )
+                self.assertEqual(response.status_code, 200)
+                self.assertNotEqual(response["ETag"], json_etag)
+                response = self.client.get(
+                    path, HTTP_ACCEPT="application/msgpack", HTTP_IF_NONE_MATCH=response["ETag"], **self.headers
+                )
+                self.assertEqual(response.status_code, 304)
+
+    def test_msgpack_body(self):
+        contacts = [{"name": "Friend", "country_code": "+91", "mobile_number": self.friend.mobile_number}]
+        for path in ("/drf/accounts/add-contacts/", "/drf/accounts/add-contacts/stream/"):
+            with self.subTest(path=path):
+                UserContact.objects.filter(user=self.user).delete()
+                response = self.client.post(
+                    path, msgpack.packb({"contacts": contacts}), "application/msgpack",
+                    HTTP_ACCEPT="application/msgpack", **self.headers
+                )
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response["Content-Type"], "application/msgpack")
+                msgpack.unpackb(response.content)
+                self.assertEqual(
+                    list(UserContact.objects.filter(user=self.user).values_list("name", "username")),
+                    [("Friend", "user2")]
+                )
+        response = self.client.post(
+            "/drf/accounts/add-contacts/", b"\xc1", "application/msgpack", **self.headers
+        )
+        self.assertEqual(response.status_code, 400)
+
+
+class StreamingMessagePackTests(SimpleTestCase):
+    """
+    iter_msgpack_array must yield what msgpack.unpackb does, wherever the reads split the body.
+    """
+
+    def items(self, body, read_size=2, key=None, **kwargs):
+        return list(iter_msgpack_array(io.BytesIO(body), key=key, read_size=read_size, **kwargs))
+
+    def test_round_trip(self):
+        values = [{"name": "\u00fcn\u00ef", "n": 2 ** 40}, [1, 2.5, None, True], "x" * 300, b"bytes", {1: "a"}]
+        for read_size in range(1, 8):
+            with self.subTest(read_size=read_size):
+                self.assertEqual(self.items(msgpack.packb(values), read_size), values)
+                body = msgpack.packb({"before": {"a": [1]}, "contacts": values, "after": 1})
+                self.assertEqual(self.items(body, read_size, key="contacts"), values)
+        self.assertEqual(self.items(msgpack.packb([])), [])
+
+    def test_malformed(self):
+        for body, key in (
+            (b"", None), (b"\x92\x01", None), (b"\xc1", None), (msgpack.packb([1]) + b"x", None),
+            (msgpack.packb({"a": 1}), None), (msgpack.packb({"other": []}), "contacts"),
+            (msgpack.packb({"contacts": 1}), "contacts"), (msgpack.packb([]), "contacts"),
+        ):
+            with self.subTest(body=body, key=key), self.assertRaises(ParseError):
+                self.items(body, key=key)
+
+    def test_item_size_limit(self):
+        with self.assertRaises(ParseError):
+            self.items(msgpack.packb(["a" * 200]), read_size=16, max_item_size=100)
+        self.assertEqual(len(self.items(msgpack.packb(["a" * 50] * 100), read_size=16, max_item_size=100)), 100)
+
+
+@override_settings(
+    JOBS_EAGER=False, JOBS_MAX_ATTEMPTS=3, JOBS_RETRY_DELAY=datetime.timedelta(seconds=10),
+    JOBS_TIMEOUT=datetime.timedelta(minutes=10), JOBS_KEEP_DONE=datetime.timedelta(days=7),
+)
+class JobTests(TestCase):
+    """
+    Jobs are claimed once, retried with exponential backoff and purged once done.
+    """
+
+    def setUp(self):
+        self.calls = []
+        self.failures = 0
+        patcher = mock.patch.dict(jobs.registry, {"test": self.handler})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def handler(self, **payload):
+        self.calls.append(payload)
+        if self.failures:
+            self.failures -= 1
+            raise RuntimeError("boom")
+
+    def due(self, job):
+        Job.objects.filter(id=job.id).update(run_after=timezone.now())
+
+    def test_run(self):
+        job = jobs.enqueue("test", {"a": 1})
+        self.assertEqual(jobs.run_claimed(), 1)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts, self.calls), (Job.DONE, 1, [{"a": 1}]))
+        self.assertEqual(jobs.run_claimed(), 0)
+        with self.assertRaises(KeyError):
+            jobs.enqueue("unknown")
+
+    def test_retry_backoff(self):
+        self.failures = 2
+        job = jobs.enqueue("test")
+        for attempt, delay in ((1, 10), (2, 20)):
+            before = timezone.now()
+            with self.assertLogs("apps.accounts.jobs", "WARNING"):
+                jobs.run_claimed()
+            job.refresh_from_db()
+            self.assertEqual((job.status, job.attempts), (Job.PENDING, attempt))
+            self.assertIn("RuntimeError: boom", job.last_error)
+            self.assertGreaterEqual(job.run_after, before + datetime.timedelta(seconds=delay))
+            self.assertLess(job.run_after, timezone.now() + datetime.timedelta(seconds=delay))
+            # Not due yet
+            self.assertEqual(jobs.run_claimed(), 0)
+            self.due(job)
+        jobs.run_claimed()
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts, job.last_error), (Job.DONE, 3, ""))
+
+    def test_failed_after_max_attempts(self):
+        self.failures = 3
+        job = jobs.enqueue("test")
+        with self.assertLogs("apps.accounts.jobs", "WARNING") as logs:
+            for _ in range(3):
+                self.due(job)
+                jobs.run_claimed()
+        self.assertIn("failed permanently", logs.output[-1])
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (Job.FAILED, 3))
+        self.due(job)
+        self.assertEqual(jobs.run_claimed(), 0)
+        self.assertEqual(len(self.calls), 3)
+
+    def test_claimed_once(self):
+        first, second = jobs.enqueue("test"), jobs.enqueue("test", delay=datetime.timedelta(minutes=1))
+        with CaptureQueriesContext(connection) as queries:
+            claimed = jobs.claim(batch_size=10)
+        self.assertEqual([job.id for job in claimed], [first.id])
+        # Rows are locked, other workers skip them. SQLite has no row locks, the SQL is not checked.
+        if connection.features.has_select_for_update_skip_locked:
+            self.assertIn("SKIP LOCKED", queries[0]["sql"])
+        first.refresh_from_db()
+        self.assertEqual((first.status, first.attempts), (Job.RUNNING, 1))
+        self.assertEqual(jobs.claim(batch_size=10), [])
+
+        # The worker died, the job is picked up again after JOBS_TIMEOUT
+        Job.objects.filter(id=first.id).update(updated_at=timezone.now() - datetime.timedelta(minutes=11))
+        self.assertEqual([job.id for job in jobs.claim(batch_size=10)], [first.id])
+        self.assertEqual(jobs.claim(ids=[second.id])[0].id, second.id)
+
+    def test_purge(self):
+        done, recent, failed, pending = [jobs.enqueue("test") for _ in range(4)]
+        Job.objects.filter(id__in=[done.id, recent.id]).update(status=Job.DONE)
+        Job.objects.filter(id=failed.id).update(status=Job.FAILED)
+        Job.objects.exclude(id=recent.id).update(updated_at=timezone.now() - datetime.timedelta(days=8))
+
+        self.assertEqual(jobs.purge(batch_size=1), 1)
+        self.assertEqual(
+            set(Job.objects.values_list("id", flat=True)), {recent.id, failed.id, pending.id}
+        )
+        self.assertEqual(jobs.purge(datetime.timedelta(0)), 1)
+        self.assertEqual(set(Job.objects.values_list("id", flat=True)), {failed.id, pending.id})
+
+    def test_run_jobs_command(self):
+        job = jobs.enqueue("test")
+        old = jobs.enqueue("test")
+        Job.objects.filter(id=old.id).update(status=Job.DONE, updated_at=timezone.now() - datetime.timedelta(days=8))
+        out = io.StringIO()
+        call_command("run_jobs", "--once", stdout=out)
+        self.assertEqual(Job.objects.get(id=job.id).status, Job.DONE)
+        self.assertFalse(Job.objects.filter(id=old.id).exists())
+        self.assertIn("Deleted 1 done jobs", out.getvalue())
+
+        Job.objects.filter(id=job.id).update(updated_at=timezone.now() - datetime.timedelta(days=8))
+        call_command("run_jobs", "--once", "--purge-interval", "0", stdout=io.StringIO())
+        self.assertTrue(Job.objects.filter(id=job.id).exists())
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class KeysetPaginationTests(TestCase):
+    """
+    groups/ pages by (created_at, id): every group once, whatever the ties and the writes between pages.
+    """
+
+    def setUp(self):
+        for cache in caches.all():
+            cache.clear()
+        token_cache.clear()
+        self.user = make_user(1)
+        self.headers = {"HTTP_AUTH": f"Token {Token.objects.create(user=self.user).key}"}
+        self.start = timezone.now().replace(microsecond=0) - datetime.timedelta(days=1)
+
+    def create(self, count, created_at):
+        groups = [ChatGroup.objects.create(name=f"Group {index}", created_by=self.user) for index in range(count)]
+        ChatGroup.objects.filter(id__in=[group.id for group in groups]).update(created_at=created_at)
+        return groups
+
+    def page(self, url=None, page_size=2):
+        # Next links keep the page size
+        if url is None:
+            response = self.client.get("/accounts/groups/", {"page_size": page_size}, **self.headers)
+        else:
+            response = self.client.get(url, **self.headers)
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        return [group["unique_id"] for group in data["results"]], data["next"]
+
+    def walk(self, url=None, page_size=2):
+        ids = []
+        while True:
+            page, url = self.page(url, page_size)
+            ids += page
+            if url is None:
+                return ids
+
+    def expected(self):
+        return list(ChatGroup.objects.order_by("created_at", "id").values_list("unique_id", flat=True))
+
+    def test_ties(self):
+        # Pages end inside runs of equal created_at
+        self.create(5, self.start)
+        self.create(3, self.start + datetime.timedelta(microseconds=1))
+        self.create(1, self.start - datetime.timedelta(seconds=1))
+        for page_size in (1, 2, 3, 4):
+            with self.subTest(page_size=page_size):
+                self.assertEqual(self.walk(page_size=page_size), self.expected())
+
+    def test_cursor_stability(self):
+        self.create(3, self.start)
+        self.create(3, self.start + datetime.timedelta(microseconds=1))
+        first, url = self.page(page_size=3)
+        expected = self.expected()
+
+        # Rows written after the first page neither shift nor repeat the next ones
+        ChatGroup.objects.filter(unique_id=first[0]).delete()
+        ChatGroup.objects.filter(unique_id=expected[4]).delete()
+        new = self.create(2, self.start + datetime.timedelta(seconds=1))
+        self.create(1, self.start - datetime.timedelta(seconds=1))
+        rest = self.walk(url, page_size=3)
+        self.assertEqual(rest, [expected[3], expected[5]] + [group.unique_id for group in new])
+
+        # A cursor gives the same page every time
+        self.assertEqual(self.page(url, 3), self.page(url, 3))
+
+    def test_invalid_cursor(self):
+        for cursor in ("nope", *(base64.urlsafe_b64encode(value).decode() for value in (b"[1]", b"[null, 1]"))):
+            with self.subTest(cursor=cursor):
+                response = self.client.get("/accounts/groups/", {"cursor": cursor}, **self.headers)
+                self.assertEqual(response.status_code, 404)
+
+
+@override_settings(CACHES=LOCMEM_CACHES, JOBS_EAGER=False)
+class GroupMembersTests(TestCase):
+    """
+    member_count follows the GroupMember rows through every membership change, members pages them.
+    """
+
+    def setUp(self):
+        for cache in caches.all():
+            cache.clear()
+        token_cache.clear()
+        self.owner = make_user(1)
+        self.users = [make_user(index) for index in range(2, 8)]
+        response = self.post(self.owner, "/accounts/groups/", {
+            "name": "Group", "users": [self.users[0].username, self.users[1].username, self.owner.username],
+        })
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()["member_count"], 3)
+        self.group = ChatGroup.objects.get(name="Group")
+        self.url = f"/accounts/groups/{self.group.unique_id}/"
+
+    def headers(self, user):
+        return {"HTTP_AUTH": f"Token {Token.objects.get_or_create(user=user)[0].key}"}
+
+    def post(self, user, path, data=None):
+        return self.client.post(path, json.dumps(data or {}), "application/json", **self.headers(user))
+
+    def assertMemberCount(self, count):
+        self.group.refresh_from_db()
+        self.assertEqual(self.group.member_count, count)
+        self.assertEqual(GroupMember.objects.filter(group=self.group).count(), count)
+        response = self.client.get(self.url, **self.headers(self.owner))
+        self.assertEqual(response.json()["member_count"], count)
+
+    def test_member_count(self):
+        self.assertMemberCount(3)
+        self.assertEqual(self.post(self.users[2], self.url + "join/").status_code, 200)
+        self.assertMemberCount(4)
+        # Already a member
+        self.assertEqual(self.post(self.users[2], self.url + "join/").status_code, 400)
+        self.assertMemberCount(4)
+
+        self.assertEqual(self.post(self.owner, self.url + "add_member/", {"username": "user5"}).status_code, 200)
+        self.assertMemberCount(5)
+        self.assertEqual(self.post(self.owner, self.url + "add_member/", {"username": "user5"}).status_code, 400)
+        self.assertEqual(self.post(self.owner, self.url + "add_member/", {"username": "nobody"}).status_code, 400)
+        self.assertMemberCount(5)
+
+        self.assertEqual(self.post(self.users[2], self.url + "exit/").status_code, 204)
+        self.assertMemberCount(4)
+        # Not a member any more
+        self.assertEqual(self.post(self.users[2], self.url + "exit/").status_code, 204)
+        self.assertMemberCount(4)
+
+        response = self.post(self.owner, self.url + "add_members/", {"usernames": ["user2", "user6", "user7"]})
+        self.assertEqual(response.status_code, 200)
+        self.assertMemberCount(6)
+        response = self.post(self.owner, self.url + "remove_members/", {"usernames": ["user6", "user7", "user4"]})
+        self.assertEqual(response.status_code, 200)
+        self.assertMemberCount(4)
+
+    def test_premium_add_member(self):
+        ChatGroup.objects.filter(id=self.group.id).update(premium=True, amount=100)
+        response = self.post(self.users[0], self.url + "add_member/", {"username": "user5"})
+        self.assertEqual(response.status_code, 400)
+        self.assertMemberCount(3)
+        self.assertEqual(self.post(self.owner, self.url + "add_member/", {"username": "user5"}).status_code, 200)
+        self.assertMemberCount(4)
+
+    def test_members(self):
+        for user in self.users[2:]:
+            self.post(user, self.url + "join/")
+        usernames = []
+        url = self.url + "members/?page_size=2"
+        while url:
+            response = self.client.get(url, **self.headers(self.users[5]))
+            self.assertEqual(response.status_code, 200)
+            usernames += [member["username"] for member in response.json()["results"]]
+            url = response.json()["next"]
+        self.assertEqual(usernames, ["user1", "user2", "user3", "user4", "user5", "user6", "user7"])
+        self.assertEqual(
+            response.json()["results"][-1],
+            {"name": "User 7", "username": "user7", "id": self.users[5].id, "is_admin": False}
+        )
+
+    def test_members_permissions(self):
+        self.assertEqual(self.client.get(self.url + "members/").status_code, 403)
+        response = self.client.get("/accounts/groups/missing/members/", **self.headers(self.owner))
+        self.assertEqual(response.status_code, 404)
+        # Any signed in user sees who is in a group, like groups/ lists them
+        self.assertEqual(self.client.get(self.url + "members/", **self.headers(self.users[5])).status_code, 200)
+
+
+@override_settings(CACHES=LOCMEM_CACHES, JOBS_EAGER=False)
+class BulkGroupMembersTests(TestCase):
+    """
+    add_members and remove_members change many memberships at once, in a constant number of queries.
+    """
+
+    def setUp(self):
+        for cache in caches.all():
+            cache.clear()
+        token_cache.clear()
+        self.owner = make_user(1)
+        self.admin, self.member, self.outsider = make_user(2), make_user(3), make_user(4)
+        self.others = [make_user(index) for index in range(10, 40)]
+        self.group = ChatGroup.objects.create(name="Group", created_by=self.owner)
+        GroupMember.objects.bulk_create([
+            GroupMember(group=self.group, user=self.owner, is_admin=True),
+            GroupMember(group=self.group, user=self.admin, is_admin=True),
+            GroupMember(group=self.group, user=self.member),
+        ])
+        self.group.refresh_member_count()
+        self.url = f"/accounts/groups/{self.group.unique_id}/"
+
+    def post(self, user, action, usernames):
+        return self.client.post(
+            self.url + action, json.dumps({"usernames": usernames}), "application/json",
+            HTTP_AUTH=f"Token {Token.objects.get_or_create(user=user)[0].key}",
+        )
+
+    def members(self):
+        return set(GroupMember.objects.filter(group=self.group).values_list("user__username", flat=True))
+
+    def test_add_members(self):
+        response = self.post(self.member, "add_members/", ["user10", "user3", "nobody", "user11", "user10"])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {"added": ["user10", "user11"], "skipped": ["user3"], "invalid": ["nobody"]})
+        self.assertEqual(self.members(), {"user1", "user2", "user3", "user10", "user11"})
+
+        for usernames in ([], ["x"] * (settings.GROUP_MEMBERS_BULK_LIMIT + 1), "user12"):
+            with self.subTest(usernames=len(usernames)):
+                self.assertEqual(self.post(self.owner, "add_members/", usernames).status_code, 400)
+        self.assertEqual(len(self.members()), 5)
+
+    def test_add_members_premium(self):
+        ChatGroup.objects.filter(id=self.group.id).update(premium=True, amount=100)
+        # Only the creator adds members to premium groups, other admins don't
+        for user in (self.admin, self.member, self.outsider):
+            with self.subTest(user=user.username):
+                self.assertEqual(self.post(user, "add_members/", ["user10"]).status_code, 400)
+        self.assertEqual(self.post(self.owner, "add_members/", ["user10"]).status_code, 200)
+        self.assertIn("user10", self.members())
+
+    def test_remove_members(self):
+        for user in (self.member, self.outsider):
+            with self.subTest(user=user.username):
+                response = self.post(user, "remove_members/", ["user2"])
+                self.assertEqual(response.status_code, 400)
+                self.assertEqual(response.json(), {"error": "Only admin can remove members"})
+        self.assertIn("user2", self.members())
+
+        response = self.post(self.admin, "remove_members/", ["user3", "user4", "nobody"])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {"removed": ["user3"], "skipped": ["user4"], "invalid": ["nobody"]})
+        response = self.post(self.owner, "remove_members/", ["user2"])
+        self.assertEqual(response.json()["removed"], ["user2"])
+        self.assertEqual(self.members(), {"user1"})
+        self.group.refresh_from_db()
+        self.assertEqual(self.group.member_count, 1)
+
+    def test_unauthenticated(self):
+        for action in ("add_members/", "remove_members/"):
+            response = self.client.post(self.url + action, json.dumps({"usernames": ["user10"]}), "application/json")
+            self.assertEqual(response.status_code, 403)
+        self.assertEqual(len(self.members()), 3)
+
+    def test_constant_queries(self):
+        # Creates the token and caches it, outside of the counted requests
+        self.post(self.owner, "add_members/", [self.owner.username])
+        for action in ("add_members/", "remove_members/"):
+            counts = []
+            for users in (self.others[:1], self.others[1:30]):
+                usernames = [user.username for user in users]
+                with CaptureQueriesContext(connection) as queries:
+                    self.assertEqual(self.post(self.owner, action, usernames).status_code, 200)
+                counts.append(len(queries))
+            with self.subTest(action=action):
+                self.assertEqual(counts[0], counts[1])
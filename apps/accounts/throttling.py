@@ -0,0 +1,130 @@
+from django.conf import settings
+from django.core.cache import caches
+from rest_framework.throttling import SimpleRateThrottle
+
+from apps.accounts.authentication import get_authorization_header
+from apps.accounts.utils import normalize_phone
+
+
+class SlidingWindowRateThrottle(SimpleRateThrottle):
+    """
+    Sliding window counter kept in the THROTTLE_CACHE cache, shared by all workers.
+
+    Unlike SimpleRateThrottle, which rewrites a list of timestamps, every request
+    is one atomic ``incr`` of the current window's counter. The previous window
+    is weighted by how much of it still overlaps the sliding window.
+    Rejected requests count too, so a client has to back off to get through.
+    """
+
+    @property
+    def cache(self):
+        return caches[settings.THROTTLE_CACHE]
+
+    def allow_request(self, request, view):
+        if self.rate is None:
+            return True
+
+        ident = self.get_cache_key(request, view)
+        if ident is None:
+            return True
+        return self.hit(ident)
+
+    def hit(self, ident, count_rejected=True):
+        """
+        Count a request against the window of ``ident``, return whether it is allowed.
+        Without ``count_rejected`` a request over the limit is not counted.
+        """
+        now = self.timer()
+        window, offset = divmod(now, self.duration)
+        key, previous_key = f"{ident}_{int(window)}", f"{ident}_{int(window) - 1}"
+        overlap = 1 - offset / self.duration
+        self.wait_seconds = self.duration - offset
+        if not count_rejected:
+            counts = self.cache.get_many([key, previous_key])
+            if counts.get(previous_key, 0) * overlap + counts.get(key, 0) + 1 > self.num_requests:
+                return False
+        self.cache.add(key, 0, self.duration * 2)
+        try:
+            current = self.cache.incr(key)
+        except ValueError:
+            # Expired between add and incr
+            self.cache.add(key, 1, self.duration * 2)
+            current = 1
+        previous = self.cache.get(previous_key, 0)
+        allowed = previous * overlap + current <= self.num_requests
+        if not allowed and not count_rejected:
+            # A concurrent request took the last slot
+            try:
+                self.cache.decr(key)
+            except ValueError:
+                pass
+        return allowed
+
+    def wait(self):
+        return self.wait_seconds
+
+    def format_key(self, ident):
+        return self.cache_format % {'scope': self.scope, 'ident': ident}
+
+
+class IPRateThrottle(SlidingWindowRateThrottle):
+
+    def get_cache_key(self, request, view):
+        return self.format_key(self.get_ident(request))
+
+
+class MobileNumberRateThrottle(SlidingWindowRateThrottle):
+    """
+    Keyed by the normalized mobile number in the request body,
+    so reformatting the number does not get around it.
+
+    Only allowed requests count against the number, or anyone could keep a
+    victim's number locked out by sending requests for it. Rejected requests
+    count against the number and IP pair, the client sending them backs off.
+    """
+
+    def allow_request(self, request, view):
+        if self.rate is None:
+            return True
+
+        ident = self.get_cache_key(request, view)
+        if ident is None:
+            return True
+        return self.hit(f"{ident}:{self.get_ident(request)}") and self.hit(ident, count_rejected=False)
+
+    def get_cache_key(self, request, view):
+        try:
+            phone_key = normalize_phone(request.data.get("country_code"), request.data.get("mobile_number"))
+        except (AttributeError, TypeError):
+            return None
+        if not phone_key:
+            return None
+        return self.format_key(phone_key)
+
+
+class TokenRateThrottle(SlidingWindowRateThrottle):
+    """
+    Keyed by the raw token in the auth header, the token is not looked up.
+    """
+
+    def get_cache_key(self, request, view):
+        auth = get_authorization_header(request).split()
+        if len(auth) != 2:
+            return None
+        return self.format_key(auth[1].decode(errors="replace"))
+
+
+class LoginIPRateThrottle(IPRateThrottle):
+    scope = "login_ip"
+
+
+class LoginMobileNumberRateThrottle(MobileNumberRateThrottle):
+    scope = "login_mobile"
+
+
+class VerifyOtpIPRateThrottle(IPRateThrottle):
+    scope = "verify_otp_ip"
+
+
+class VerifyOtpMobileNumberRateThrottle(MobileNumberRateThrottle):
+    scope = "verify_otp_mobile"
@@ -1,7 +1,7 @@
 from django.urls import path
 from django.conf import settings
 
-from apps.accounts import views as accounts_views
+from apps.accounts import async_views, views as accounts_views
 from rest_framework.routers import DefaultRouter, SimpleRouter
 
 if settings.DEBUG:
@@ -12,9 +12,21 @@ else:
 router.register("users", accounts_views.UserViewSet)
 router.register("groups", accounts_views.ChatGroupViewSet)
 
-urlpatterns = [
+if settings.ASYNC_VIEWS:
+    # Ahead of the router, which serves the DRF versions of users/sync/ and users/me/
+    async_urlpatterns = [
+        path("login/", async_views.login),
+        path("verify-otp/", async_views.verify_otp),
+        path("users/sync/", async_views.sync),
+        path("users/me/", async_views.me),
+    ]
+else:
+    async_urlpatterns = []
+
+urlpatterns = async_urlpatterns + [
     # API base url
     path("login/", accounts_views.LoginApiView.as_view()),
     path("verify-otp/", accounts_views.VerifyOtpApiView.as_view()),
     path("add-contacts/", accounts_views.AddNewContacts.as_view()),
+    path("add-contacts/stream/", accounts_views.StreamAddNewContacts.as_view()),
 ] + router.urls
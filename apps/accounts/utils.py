@@ -1,6 +1,7 @@
 import base64
 import binascii
 import imghdr
+import re
 import uuid
 
 from django.core.files.base import ContentFile
@@ -17,6 +18,30 @@ ALLOWED_IMAGE_TYPES = (
 
 EMPTY_VALUES = (None, '', [], (), {})
 
+NON_DIGITS = re.compile(r"\D")
+
+#: E.164 numbers have at most 15 digits, phone keys fit in PHONE_KEY_MAX_LENGTH characters
+E164_MAX_DIGITS = 15
+PHONE_KEY_MAX_LENGTH = E164_MAX_DIGITS + 1
+
+
+def normalize_phone(country_code, mobile_number, default_country_code=""):
+    """
+    Return the key contacts are matched to users on: ``+<country code><number>``
+    in E.164 form. Formatting, the ``+`` sign and trunk zeros are dropped.
+    Without any country code only the national digits are returned.
+    None when there is no number or it is longer than E.164 allows.
+    """
+    number = NON_DIGITS.sub("", mobile_number or "").lstrip("0")
+    if not number:
+        return None
+    country = NON_DIGITS.sub("", country_code or "") or NON_DIGITS.sub("", default_country_code or "")
+    if len(country) + len(number) > E164_MAX_DIGITS:
+        return None
+    if not country:
+        return number
+    return f"+{country}{number}"
+
 
 class Base64ImageField(ImageField):
 
@@ -1,10 +1,13 @@
 import datetime
 
-from django.utils import timezone
+from django.conf import settings
+from django.db.models import Max, Q
 
 from django.contrib.auth import get_user_model
 from rest_framework import status
 from rest_framework.decorators import action
+from rest_framework.exceptions import ParseError, ValidationError
+from rest_framework.parsers import MultiPartParser
 from rest_framework.mixins import RetrieveModelMixin, CreateModelMixin, ListModelMixin, UpdateModelMixin
 from rest_framework.response import Response
 from rest_framework.viewsets import GenericViewSet
@@ -12,13 +15,45 @@ from rest_framework.views import APIView
 from rest_framework.authtoken.models import Token
 from rest_framework.permissions import IsAuthenticated
 
-from apps.accounts.serializers import UserSerializer, LoginSerializer, VerifyOtpSerializer, ProfileUpdateSerializer, UserContactsSerializer, UserContactSerializer
+from apps.accounts.serializers import UserSerializer, LoginSerializer, VerifyOtpSerializer, ProfileUpdateSerializer, UserContactsSerializer, UserContactSerializer, create_contacts
+from apps.accounts.conditional import Validators
+from apps.accounts.pagination import CreatedAtKeysetPagination, GroupMemberPagination
+from apps.accounts.parsers import MessagePackParser
+from apps.accounts.streaming import iter_json_array, iter_msgpack_array, iter_chunks
 from apps.accounts.models import UserContact, ChatGroup, GroupMember
 from apps.accounts import serializers as accounts_serializers
+from apps.accounts import cache as accounts_cache
+from apps.accounts import fast_serializers, jobs, throttling
 
 User = get_user_model()
 
 
+def sync_contacts(user, cursor, paths):
+    """
+    Values of the contacts of ``user`` changed after ``cursor``, in sync order.
+    """
+    change_seq, contact_id = cursor
+    return UserContact.objects.filter(
+        Q(change_seq__gt=change_seq) | Q(change_seq=change_seq, id__gt=contact_id),
+        user=user, username__isnull=False
+    ).exclude(username__exact='').order_by("change_seq", "id").values(*paths, "change_seq")
+
+
+def sync_page(serializer, contacts, page_size, cursor):
+    """
+    users/sync payload from the first ``page_size + 1`` contacts after ``cursor``.
+    """
+    has_more = len(contacts) > page_size
+    contacts = contacts[:page_size]
+    if contacts:
+        cursor = (contacts[-1]["change_seq"], contacts[-1]["id"])
+    return {
+        "results": serializer.serialize(contacts),
+        "cursor": accounts_serializers.SyncCursorSerializer.encode(cursor),
+        "has_more": has_more,
+    }
+
+
 class UserViewSet(RetrieveModelMixin, GenericViewSet):
     serializer_class = UserSerializer
     queryset = User.objects.all()
@@ -30,37 +65,81 @@ class UserViewSet(RetrieveModelMixin, GenericViewSet):
         assert isinstance(self.request.user.id, int)
         return self.queryset
 
+    def retrieve(self, request, *args, **kwargs):
+        user_id = self.get_queryset().filter(
+            **{self.lookup_field: kwargs[self.lookup_field]}
+        ).values_list("id", flat=True).first()
+        if user_id is None:
+            return super().retrieve(request, *args, **kwargs)
+        versions = accounts_cache.get_versions([accounts_cache.user_key(user_id)])
+        validators = Validators("user", versions.values(), request)
+        return validators.not_modified(request) or validators.apply(super().retrieve(request, *args, **kwargs))
+
     @action(detail=False, methods=["GET"])
     def sync(self, request):
-        serializer = UserSerializer(
-            list(UserContact.objects.filter(
-                user=self.request.user, updated_at__gte=self.request.user.last_sync,
-                username__isnull=False
-            ).exclude(username__exact='')),
-            context={"request": request},
-            many=True
-        )
-        self.request.user.last_sync = timezone.now()
-        self.request.user.save()
-        return Response(status=status.HTTP_200_OK, data=serializer.data)
+        params = accounts_serializers.SyncCursorSerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+        change_seq, contact_id = params.validated_data["cursor"]
+        page_size = params.validated_data.get("page_size", settings.SYNC_PAGE_SIZE)
+
+        # Every contact change takes a new change_seq, the highest one versions the delta
+        last_change_seq = UserContact.objects.filter(user=self.request.user).aggregate(
+            last=Max("change_seq")
+        )["last"] or 0
+        validators = Validators("sync", [last_change_seq], request)
+        response = validators.not_modified(request)
+        if response:
+            return response
+
+        serializer = fast_serializers.SyncContactFastSerializer(context={"request": request})
+        contacts = list(sync_contacts(request.user, (change_seq, contact_id), serializer.paths)[:page_size + 1])
+        return validators.apply(Response(
+            status=status.HTTP_200_OK, data=sync_page(serializer, contacts, page_size, (change_seq, contact_id))
+        ))
 
     @action(detail=False, methods=["GET", "PUT"])
     def me(self, request):
         if request.method == "GET":
-            serializer = UserSerializer(request.user, context={"request": request})
-            return Response(status=status.HTTP_200_OK, data=serializer.data)
+            version_keys = [accounts_cache.user_key(request.user.id)]
+            validators = Validators("me", accounts_cache.get_versions(version_keys).values(), request)
+            response = validators.not_modified(request)
+            if response:
+                return response
+            # Built from the database, request.user may be a copy cached by the authentication
+            data = accounts_cache.cached_data(
+                f"me:{request.user.id}:{request.build_absolute_uri('/')}",
+                version_keys,
+                lambda: UserSerializer(User.objects.get(id=request.user.id), context={"request": request}).data
+            )
+            return validators.apply(Response(status=status.HTTP_200_OK, data=data))
         else:
-            serializer = ProfileUpdateSerializer(data=request.data, instance=self.request.user, partial=True)
+            serializer = ProfileUpdateSerializer(
+                data=request.data, instance=User.objects.get(id=request.user.id), partial=True
+            )
             serializer.is_valid(raise_exception=True)
             serializer.save()
             return Response(status=status.HTTP_200_OK)
 
+    @action(detail=False, methods=["PUT"], url_path="me/image", parser_classes=(MultiPartParser, ))
+    def image(self, request):
+        """
+        Replace the profile image with the ``image`` file of a multipart body.
+        Variants are generated in the background, the response has none yet.
+        """
+        serializer = accounts_serializers.AvatarUploadSerializer(
+            data=request.data, instance=User.objects.get(id=request.user.id)
+        )
+        serializer.is_valid(raise_exception=True)
+        user = serializer.save()
+        return Response(UserSerializer(user, context={"request": request}).data, status=status.HTTP_202_ACCEPTED)
+
 
 class ChatGroupViewSet(UpdateModelMixin, ListModelMixin, RetrieveModelMixin, CreateModelMixin, GenericViewSet):
     serializer_class = accounts_serializers.ChatGroupSerializer
     update_serializer_class = accounts_serializers.ChatGroupUpdateSerializer
     queryset = ChatGroup.objects.all()
     lookup_field = "unique_id"
+    pagination_class = CreatedAtKeysetPagination
 
     permission_classes = (IsAuthenticated, )
 
@@ -70,7 +149,27 @@ class ChatGroupViewSet(UpdateModelMixin, ListModelMixin, RetrieveModelMixin, Cre
             queryset = queryset.filter(premium=True)
         elif self.request.query_params.get("premium") in [False, "false"]:
             queryset = queryset.filter(premium=False)
-        return queryset.prefetch_related('groupmember_set__user')
+        return queryset.select_related('created_by')
+
+    def list(self, request, *args, **kwargs):
+        versions = accounts_cache.get_versions([accounts_cache.GROUPS_KEY])
+        validators = Validators("groups", versions.values(), request)
+        response = validators.not_modified(request)
+        if response:
+            return response
+        serializer = fast_serializers.ChatGroupFastSerializer(context={"request": request})
+        page = self.paginate_queryset(serializer.values(self.filter_queryset(self.get_queryset())))
+        return validators.apply(self.get_paginated_response(serializer.serialize(page)))
+
+    def retrieve(self, request, *args, **kwargs):
+        group_id = self.get_queryset().filter(
+            **{self.lookup_field: kwargs[self.lookup_field]}
+        ).values_list("id", flat=True).first()
+        if group_id is None:
+            return super().retrieve(request, *args, **kwargs)
+        versions = accounts_cache.get_versions([accounts_cache.group_key(group_id)])
+        validators = Validators("group", versions.values(), request)
+        return validators.not_modified(request) or validators.apply(super().retrieve(request, *args, **kwargs))
 
     def update(self, request, *args, **kwargs):
         partial = kwargs.pop('partial', False)
@@ -87,12 +186,26 @@ class ChatGroupViewSet(UpdateModelMixin, ListModelMixin, RetrieveModelMixin, Cre
         return Response(serializer.data)
 
     @action(detail=False, methods=["GET"])
-    def mine(self, *args, **kwargs):
-        queryset = self.queryset.filter(
-            groupmember__user=self.request.user).distinct().prefetch_related('groupmember_set__user'
-        )
-        serializer = self.serializer_class(queryset, many=True)
-        return Response(serializer.data, status=status.HTTP_200_OK)
+    def mine(self, request, *args, **kwargs):
+        def build():
+            queryset = self.queryset.filter(
+                id__in=GroupMember.objects.filter(user=request.user).values("group_id")
+            )
+            serializer = fast_serializers.ChatGroupFastSerializer(context={"request": request})
+            page = self.paginate_queryset(serializer.values(queryset))
+            return self.get_paginated_response(serializer.serialize(page)).data
+
+        # The set of groups, then each group
+        version_keys = [accounts_cache.memberships_key(request.user.id)] + [
+            accounts_cache.group_key(group_id)
+            for group_id in GroupMember.objects.filter(user=request.user).values_list("group_id", flat=True)
+        ]
+        validators = Validators("mine", accounts_cache.get_versions(version_keys).values(), request)
+        response = validators.not_modified(request)
+        if response:
+            return response
+        data = accounts_cache.cached_data(f"mine:{request.user.id}:{request.build_absolute_uri()}", version_keys, build)
+        return validators.apply(Response(data, status=status.HTTP_200_OK))
 
     @action(detail=True, methods=["POST"])
     def add_member(self, request, *args, **kwargs):
@@ -102,10 +215,14 @@ class ChatGroupViewSet(UpdateModelMixin, ListModelMixin, RetrieveModelMixin, Cre
                 data={'error': 'Only admin can add member in premium group'},
                 status=status.HTTP_400_BAD_REQUEST
             )
-        data = dict(group=group.id, user=User.objects.get(username=request.data.get("username")).id)
+        user_id = User.objects.filter(username=request.data.get("username")).values_list("id", flat=True).first()
+        if user_id is None:
+            raise ValidationError({"username": ["Invalid username"]})
+        data = dict(group=group.id, user=user_id)
         serializer = accounts_serializers.GroupMemberSerializer(data=data)
         serializer.is_valid(raise_exception=True)
         serializer.save()
+        group.adjust_member_count(1)
         return Response(status=status.HTTP_200_OK)
 
     @action(detail=True, methods=["POST"])
@@ -117,40 +234,51 @@ class ChatGroupViewSet(UpdateModelMixin, ListModelMixin, RetrieveModelMixin, Cre
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-        usernames = request.data.get("usernames")
-        if type(usernames) is not list:
-            return Response(data={'error': 'usernames should be a list'}, status=status.HTTP_400_BAD_REQUEST)
-        serializers = []
-        group_id = group.id
-        already_added_users = set(GroupMember.objects.filter(group_id=group_id).values_list('user__username', flat=True))
-        usernames = set(usernames) - already_added_users
-        for username in usernames:
-            user = User.objects.filter(username=username).only('id').first()
-            if not user:
-                return Response(data={'error': f'Invalid username {username}'}, status=status.HTTP_400_BAD_REQUEST)
-            data = dict(group=group_id, user=user.id)
-            serializer = accounts_serializers.GroupMemberSerializer(data=data)
-            serializer.is_valid(raise_exception=True)
-            serializers.append(serializer)
-        for serializer in serializers:
-            serializer.save()
-        return Response(status=status.HTTP_200_OK)
+        serializer = accounts_serializers.GroupMembersSerializer(data=request.data, context={"group": group})
+        serializer.is_valid(raise_exception=True)
+        return Response(data=serializer.add(), status=status.HTTP_200_OK)
+
+    @action(detail=True, methods=["POST"])
+    def remove_members(self, request, *args, **kwargs):
+        group = self.get_object()
+        if request.user.id != group.created_by_id and not GroupMember.objects.filter(
+            group=group, user=request.user, is_admin=True
+        ).exists():
+            return Response(
+                data={'error': 'Only admin can remove members'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        serializer = accounts_serializers.GroupMembersSerializer(data=request.data, context={"group": group})
+        serializer.is_valid(raise_exception=True)
+        return Response(data=serializer.remove(), status=status.HTTP_200_OK)
 
     @action(detail=True, methods=["POST"])
     def join(self, request, *args, **kwargs):
-        data = dict(**request.data, group=self.get_object().id, user=request.user.id)
+        group = self.get_object()
+        data = dict(**request.data, group=group.id, user=request.user.id)
         serializer = accounts_serializers.GroupMemberSerializer(data=data)
         serializer.is_valid(raise_exception=True)
         serializer.save()
+        group.adjust_member_count(1)
         return Response(status=status.HTTP_200_OK)
 
     @action(detail=True, methods=["POST"])
     def exit(self, request, *args, **kwargs):
-        GroupMember.objects.filter(group=self.get_object(), user=request.user).delete()
+        group = self.get_object()
+        deleted, _ = GroupMember.objects.filter(group=group, user=request.user).delete()
+        group.adjust_member_count(-deleted)
         return Response(status=status.HTTP_204_NO_CONTENT)
 
+    @action(detail=True, methods=["GET"], pagination_class=GroupMemberPagination)
+    def members(self, request, *args, **kwargs):
+        queryset = GroupMember.objects.filter(group=self.get_object()).select_related('user')
+        page = self.paginate_queryset(queryset)
+        serializer = accounts_serializers.GroupMemberDetailSerializer(page, many=True)
+        return self.get_paginated_response(serializer.data)
+
 
 class LoginApiView(APIView):
+    throttle_classes = (throttling.LoginIPRateThrottle, throttling.LoginMobileNumberRateThrottle)
 
     def post(self, request, *args, **kwargs):
         serializer = LoginSerializer(data=request.data)
@@ -160,22 +288,14 @@ class LoginApiView(APIView):
 
 
 class VerifyOtpApiView(APIView):
+    throttle_classes = (throttling.VerifyOtpIPRateThrottle, throttling.VerifyOtpMobileNumberRateThrottle)
 
     def post(self, request, *args, **kwargs):
         serializer = VerifyOtpSerializer(data=request.data)
         serializer.is_valid(raise_exception=True)
-        serializer.verify(serializer.validated_data)
         user = serializer.validated_data["user"]
 
-        UserContact.objects.filter(
-            mobile_number=user.mobile_number
-        ).update(
-            username=user.username,
-            updated_at=timezone.now(),
-            active=True
-        )
-        user.last_sync = timezone.datetime(2022, 1, 1)
-        user.save()
+        jobs.enqueue("activate_contacts", {"user_id": user.id})
 
         token, created = Token.objects.get_or_create(user=user)
         return Response({
@@ -193,4 +313,42 @@ class AddNewContacts(APIView):
         serializer = UserContactsSerializer(data=request.data, context={'request': self.request})
         serializer.is_valid(raise_exception=True)
         new_contacts = serializer.save()
-        return Response(data=UserContactSerializer(new_contacts, many=True).data, status=status.HTTP_200_OK)
+        return Response(
+            data=fast_serializers.UserContactFastSerializer().serialize_objects(new_contacts),
+            status=status.HTTP_200_OK
+        )
+
+
+class StreamAddNewContacts(APIView):
+    """
+    Same as AddNewContacts, but the body is parsed while it is read and
+    contacts are validated and inserted ``CONTACTS_UPLOAD_CHUNK_SIZE`` at a time.
+
+    Chunks are committed as they go. When a chunk is invalid the error names it,
+    and the client can re-send the whole body since existing contacts are skipped.
+    The response only counts the contacts of every chunk, so memory does not grow
+    with the address book. Matched contacts are read through users/sync.
+    """
+    permission_classes = (IsAuthenticated, )
+
+    def post(self, request, *args, **kwargs):
+        if request.stream is None:
+            raise ParseError('"contacts" is required')
+
+        chunks = []
+        if MessagePackParser.media_type in (request.content_type or ""):
+            items = iter_msgpack_array(request.stream, key="contacts")
+        else:
+            items = iter_json_array(request.stream, key="contacts")
+        for index, chunk in enumerate(iter_chunks(items, settings.CONTACTS_UPLOAD_CHUNK_SIZE)):
+            serializer = UserContactSerializer(data=chunk, many=True)
+            if not serializer.is_valid():
+                raise ValidationError({"chunk": index, "contacts": serializer.errors})
+            new_contacts = create_contacts(request.user, serializer.validated_data)
+            chunks.append({
+                "index": index,
+                "received": len(chunk),
+                "created": len(new_contacts),
+                "matched": sum(contact.username is not None for contact in new_contacts),
+            })
+        return Response(data={"chunks": chunks}, status=status.HTTP_200_OK)
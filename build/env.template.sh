@@ -8,4 +8,6 @@ export DB_HOST=
 export DB_NAME=
 export DB_PASSWORD=
 export DB_PORT=5432
-export DB_USER=
\ No newline at end of file
+export DB_USER=
+export REDIS_URL=
+export METRICS_TOKEN=
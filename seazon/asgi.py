@@ -13,4 +13,18 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'seazon.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# Imported once the apps are loaded
+from apps.accounts.events import event_stream  # noqa: E402
+
+# Streams that Django 4.1 can't serve from an async view
+streams = {
+    "/accounts/events/": event_stream,
+}
+
+
+async def application(scope, receive, send):
+    if scope["type"] == "http" and scope["path"] in streams:
+        return await streams[scope["path"]](scope, receive, send)
+    return await django_application(scope, receive, send)
@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/4.1/ref/settings/
 """
 
 from pathlib import Path
+import datetime
 import os
 import sentry_sdk
 
@@ -44,11 +45,12 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'apps.accounts.middleware.MetricsMiddleware',
+    'apps.accounts.middleware.ReplicaMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
-    # 'apps.accounts.middleware.LogMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
@@ -129,6 +131,153 @@ REST_FRAMEWORK = {
         "rest_framework.authentication.SessionAuthentication",
         "apps.accounts.authentication.CustomTokenAuthentication",
     ),
+    "DEFAULT_RENDERER_CLASSES": (
+        "apps.accounts.renderers.FastJSONRenderer",
+        "apps.accounts.renderers.MessagePackRenderer",
+        "rest_framework.renderers.BrowsableAPIRenderer",
+    ),
+    "DEFAULT_PARSER_CLASSES": (
+        "apps.accounts.parsers.FastJSONParser",
+        "apps.accounts.parsers.MessagePackParser",
+        "rest_framework.parsers.FormParser",
+        "rest_framework.parsers.MultiPartParser",
+    ),
+    "DEFAULT_THROTTLE_RATES": {
+        "login_ip": "30/min",
+        "login_mobile": "5/hour",
+        "verify_otp_ip": "30/min",
+        "verify_otp_mobile": "10/hour",
+    },
+}
+
+# Cache alias of the rate limit counters, it has to be shared by all workers
+THROTTLE_CACHE = "shared"
+
+# Serve login, verify-otp, users/sync and users/me from apps.accounts.async_views under ASGI.
+# Off by default: Django 4.1's async ORM still runs every query on the sync thread,
+# only the cache and SMS waits are concurrent.
+ASYNC_VIEWS = os.environ.get("ASYNC_VIEWS", "0") == "1"
+
+# Number of contacts validated and inserted at once by the streaming contact upload
+CONTACTS_UPLOAD_CHUNK_SIZE = 500
+
+# Spool every upload to a temporary file instead of holding it in memory
+FILE_UPLOAD_HANDLERS = ["django.core.files.uploadhandler.TemporaryFileUploadHandler"]
+
+# Profile image uploads and the variants generated by the avatar_variants job
+AVATAR = {
+    "MAX_UPLOAD_SIZE": 10 * 1024 * 1024,
+    "SIZES": (64, 128, 256, 512),
+    "QUALITY": 85,
+    "UPLOAD_TO": "user/profile_photo/variants/",
+}
+
+# apps.accounts.media, MAX_AGE in seconds. SENDFILE is None, "x-sendfile" or "x-accel-redirect",
+# the latter maps directories to nginx internal locations.
+MEDIA_SERVING = {
+    "CACHE_ROOT": os.path.join(BASE_DIR, '.media-cache'),
+    "MAX_AGE": 365 * 24 * 60 * 60,
+    "SENDFILE": os.environ.get('MEDIA_SENDFILE') or None,
+    "ACCEL_REDIRECT_LOCATIONS": {
+        MEDIA_ROOT: "/internal/media/",
+        os.path.join(BASE_DIR, '.media-cache'): "/internal/media-cache/",
+    },
+}
+
+# Page size of the contact delta sync (users/sync), clients may ask for up to SYNC_MAX_PAGE_SIZE
+SYNC_PAGE_SIZE = 500
+SYNC_MAX_PAGE_SIZE = 2000
+
+# Most usernames accepted by one groups/<id>/add_members/ or remove_members/ call
+GROUP_MEMBERS_BULK_LIMIT = 1000
+
+# Background jobs, run by `python manage.py run_jobs`. With JOBS_EAGER jobs run on commit in the request.
+JOBS_EAGER = False
+JOBS_MAX_ATTEMPTS = 5
+JOBS_RETRY_DELAY = datetime.timedelta(seconds=10)
+JOBS_TIMEOUT = datetime.timedelta(minutes=10)
+# Done jobs are deleted by run_jobs once this old, failed ones are kept for inspection
+JOBS_KEEP_DONE = datetime.timedelta(days=7)
+
+# Outbound SMS, sent by the send_sms job. LocMemBackend keeps messages in apps.accounts.sms.outbox.
+SMS_BACKEND = 'apps.accounts.sms.TwilioBackend'
+SMS_MAX_ATTEMPTS = 5
+SMS_TIMEOUT = 10
+TWILIO_ACCOUNT_SID = os.environ.get('TWILIO_ACCOUNT_SID')
+TWILIO_AUTH_TOKEN = os.environ.get('TWILIO_AUTH_TOKEN')
+TWILIO_PHONE_NUMBER = os.environ.get('TWILIO_PHONE_NUMBER')
+
+# Login OTPs, TTL in seconds. Codes are dropped after MAX_ATTEMPTS wrong guesses.
+OTP_STORE = {
+    "CACHE": "shared",
+    "TTL": 300,
+    "MAX_ATTEMPTS": 5,
+}
+
+# Contacts linked per transaction when a new user verifies
+CONTACT_ACTIVATION_BATCH_SIZE = 1000
+
+# Caches, "shared" is visible to every worker process
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # Single machine development only, `check --deploy` asks for Redis: OTP attempts and
+    # rate limits need an atomic incr(). Past MAX_ENTRIES files a third of the entries,
+    # OTPs and counters included, are evicted at random.
+    'shared': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(BASE_DIR, '.cache'),
+        'OPTIONS': {
+            'MAX_ENTRIES': 100000,
+        },
+    },
+}
+if os.environ.get('REDIS_URL'):
+    CACHES['shared'] = {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': os.environ.get('REDIS_URL'),
+    }
+
+# Cached payloads of users/me and groups/mine, invalidated by version bumps. TIMEOUT in seconds.
+ACCOUNTS_CACHE = {
+    "CACHE": "shared",
+    "TIMEOUT": 24 * 60 * 60,
+}
+
+# Token -> user cache of CustomTokenAuthentication, TTL in seconds
+AUTH_TOKEN_CACHE = {
+    "MAX_SIZE": 10000,
+    "TTL": 60,
+    "SHARED_CACHE": "shared" if os.environ.get('REDIS_URL') else None,
+}
+
+# Aliases of DATABASES safe requests read from, see apps.accounts.routers. A client that
+# wrote reads from the primary for STICKY_SECONDS, remembered in the CACHE cache.
+DATABASE_ROUTERS = ['apps.accounts.routers.ReplicaRouter']
+READ_REPLICAS = {
+    "ALIASES": [],
+    "STICKY_SECONDS": 10,
+    "CACHE": "shared",
+}
+
+# Request metrics of apps.accounts.metrics, served on /metrics. FLUSH_INTERVAL in seconds.
+# Scrapers send "Authorization: Bearer <TOKEN>", without a TOKEN the endpoint is only served with DEBUG.
+METRICS = {
+    "DIR": os.path.join(BASE_DIR, '.metrics'),
+    "FLUSH_INTERVAL": 5,
+    "TOKEN": os.environ.get('METRICS_TOKEN'),
+}
+
+# Server-sent events of apps.accounts.events, Redis carries them between processes.
+# Disabled without Redis: the web and job workers all publish events.
+EVENTS = {
+    "BACKEND": "apps.accounts.events.RedisBroker" if os.environ.get('REDIS_URL') else None,
+    "OPTIONS": {"url": os.environ.get('REDIS_URL')} if os.environ.get('REDIS_URL') else {},
+    "QUEUE_SIZE": 100,
+    # Seconds between keep-alive comments, and before a client reconnects
+    "KEEPALIVE": 15,
+    "RETRY": 5,
 }
 
 
@@ -166,6 +315,10 @@ elif os.environ.get('use_aws'):
             'PORT': os.environ.get('DB_PORT'),
         }
     }
+    # Comma separated hosts of streaming replicas of DB_HOST
+    for index, host in enumerate(filter(None, os.environ.get('DB_REPLICA_HOSTS', '').split(',')), 1):
+        DATABASES[f'replica_{index}'] = {**DATABASES['default'], 'HOST': host.strip(), 'TEST': {'MIRROR': 'default'}}
+        READ_REPLICAS["ALIASES"].append(f'replica_{index}')
 
 else:
     # Database
@@ -174,5 +327,11 @@ else:
         'default': {
             'ENGINE': 'django.db.backends.sqlite3',
             'NAME': BASE_DIR / 'db.sqlite3',
-        }
+        },
+        # Same file, to try out READ_REPLICAS locally and in tests
+        'replica': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': BASE_DIR / 'db.sqlite3',
+            'TEST': {'MIRROR': 'default'},
+        },
     }